@@ -0,0 +1,322 @@
+'''
+文档格式的性能测试，记录读写速度(MB/s)、内存峰值和结果占用的内存，结果保存为json以便比较不同提交之间的差异
+
+PYTHONPATH=. python test/benchdoc.py --max-size 1G --output bench.json
+PYTHONPATH=. python test/benchdoc.py --compare old.json
+'''
+import argparse
+import base64
+import gc
+import hashlib
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import unittest
+from typing import Callable, Dict, List
+
+from writerlib.cipher import DocEnvelope
+from writerlib.doc import DocHead, DocInfoBlock, DocBody, DocFile
+
+from testdoc import conent
+
+KB = 1 << 10
+MB = 1 << 20
+GB = 1 << 30
+
+BodySizes = [KB, 64 * KB, MB, 16 * MB, 256 * MB, GB]
+InfoBlockCounts = [0, 10, 100, 1000]
+ImageCounts = [0, 10, 50]
+ImageSize = 200 * KB
+
+# 每项测试至少运行的时间(秒)
+minTime = 0.2
+
+
+def createHtml(size: int, imageNames: List[str] = ()) -> str:
+    paragraphs = [p for p in conent.splitlines() if p]
+    lines = list()
+    length = 0
+    index = 0
+    while length < size:
+        line = '<p style=" margin-top:0px; margin-bottom:0px; margin-left:0px; margin-right:0px; ' \
+               '-qt-block-indent:0; text-indent:0px;"><span style=" font-family:\'Microsoft YaHei UI\'; ' \
+               'font-size:14pt;">%s</span></p>' % paragraphs[index % len(paragraphs)]
+        if imageNames and index % 5 == 0:
+            line += '<p><img src="%s" width="640" height="480" /></p>' % imageNames[(index // 5) % len(imageNames)]
+        lines.append(line)
+        length += len(line.encode('utf-8')) + 1
+        index += 1
+    html = '\n'.join(lines)
+    return html
+
+
+def createImages(count: int) -> List[bytes]:
+    # 随机数据不能压缩，和已经压缩的图片相近
+    return [os.urandom(ImageSize) for index in range(count)]
+
+
+def createDocFile(content: bytes, infoCount: int, codec: int, images: List[bytes] = ()) -> DocFile:
+    df = DocFile()
+    df.docBody = DocBody()
+    df.docBody.content = content
+    df.docInfoBlock = list()
+    for index in range(infoCount):
+        block = DocInfoBlock()
+        block.name = ('property%d' % index).encode('utf-8')
+        block.value = '2022-10-01 12:00:00.000000 +0000 UTC'.encode('utf-8')
+        df.docInfoBlock.append(block)
+    for image in images:
+        df.docAssets[hashlib.sha256(image).hexdigest()] = image
+    df.docHead = DocHead()
+    df.docHead.docType = DocHead.DocType.Writer
+    df.docHead.codec = codec
+    df.docHead.docInfoBlockLen = [i.getByteLen() for i in df.docInfoBlock]
+    return df
+
+
+def measure(func: Callable, dataLen: int) -> Dict[str, float]:
+    '''
+    返回每次运行的时间、速度、运行过程中新分配内存的峰值，以及运行结束后结果仍然占用的内存块数量和大小。
+    tracemalloc只能记录仍然存在的内存块，不能统计分配的次数，减少复制和临时对象的效果体现在内存峰值上
+    '''
+    func()
+    number = 0
+    best = float('inf')
+    total = 0
+    while total < minTime or number < 3:
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = min(best, elapsed)
+        total += elapsed
+        number += 1
+        if elapsed > minTime * 5:
+            break
+
+    # 结果在运行中释放，峰值包括结果和所有临时分配的内存
+    gc.collect()
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    # 结果仍然占用的内存，和快照分开测量，快照本身不计入峰值
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    result = func()
+    stats = tracemalloc.take_snapshot().compare_to(before, 'filename')
+    tracemalloc.stop()
+    del result
+
+    return {
+        'seconds': best,
+        'mbps': dataLen / MB / best if best > 0 else 0,
+        'peakBytes': peak,
+        'peakRatio': peak / dataLen if dataLen > 0 else 0,
+        'retainedBlocks': sum(stat.count_diff for stat in stats if stat.count_diff > 0),
+        'retainedBytes': sum(stat.size_diff for stat in stats if stat.size_diff > 0),
+        'runs': number,
+    }
+
+
+def benchDocFile(results: list, content: bytes, infoCount: int, codec: int, images: List[bytes] = ()):
+    codecName = [name for name, value in DocHead.Codec.Names.items() if value == codec][0]
+    key = {'body': len(content), 'infos': infoCount, 'images': len(images), 'codec': codecName}
+    data = createDocFile(content, infoCount, codec, images).toByteIO().getvalue()
+    dataLen = len(content) + sum(len(image) for image in images)
+    for name, func in (
+            ('DocFile.toByteIO', lambda: createDocFile(content, infoCount, codec, images).toByteIO()),
+            ('DocFile.toBuffers', lambda: createDocFile(content, infoCount, codec, images).toBuffers()),
+            ('DocFile.fromBytes', lambda: DocFile.fromBytes(data)),
+            ('DocFile.fromBuffer', lambda: DocFile.fromBuffer(data)),
+    ):
+        results.append(dict(name=name, **key, **measure(func, dataLen)))
+        print(formatResult(results[-1]))
+
+    # 加密文档的保存和打开，内存峰值应该和分块大小相关，而不是文件大小的几倍
+    encryptKey = bytes(32)
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, 'bench.writer')
+        for name, func in (
+                ('DocEnvelope.encryptToFile', lambda: DocEnvelope.encryptToFile(
+                    encryptKey, path, createDocFile(content, infoCount, codec, images).toBuffers())),
+                ('DocEnvelope.decryptFile', lambda: DocEnvelope.decryptFile(encryptKey, path)[0]),
+        ):
+            results.append(dict(name=name, **key, **measure(func, dataLen)))
+            print(formatResult(results[-1]))
+        # 没有变化的分块不再加密，只写入新的分块表
+        envelope = DocEnvelope.encryptToFile(encryptKey, path,
+                                             createDocFile(content, infoCount, codec, images).toBuffers())
+        results.append(dict(name='DocEnvelope.update', **key, **measure(
+            lambda: envelope.update(encryptKey, path, createDocFile(content, infoCount, codec, images).toBuffers()),
+            dataLen)))
+        print(formatResult(results[-1]))
+
+
+def createTextEdit():
+    '''
+    TextEdit需要QApplication，没有安装PySide6时跳过
+    '''
+    try:
+        os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+        from PySide6.QtWidgets import QApplication
+        from writerlib.textedit import TextEdit
+    except ImportError:
+        return None
+    global application
+    application = QApplication.instance() or QApplication(sys.argv[:1])
+    return TextEdit(None)
+
+
+def benchTextEdit(results: list, textEdit, html: str, infoCount: int, codec: int, images: List[bytes] = ()):
+    codecName = [name for name, value in DocHead.Codec.Names.items() if value == codec][0]
+    key = {'body': len(html.encode('utf-8')), 'infos': infoCount, 'images': len(images), 'codec': codecName}
+    properties = {'property%d' % index: '2022-10-01 12:00:00.000000 +0000 UTC' for index in range(infoCount)}
+    textEdit.setAssets({hashlib.sha256(image).hexdigest(): image for image in images})
+    data = textEdit.docToBytes(html, properties, codec)
+    dataLen = key['body'] + sum(len(image) for image in images)
+    for name, func in (
+            ('TextEdit.docToBytes', lambda: textEdit.docToBytes(html, properties, codec)),
+            ('TextEdit.docfromBytes', lambda: textEdit.docfromBytes(data)),
+    ):
+        results.append(dict(name=name, **key, **measure(func, dataLen)))
+        print(formatResult(results[-1]))
+
+
+def formatResult(result: dict) -> str:
+    return '%-26s body=%-10d infos=%-4d images=%-3d codec=%-4s %9.1fMB/s peak=%.2fx retained=%d blocks' % (
+        result['name'], result['body'], result['infos'], result['images'], result['codec'],
+        result['mbps'], result['peakRatio'], result['retainedBlocks'])
+
+
+def runBenchmarks(maxBodySize: int = 16 * MB, codecs=('none', 'zlib')) -> dict:
+    results = list()
+    codecs = [DocHead.Codec.Names[name] for name in codecs]
+    textEdit = createTextEdit()
+
+    # 不同大小的正文
+    for size in [size for size in BodySizes if size <= maxBodySize]:
+        html = createHtml(size)
+        content = html.encode('utf-8')
+        for codec in codecs:
+            benchDocFile(results, content, 5, codec)
+            if textEdit is not None:
+                benchTextEdit(results, textEdit, html, 5, codec)
+        del html, content
+
+    # 不同数量的信息块
+    content = createHtml(64 * KB).encode('utf-8')
+    for infoCount in InfoBlockCounts:
+        benchDocFile(results, content, infoCount, DocHead.Codec.Raw)
+
+    # 包含大量图片的文档，TextEdit还测试旧版本的base64图片
+    for imageCount in [count for count in ImageCounts if count * ImageSize <= maxBodySize * 4]:
+        images = createImages(imageCount)
+        names = ['asset:' + hashlib.sha256(image).hexdigest() for image in images]
+        html = createHtml(MB, names)
+        for codec in codecs:
+            benchDocFile(results, html.encode('utf-8'), 5, codec, images)
+            if textEdit is not None:
+                benchTextEdit(results, textEdit, html, 5, codec, images)
+        if textEdit is not None and imageCount > 0:
+            dataUris = ['data:image/png;base64,' + base64.b64encode(image).decode('ascii') for image in images]
+            benchTextEdit(results, textEdit, createHtml(MB, dataUris), 5, DocHead.Codec.Raw)
+            results[-2]['name'] += '(base64)'
+            results[-1]['name'] += '(base64)'
+
+    return {
+        'commit': getCommit(),
+        'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'textEdit': textEdit is not None,
+        'results': results,
+    }
+
+
+def getCommit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return ''
+
+
+def resultKey(result: dict):
+    return result['name'], result['body'], result['infos'], result['images'], result['codec']
+
+
+def compareResults(old: dict, new: dict) -> List[str]:
+    '''
+    比较两次测试的速度和内存峰值，返回每项的变化
+    '''
+    oldResults = {resultKey(r): r for r in old['results']}
+    lines = list()
+    for result in new['results']:
+        oldResult = oldResults.get(resultKey(result))
+        if oldResult is None:
+            continue
+        lines.append('%-26s body=%-10d infos=%-4d images=%-3d codec=%-4s speed %6.2fx peak %6.2fx' % (
+            result['name'], result['body'], result['infos'], result['images'], result['codec'],
+            result['mbps'] / oldResult['mbps'] if oldResult['mbps'] else 0,
+            result['peakBytes'] / oldResult['peakBytes'] if oldResult['peakBytes'] else 0))
+    return lines
+
+
+def parseSize(size: str) -> int:
+    units = {'K': KB, 'M': MB, 'G': GB}
+    size = size.upper().rstrip('B')
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+
+class DocFormatBenchmark(unittest.TestCase):
+
+    def test_benchmark_small(self):
+        global minTime
+        oldMinTime, minTime = minTime, 0.01
+        try:
+            report = runBenchmarks(64 * KB, ('none',))
+        finally:
+            minTime = oldMinTime
+        names = {r['name'] for r in report['results']}
+        self.assertIn('DocFile.fromBuffer', names)
+        self.assertIn('DocFile.toBuffers', names)
+        self.assertIn('DocEnvelope.decryptFile', names)
+        self.assertEqual({r['infos'] for r in report['results']}, {5, *InfoBlockCounts})
+        for result in report['results']:
+            self.assertGreater(result['mbps'], 0)
+        # 和自己比较时速度变化只和测量误差有关
+        self.assertEqual(len(compareResults(report, report)), len(report['results']))
+        json.dumps(report)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='文档格式性能测试')
+    parser.add_argument('--max-size', default='16M', help='正文的最大大小，例如1K、16M、1G')
+    parser.add_argument('--codec', action='append', choices=list(DocHead.Codec.Names.keys()), help='测试的压缩格式')
+    parser.add_argument('--output', default='bench_doc.json', help='保存结果的json文件')
+    parser.add_argument('--compare', help='和之前保存的json文件比较')
+    args = parser.parse_args()
+
+    report = runBenchmarks(parseSize(args.max_size), args.codec or ('none', 'zlib'))
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            old = json.load(f)
+        print('\n和%s(%s)比较：' % (args.compare, old.get('commit', '')))
+        for line in compareResults(old, report):
+            print(line)
+
+
+if __name__ == '__main__':
+    main()
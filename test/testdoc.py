@@ -1,8 +1,28 @@
+import errno
+import hashlib
+import hmac
+import io
+import mmap
+import os
+import tempfile
+import time
+import timeit
 import unittest
+import zlib
 from io import BytesIO
+from pathlib import Path
 from typing import List
+from unittest import mock
 
-from writer import DocHead, DocInfoBlock, DocBody, DocFile
+from writerlib import doc
+from writerlib.cipher import DocEnvelope, KeyContext
+from writerlib.doc import DocHead, DocInfoBlock, DocBody, DocFile, DocJournal, DocInfoTable, CorruptFileException
+
+try:
+    from PySide6.QtGui import QImage
+    from writerlib.assets import ImageScalePolicy, imageToBytes, prepareImage
+except ImportError:
+    QImage = None
 
 
 class MyTestCase(unittest.TestCase):
@@ -51,6 +71,38 @@ class MyTestCase(unittest.TestCase):
         self.assertEqual(newBlock.name, block.name)
         self.assertEqual(newBlock.value, block.value)
 
+    def test_docinfoblock_v1(self):
+        block = DocInfoBlock()
+        block.name = 'author'.encode('utf-8')
+        block.value = '名字'.encode('utf-8')
+        data = block.toByteIO(version=DocHead.Version.V1).getvalue()
+        self.assertEqual(len(data), block.getByteLen(DocHead.Version.V1))
+        self.assertEqual(len(data), DocInfoBlock.nameLen + len(block.value))
+        newBlock = DocInfoBlock.fromBytes(data, DocHead.Version.V1)
+        self.assertDocInfoBlock(block, newBlock)
+
+    def test_docinfoblock_v2(self):
+        block = DocInfoBlock()
+        block.name = '测试'.encode('utf-8')
+        block.value = b''
+        data = block.toByteIO().getvalue()
+        self.assertEqual(len(data), block.getByteLen())
+        self.assertEqual(len(data), DocInfoBlock.NameLenBytesLen + len(block.name))
+        newBlock = DocInfoBlock.fromBytes(data)
+        self.assertDocInfoBlock(block, newBlock)
+
+    def test_dochead_version(self):
+        for version in (DocHead.Version.V1, DocHead.Version.V2):
+            head = self.createDocHead()
+            head.version = version
+            newHead = DocHead.fromBytes(head.toBytesIO().getvalue())
+            self.assertEqual(newHead.version, version)
+            self.assertDocHead(head, newHead)
+        # V1版本的文档类型字段和旧文件保持一致
+        head = self.createDocHead()
+        head.version = DocHead.Version.V1
+        self.assertEqual(head.toBytesIO().getvalue()[4:6], b'\x00\x01')
+
     def test_docbody(self):
         docBody = DocBody()
         docBody.content = conent.encode('utf-8')
@@ -101,6 +153,758 @@ class MyTestCase(unittest.TestCase):
             self.assertDocInfoBlock(a, b)
         self.assertDocBody(newDf.docBody, df.docBody)
 
+    def createDocFile(self):
+        df = DocFile()
+
+        docBody = DocBody()
+        docBody.content = conent.encode('utf-8')
+
+        infoList:List[DocInfoBlock] = list()
+        for name, value in (('author', '名字'), ('title', '标题'), ('测试', 'aaaa')):
+            block = DocInfoBlock()
+            block.name = name.encode('utf-8')
+            block.value = value.encode('utf-8')
+            infoList.append(block)
+
+        head = DocHead()
+        head.docBodyLen = len(docBody.content)
+        head.docType = DocHead.DocType.Writer
+        head.docInfoBlockLen = [i.getByteLen() for i in infoList]
+
+        df.docHead = head
+        df.docBody = docBody
+        df.docInfoBlock = infoList
+        return df
+
+    def assertDocFile(self, df, newDf):
+        self.assertDocHead(df.docHead, newDf.docHead)
+        self.assertEqual(len(df.docInfoBlock), len(newDf.docInfoBlock))
+        for a,b in zip(df.docInfoBlock, newDf.docInfoBlock):
+            self.assertDocInfoBlock(a, b)
+        self.assertEqual(bytes(newDf.docBody.content), df.docBody.content)
+
+    def test_docfile_fromstream(self):
+        df = self.createDocFile()
+        data = df.toByteIO().getvalue()
+        newDf = DocFile.fromStream(BytesIO(data))
+        self.assertDocFile(df, newDf)
+        self.assertDocBody(df.docBody, newDf.docBody)
+
+    def test_docfile_frombuffer(self):
+        df = self.createDocFile()
+        data = df.toByteIO().getvalue()
+        newDf = DocFile.fromBuffer(data)
+        self.assertDocFile(df, newDf)
+        # 正文是原数据的视图，没有复制
+        self.assertIsInstance(newDf.docBody.content, memoryview)
+        self.assertIs(newDf.docBody.content.obj, data)
+        self.assertEqual(str(newDf.docBody.content, 'utf-8'), conent)
+
+    def test_docfile_open(self):
+        df = self.createDocFile()
+        with tempfile.TemporaryDirectory() as folder:
+            path = Path(folder) / 'test.writer'
+            path.write_bytes(df.toByteIO().getvalue())
+            newDf = DocFile.open(path)
+        self.assertDocFile(df, newDf)
+        self.assertDocBody(df.docBody, newDf.docBody)
+
+    def test_docfile_v1(self):
+        # 按旧版本格式手工构造的文件
+        name = 'author'.encode('utf-8')
+        value = '名字'.encode('utf-8')
+        body = conent.encode('utf-8')
+        data = b''.join([
+            (1).to_bytes(4, byteorder='big'),
+            (1).to_bytes(2, byteorder='big'),
+            (1024 + len(value)).to_bytes(5, byteorder='big'),
+            len(body).to_bytes(7, byteorder='big'),
+            b'\0' * (1024 - len(name)), name, value,
+            body,
+        ])
+        newDf = DocFile.fromBytes(data)
+        self.assertEqual(newDf.docHead.version, DocHead.Version.V1)
+        self.assertEqual(newDf.docInfoBlock[0].name, name)
+        self.assertEqual(newDf.docInfoBlock[0].value, value)
+        self.assertEqual(newDf.docBody.content, body)
+
+        df = self.createDocFile()
+        df.docHead.version = DocHead.Version.V1
+        df.docHead.docInfoBlockLen = [i.getByteLen(DocHead.Version.V1) for i in df.docInfoBlock]
+        self.assertDocFile(df, DocFile.fromBytes(df.toByteIO().getvalue()))
+
+    def test_docbody_chunks(self):
+        docBody = DocBody()
+        docBody.chunkSize = 512
+        for content in (conent, conent.replace('\n', '')):
+            docBody.content = content.encode('utf-8')
+            chunkLens = docBody.getChunkLens()
+            self.assertGreater(len(chunkLens), 1)
+            self.assertEqual(sum(chunkLens), len(docBody.content))
+            chunks = docBody.getChunks(chunkLens)
+            # 每个分块都可以单独解码
+            self.assertEqual(''.join(str(chunk, 'utf-8') for chunk in chunks), content)
+            if '\n' in content:
+                for chunk in chunks[:-1]:
+                    self.assertEqual(bytes(chunk[-1:]), b'\n')
+
+    def test_docfile_readchunk(self):
+        df = self.createDocFile()
+        df.docBody.chunkSize = 256
+        data = df.toByteIO().getvalue()
+        bis = BytesIO(data)
+        head = DocHead.fromStream(bis)
+        self.assertEqual(head.docChunkLen, df.docBody.getChunkLens())
+        self.assertEqual(head.getBodyOffset(), len(data) - head.docBodyLen)
+        chunks = df.docBody.getChunks()
+        for index in reversed(range(len(head.docChunkLen))):
+            self.assertEqual(DocFile.readChunk(bis, head, index), chunks[index])
+        self.assertDocFile(df, DocFile.fromBytes(data))
+
+    def test_docfile_chunklen_mismatch(self):
+        df = self.createDocFile()
+        data = bytearray(df.toByteIO().getvalue())
+        # 修改文件头中的正文长度
+        offset = DocHead.DocInfoBlockCountBytesLen + DocHead.DocTypeBytesLen + len(df.docInfoBlock) * DocHead.DocInfoBlockBytesLen
+        data[offset:offset + DocHead.DocBodyBytesLen] = (df.docHead.docBodyLen - 1).to_bytes(DocHead.DocBodyBytesLen, byteorder='big')
+        with self.assertRaises(CorruptFileException):
+            DocFile.fromBytes(data)
+
+    def test_docfile_codec(self):
+        for codec in (DocHead.Codec.Zlib, DocHead.Codec.Lzma):
+            df = self.createDocFile()
+            df.docBody.content = (conent * 20).encode('utf-8')
+            df.docBody.chunkSize = 4096
+            df.docHead.codec = codec
+            data = df.toByteIO().getvalue()
+            self.assertLess(len(data), len(df.docBody.content))
+            newDf = DocFile.fromBytes(data)
+            self.assertEqual(newDf.docHead.codec, codec)
+            self.assertDocHead(df.docHead, newDf.docHead)
+            self.assertEqual(newDf.docBody.content, df.docBody.content)
+            bis = BytesIO(data)
+            head = DocHead.fromStream(bis)
+            chunks = df.docBody.getChunks()
+            self.assertGreater(len(chunks), 1)
+            for index in range(len(chunks)):
+                self.assertEqual(DocFile.readChunk(bis, head, index), chunks[index])
+
+    def test_docfile_assets(self):
+        df = self.createDocFile()
+        df.docHead.codec = DocHead.Codec.Zlib
+        images = [bytes(range(256)) * 10, b'\x89PNG' + bytes(1000)]
+        for image in images:
+            df.docAssets[hashlib.sha256(image).hexdigest()] = image
+        data = df.toByteIO().getvalue()
+        self.assertEqual(len(df.docHead.docAssetLen), 2)
+
+        for loader in (DocFile.fromBytes, DocFile.fromBuffer):
+            newDf = loader(data)
+            self.assertDocFile(df, newDf)
+            self.assertEqual(newDf.docHead.docAssetHash, df.docHead.docAssetHash)
+            self.assertEqual({k: bytes(v) for k, v in newDf.docAssets.items()}, df.docAssets)
+
+        bis = BytesIO(data)
+        head = DocHead.fromStream(bis)
+        for index, image in enumerate(images):
+            self.assertEqual(DocFile.readAsset(bis, head, index), image)
+        self.assertEqual(head.getAssetOffset(len(images)), len(data))
+
+    def test_docfile_noassets_v4(self):
+        df = self.createDocFile()
+        df.docHead.version = DocHead.Version.V4
+        df.docAssets['00' * 32] = b'data'
+        newDf = DocFile.fromBytes(df.toByteIO().getvalue())
+        self.assertEqual(newDf.docHead.version, DocHead.Version.V4)
+        self.assertEqual(newDf.docAssets, dict())
+
+    def test_dochead_unknowncodec(self):
+        head = self.createDocHead()
+        head.codec = 200
+        with self.assertRaises(CorruptFileException):
+            DocHead.fromBytes(head.toBytesIO().getvalue())
+
+    def test_docfile_readmetadata(self):
+        df = self.createDocFile()
+        with tempfile.TemporaryDirectory() as folder:
+            path = Path(folder) / 'test.writer'
+            # 正文被截断也不影响读取属性
+            path.write_bytes(df.toByteIO().getvalue()[:-len(df.docBody.content) // 2])
+            metadata = DocFile.readMetadata(path)
+        self.assertEqual(metadata, {'author': '名字', 'title': '标题', '测试': 'aaaa'})
+
+    def test_docfile_readmetadata_encrypted(self):
+        df = self.createDocFile()
+        with tempfile.TemporaryDirectory() as folder:
+            path = Path(folder) / 'test.writer'
+            DocEnvelope.encryptToFile(bytes(range(32)), path, df.toBuffers())
+            with self.assertRaises(CorruptFileException):
+                DocFile.readMetadata(path)
+            # 信息块数量很大的损坏文件不会逐个读取信息块的长度
+            data = bytearray(df.toByteIO().getvalue())
+            data[:DocHead.DocInfoBlockCountBytesLen] = b'\xff' * DocHead.DocInfoBlockCountBytesLen
+            path.write_bytes(data)
+            with self.assertRaises(CorruptFileException):
+                DocFile.readMetadata(path)
+            data = df.toByteIO().getvalue()
+            path.write_bytes(data[:DocHead.DocInfoBlockCountBytesLen + DocHead.DocTypeBytesLen + 2])
+            with self.assertRaises(CorruptFileException):
+                DocFile.readMetadata(path)
+
+    def test_docbody_chunks_stable(self):
+        docBody = DocBody()
+        docBody.chunkSize = 512
+        lines = [('第%d行 ' % i) * 5 for i in range(400)]
+        docBody.content = '\n'.join(lines).encode('utf-8')
+        chunks = [bytes(c) for c in docBody.getChunks()]
+        lines[200] += '修改'
+        docBody.content = '\n'.join(lines).encode('utf-8')
+        newChunks = [bytes(c) for c in docBody.getChunks()]
+        # 修改一行只影响附近的分块
+        self.assertLessEqual(len(set(newChunks) - set(chunks)), 2)
+
+    def createJournalDocFile(self, lines, codec=DocHead.Codec.Zlib):
+        df = self.createDocFile()
+        df.docBody.chunkSize = 512
+        df.docBody.content = '\n'.join(lines).encode('utf-8')
+        df.docHead.codec = codec
+        return df
+
+    def test_docjournal_append(self):
+        lines = [('第%d行 ' % i) * 5 for i in range(400)]
+        image = bytes(range(256)) * 10
+        with tempfile.TemporaryDirectory() as folder:
+            path = Path(folder) / 'test.writer'
+            df = self.createJournalDocFile(lines)
+            journal = DocJournal.write(path, df)
+            baseLen = path.stat().st_size
+            self.assertDocFile(df, DocFile.open(path))
+
+            lines[100] += '修改'
+            df = self.createJournalDocFile(lines)
+            df.docAssets[hashlib.sha256(image).hexdigest()] = image
+            df.docInfoBlock[0].value = '新名字'.encode('utf-8')
+            self.assertTrue(journal.canAppend(path, df))
+            journal.append(path, df)
+            # 只追加了修改的分块和新增的资源
+            self.assertLess(path.stat().st_size - baseLen, len(image) + 2048)
+
+            for loader in (DocFile.fromBytes, DocFile.fromBuffer):
+                newDf = loader(path.read_bytes())
+                self.assertEqual(bytes(newDf.docBody.content), df.docBody.content)
+                self.assertEqual({k: bytes(v) for k, v in newDf.docAssets.items()}, df.docAssets)
+                self.assertEqual(newDf.docInfoBlock[0].value, '新名字'.encode('utf-8'))
+                self.assertEqual(newDf.docJournal.fileLen, path.stat().st_size)
+            self.assertEqual(DocFile.readMetadata(path)['author'], '新名字')
+
+            # 重新打开后继续追加
+            journal = DocFile.open(path).docJournal
+            lines[300] += '再次修改'
+            df = self.createJournalDocFile(lines)
+            journal.append(path, df)
+            self.assertEqual(DocFile.open(path).docBody.content, df.docBody.content)
+            self.assertEqual(DocFile.open(path).docAssets, dict())
+
+    def test_docjournal_torn(self):
+        lines = [('第%d行 ' % i) * 5 for i in range(400)]
+        with tempfile.TemporaryDirectory() as folder:
+            path = Path(folder) / 'test.writer'
+            df = self.createJournalDocFile(lines)
+            journal = DocJournal.write(path, df)
+            saved = path.read_bytes()
+            lines[100] += '修改'
+            journal.append(path, self.createJournalDocFile(lines))
+            data = path.read_bytes()
+            # 最后一条记录没有写完整或者损坏时读取上一次保存的内容
+            for torn in (data[:-1], data[:len(saved) + 10], data[:-5] + bytes(5)):
+                newDf = DocFile.fromBytes(torn)
+                self.assertEqual(newDf.docBody.content, df.docBody.content)
+                self.assertEqual(newDf.docJournal.fileLen, len(saved))
+                # 文件长度不一致时不能继续追加
+                path.write_bytes(torn)
+                self.assertFalse(newDf.docJournal.canAppend(path, df))
+
+    def test_docjournal_readmetadata(self):
+        lines = [('第%d行 ' % i) * 5 for i in range(400)]
+        image = os.urandom(1 << 20)
+        with tempfile.TemporaryDirectory() as folder:
+            path = Path(folder) / 'test.writer'
+            df = self.createJournalDocFile(lines)
+            journal = DocJournal.write(path, df)
+            df.docAssets[hashlib.sha256(image).hexdigest()] = image
+            df.docInfoBlock[0].value = '新名字'.encode('utf-8')
+            journal.append(path, df)
+            data = path.read_bytes()
+
+            class CountingReader(BytesIO):
+                readLen = 0
+
+                def read(self, size=-1):
+                    b = super().read(size)
+                    self.readLen += len(b)
+                    return b
+
+            # 只读取记录头和清单，不读取追加的资源
+            bis = CountingReader(data)
+            head = DocHead.fromStream(bis)
+            journal = DocJournal.readRecords(bis, head, DocJournal.Check.Manifest)
+            self.assertEqual(journal.infoBlocks.properties()['author'], '新名字')
+            self.assertLess(bis.readLen, len(image) // 8)
+            self.assertEqual(DocFile.readMetadata(path)['author'], '新名字')
+
+            # 打开时只检查最后一条记录的数据
+            bis = CountingReader(data)
+            head = DocHead.fromStream(bis)
+            self.assertEqual(DocJournal.readRecords(bis, head).fileLen, len(data))
+            self.assertLess(bis.readLen, len(image) * 2)
+            DocFile.verify(path)
+
+            # 最后一条记录的数据损坏时读取上一次保存的内容
+            corrupt = bytearray(data)
+            corrupt[journal.assets[-1][1]] ^= 1
+            self.assertEqual(DocFile.fromBytes(bytes(corrupt)).docAssets, dict())
+            path.write_bytes(corrupt)
+            with self.assertRaises(CorruptFileException):
+                DocFile.verify(path)
+
+    def test_docjournal_legacy(self):
+        lines = [('第%d行 ' % i) * 5 for i in range(400)]
+        with tempfile.TemporaryDirectory() as folder:
+            path = Path(folder) / 'test.writer'
+            df = self.createJournalDocFile(lines)
+            journal = DocJournal.write(path, df)
+            # 数据和清单共用crc32的旧记录
+            manifest = DocJournal.manifestToBytes(journal.infoBlocks, journal.chunks, journal.assets)
+            record = DocJournal.LegacyRecordMagic + bytes(DocJournal.DataBytesLen) + \
+                     len(manifest).to_bytes(DocJournal.ManifestBytesLen, byteorder='big') + manifest + \
+                     zlib.crc32(manifest).to_bytes(DocJournal.CrcBytesLen, byteorder='big')
+            path.write_bytes(path.read_bytes()[:journal.baseLen] + record)
+            newDf = DocFile.open(path)
+            self.assertEqual(newDf.docBody.content, df.docBody.content)
+            self.assertEqual(newDf.docJournal.fileLen, path.stat().st_size)
+            lines[100] += '修改'
+            df = self.createJournalDocFile(lines)
+            newDf.docJournal.append(path, df)
+            self.assertEqual(DocFile.open(path).docBody.content, df.docBody.content)
+            DocFile.verify(path)
+
+    def test_docjournal_compact(self):
+        lines = [('第%d行 ' % i) * 5 for i in range(400)]
+        with tempfile.TemporaryDirectory() as folder:
+            path = Path(folder) / 'test.writer'
+            journal = DocJournal.write(path, self.createJournalDocFile(lines))
+            for i in range(400):
+                lines[i] += '修改'
+                df = self.createJournalDocFile(lines)
+                if not journal.canAppend(path, df):
+                    break
+                journal.append(path, df)
+            self.assertGreater(journal.getJournalLen(), journal.baseLen * journal.compactRatio)
+            journal = DocJournal.write(path, df)
+            self.assertLess(journal.getJournalLen(), 1024)
+            self.assertEqual(DocFile.open(path).docBody.content, df.docBody.content)
+            self.assertFalse(journal.canAppend(path, self.createJournalDocFile(lines, DocHead.Codec.Raw)))
+
+    def test_docfile_tobuffers(self):
+        df = self.createDocFile()
+        df.docBody.chunkSize = 256
+        image = bytes(range(256)) * 10
+        df.docAssets[hashlib.sha256(image).hexdigest()] = image
+        data = df.toByteIO().getvalue()
+        buffers = df.toBuffers()
+        self.assertEqual(b''.join(buffers), data)
+        # 不压缩时正文分块和资源直接引用原数据
+        chunks = buffers[2:-1]
+        self.assertGreater(len(chunks), 1)
+        for chunk in chunks:
+            self.assertIs(chunk.obj, df.docBody.content)
+        self.assertIs(buffers[-1].obj, image)
+
+        with tempfile.TemporaryDirectory() as folder:
+            path = Path(folder) / 'test.writer'
+            df.save(path)
+            self.assertEqual(path.read_bytes(), data)
+
+    def test_writebuffers(self):
+        buffers = [memoryview(bytes([i % 256]) * (i % 7)) for i in range(doc.IovMax * 3)]
+        with tempfile.TemporaryFile() as f:
+            written = doc.writeBuffers(f.fileno(), buffers)
+            f.seek(0)
+            self.assertEqual(f.read(), b''.join(buffers))
+        self.assertEqual(written, sum(len(b) for b in buffers))
+
+    def test_docfile_open_mmap(self):
+        df = self.createDocFile()
+        with tempfile.TemporaryDirectory() as folder:
+            path = Path(folder) / 'test.writer'
+            df.save(path)
+            newDf = DocFile.open(path, mmapThreshold=0)
+            self.assertDocFile(df, newDf)
+            self.assertIsInstance(newDf.docBody.content.obj, mmap.mmap)
+            self.assertEqual(str(newDf.docBody.content, 'utf-8'), conent)
+            # 文件小于mmapThreshold时直接读取
+            newDf = DocFile.open(path, mmapThreshold=path.stat().st_size + 1)
+            self.assertIsInstance(newDf.docBody.content, bytes)
+
+            journal = DocJournal.write(path, df)
+            df.docInfoBlock[0].value = b'new'
+            journal.append(path, df)
+            newDf = DocFile.open(path, mmapThreshold=0)
+            self.assertEqual(newDf.docInfoBlock[0].value, b'new')
+            self.assertEqual(bytes(newDf.docBody.content), df.docBody.content)
+            newDf = None
+            DocJournal.write(path, df)
+
+    def test_dochead_checksum(self):
+        df = self.createDocFile()
+        data = bytearray(df.toByteIO().getvalue())
+        self.assertEqual(DocHead.getHeadBlockBytesLen(3, 1), df.docHead.getHeadBytesLen())
+        # 修改文件头中的信息块长度
+        data[10] ^= 1
+        with self.assertRaises(CorruptFileException):
+            DocFile.fromBytes(data)
+
+        df.docHead.checksum = DocHead.Checksum.NoChecksum
+        newDf = DocFile.fromBytes(df.toByteIO().getvalue())
+        self.assertEqual(newDf.docHead.checksum, DocHead.Checksum.NoChecksum)
+        self.assertDocFile(df, newDf)
+
+    def test_docfile_verify(self):
+        df = self.createDocFile()
+        df.docBody.chunkSize = 256
+        df.docHead.codec = DocHead.Codec.Zlib
+        image = bytes(range(256)) * 10
+        df.docAssets[hashlib.sha256(image).hexdigest()] = image
+        data = df.toByteIO().getvalue()
+        head = df.docHead
+        with tempfile.TemporaryDirectory() as folder:
+            path = Path(folder) / 'test.writer'
+            path.write_bytes(data)
+            DocFile.verify(path)
+
+            for offset, name in ((head.getHeadBytesLen(), '信息块'),
+                                 (head.getChunkOffset(2), '正文分块2'),
+                                 (head.getAssetOffset(0) + 100, '资源')):
+                corrupt = bytearray(data)
+                corrupt[offset] ^= 0xFF
+                path.write_bytes(corrupt)
+                with self.assertRaises(CorruptFileException) as cm:
+                    DocFile.verify(path, threads=2)
+                self.assertIn(name, str(cm.exception))
+                self.assertEqual(len(str(cm.exception).splitlines()), 1)
+
+            path.write_bytes(data + b'x')
+            with self.assertRaises(CorruptFileException):
+                DocFile.verify(path)
+            path.write_bytes(data[:-1])
+            with self.assertRaises(CorruptFileException):
+                DocFile.verify(path)
+
+            journal = DocJournal.write(path, df)
+            df.docInfoBlock[0].value = b'new'
+            journal.append(path, df)
+            DocFile.verify(path)
+            path.write_bytes(path.read_bytes()[:-1])
+            with self.assertRaises(CorruptFileException):
+                DocFile.verify(path)
+
+    def test_docfile_verify_encrypted(self):
+        df = self.createDocFile()
+        key = bytes(range(32))
+        with tempfile.TemporaryDirectory() as folder:
+            path = Path(folder) / 'test.writer'
+            oldChunkSize, DocEnvelope.chunkSize = DocEnvelope.chunkSize, 100
+            try:
+                DocEnvelope.encryptToFile(key, path, df.toBuffers())
+            finally:
+                DocEnvelope.chunkSize = oldChunkSize
+            encrypted = path.read_bytes()
+            DocFile.verify(path)
+            DocEnvelope.verify(path, key)
+            with self.assertRaises(CorruptFileException):
+                DocEnvelope.verify(path, bytes(32))
+            # 分块表的位置
+            path.write_bytes(encrypted[:10] + bytes([encrypted[10] ^ 1]) + encrypted[11:])
+            with self.assertRaises(CorruptFileException):
+                DocFile.verify(path)
+            # 分块数量
+            envelope, tableOffset, mac, headMac = DocEnvelope.readTable(BytesIO(encrypted))
+            path.write_bytes(encrypted[:tableOffset] + b'\xff' * DocEnvelope.ChunkCountBytesLen +
+                             encrypted[tableOffset + DocEnvelope.ChunkCountBytesLen:])
+            with self.assertRaises(CorruptFileException):
+                DocFile.verify(path)
+            # 分块超出密文区域
+            entry = tableOffset + DocEnvelope.ChunkCountBytesLen
+            path.write_bytes(encrypted[:entry] + tableOffset.to_bytes(DocEnvelope.OffsetBytesLen, byteorder='big') +
+                             encrypted[entry + DocEnvelope.OffsetBytesLen:])
+            with self.assertRaises(CorruptFileException):
+                DocFile.verify(path)
+
+    def test_docenvelope(self):
+        df = self.createDocFile()
+        df.docBody.chunkSize = 256
+        image = bytes(range(256)) * 10
+        df.docAssets[hashlib.sha256(image).hexdigest()] = image
+        key = bytes(range(32))
+        data = b''.join(df.toBuffers())
+        oldChunkSize, DocEnvelope.chunkSize = DocEnvelope.chunkSize, 1000
+        try:
+            encrypted = b''.join(DocEnvelope.encrypt(key, df.toBuffers(), threads=2))
+        finally:
+            DocEnvelope.chunkSize = oldChunkSize
+        self.assertTrue(DocEnvelope.isEnvelope(encrypted))
+        self.assertFalse(DocEnvelope.isEnvelope(data))
+        self.assertEqual(DocEnvelope.decrypt(key, encrypted), data)
+        self.assertDocFile(df, DocFile.fromBuffer(DocEnvelope.decrypt(key, memoryview(encrypted), threads=3)))
+
+        with self.assertRaises(CorruptFileException):
+            DocEnvelope.decrypt(bytes(32), encrypted)
+        # 修改密文、分块表以及截断文件
+        for corrupt in (encrypted[:20] + bytes([encrypted[20] ^ 1]) + encrypted[21:],
+                        encrypted[:-40] + bytes([encrypted[-40] ^ 1]) + encrypted[-39:],
+                        encrypted[:-1]):
+            with self.assertRaises(CorruptFileException):
+                DocEnvelope.decrypt(key, corrupt)
+
+    def test_docenvelope_file(self):
+        df = self.createDocFile()
+        df.docBody.chunkSize = 256
+        key = bytes(range(32))
+        data = b''.join(df.toBuffers())
+        positions = list()
+        with tempfile.TemporaryDirectory() as folder:
+            path = Path(folder) / 'test.writer'
+            oldChunkSize, DocEnvelope.chunkSize = DocEnvelope.chunkSize, 1000
+            try:
+                DocEnvelope.encryptToFile(key, path, df.toBuffers(), threads=2,
+                                          progress=lambda position, total: positions.append((position, total)))
+            finally:
+                DocEnvelope.chunkSize = oldChunkSize
+            self.assertEqual(positions[-1], (len(data), len(data)))
+            encrypted = path.read_bytes()
+            self.assertEqual(DocEnvelope.decrypt(key, encrypted), data)
+            positions.clear()
+            content, envelope = DocEnvelope.decryptFile(key, path, threads=3,
+                                                        progress=lambda position, total: positions.append(position))
+            self.assertEqual(content, data)
+            self.assertEqual(positions[-1], len(data))
+            self.assertEqual(envelope.fileLen, len(encrypted))
+            self.assertEqual(len(envelope.chunkIndex), len(envelope.chunks))
+
+            with self.assertRaises(CorruptFileException):
+                DocEnvelope.decryptFile(bytes(32), path)
+            path.write_bytes(encrypted[:-5] + bytes([encrypted[-5] ^ 1]) + encrypted[-4:])
+            with self.assertRaises(CorruptFileException):
+                DocEnvelope.decryptFile(key, path)
+            # 分块表的位置
+            path.write_bytes(encrypted[:10] + bytes([encrypted[10] ^ 1]) + encrypted[11:])
+            with self.assertRaises(CorruptFileException):
+                DocEnvelope.decryptFile(key, path)
+
+    def test_docenvelope_update(self):
+        df = self.createDocFile()
+        df.docBody.chunkSize = 256
+        image = bytes(range(256)) * 10
+        df.docAssets[hashlib.sha256(image).hexdigest()] = image
+        key = bytes(range(32))
+        with tempfile.TemporaryDirectory() as folder:
+            path = Path(folder) / 'test.writer'
+            envelope = DocEnvelope.encryptToFile(key, path, df.toBuffers())
+            chunks = list(envelope.chunks)
+            fileLen = path.stat().st_size
+            self.assertTrue(envelope.canUpdate(path, key))
+            self.assertFalse(envelope.canUpdate(path, bytes(32)))
+
+            # 只修改信息块，正文分块和资源保留原来的密文
+            df.docInfoBlock[0].value = b'new'
+            data = b''.join(df.toBuffers())
+            envelope.update(key, path, df.toBuffers())
+            self.assertEqual(envelope.chunks[2:], chunks[2:])
+            self.assertNotEqual(envelope.chunks[:2], chunks[:2])
+            self.assertLess(path.stat().st_size - fileLen, fileLen // 2)
+            content, newEnvelope = DocEnvelope.decryptFile(key, path)
+            self.assertEqual(content, data)
+            self.assertEqual(newEnvelope.chunks, envelope.chunks)
+            self.assertEqual(newEnvelope.fileLen, envelope.fileLen)
+
+            # 追加保存中断时仍然是上次保存的内容
+            with open(path, 'ab') as f:
+                f.write(os.urandom(100))
+            self.assertFalse(envelope.canUpdate(path, key))
+            self.assertEqual(DocEnvelope.decryptFile(key, path)[0], data)
+
+            # 追加的数据过多时重写整个文件
+            envelope = newEnvelope
+            for index in range(5):
+                df.docBody.content = (conent * (index + 2)).encode('utf-8')
+                if not envelope.canUpdate(path, key):
+                    envelope = DocEnvelope.encryptToFile(key, path, df.toBuffers())
+                else:
+                    envelope.update(key, path, df.toBuffers())
+                self.assertEqual(DocEnvelope.decryptFile(key, path)[0], b''.join(df.toBuffers()))
+            self.assertLess(path.stat().st_size, len(b''.join(df.toBuffers())) * 3)
+
+    def test_docenvelope_rollback(self):
+        df = self.createDocFile()
+        key = bytes(range(32))
+        with tempfile.TemporaryDirectory() as folder:
+            path = Path(folder) / 'test.writer'
+            envelope = DocEnvelope.encryptToFile(key, path, df.toBuffers())
+            oldTableOffset = DocEnvelope.readTable(BytesIO(path.read_bytes()))[1]
+            df.docInfoBlock[0].value = b'new'
+            envelope.update(key, path, df.toBuffers())
+            self.assertEqual(DocEnvelope.decryptFile(key, path)[0], b''.join(df.toBuffers()))
+
+            # 旧的分块表仍然在文件中，修改分块表的位置不能回到上次保存的内容
+            updated = path.read_bytes()
+            start = len(DocEnvelope.Magic) + DocEnvelope.VersionBytesLen
+            path.write_bytes(updated[:start] + oldTableOffset.to_bytes(DocEnvelope.TableOffsetBytesLen, byteorder='big') +
+                             updated[start + DocEnvelope.TableOffsetBytesLen:])
+            DocEnvelope.verify(path)
+            with self.assertRaises(CorruptFileException):
+                DocEnvelope.verify(path, key)
+            with self.assertRaises(CorruptFileException):
+                DocEnvelope.decryptFile(key, path)
+
+    def test_docenvelope_update_failed(self):
+        df = self.createDocFile()
+        df.docBody.chunkSize = 256
+        key = bytes(range(32))
+        with tempfile.TemporaryDirectory() as folder:
+            path = Path(folder) / 'test.writer'
+            envelope = DocEnvelope.encryptToFile(key, path, df.toBuffers())
+            saved = path.read_bytes()
+
+            # 磁盘空间不足，密文没有写入文件
+            class FullFile:
+                def __init__(self, f):
+                    self.f = f
+
+                def __getattr__(self, name):
+                    return getattr(self.f, name)
+
+                def __enter__(self):
+                    return self
+
+                def __exit__(self, *args):
+                    self.f.close()
+
+                def write(self, data):
+                    raise OSError(errno.ENOSPC, os.strerror(errno.ENOSPC))
+
+            df.docInfoBlock[0].value = b'new'
+            data = b''.join(df.toBuffers())
+            with mock.patch('builtins.open', lambda *args, **kwargs: FullFile(io.open(*args, **kwargs))):
+                self.assertRaises(OSError, envelope.update, key, path, df.toBuffers())
+            self.assertEqual(path.read_bytes(), saved)
+
+            # 再次保存相同的内容时重新写入没有写入的密文
+            self.assertTrue(envelope.canUpdate(path, key))
+            envelope.update(key, path, df.toBuffers())
+            self.assertEqual(DocEnvelope.decryptFile(key, path)[0], data)
+
+    def test_docenvelope_v1(self):
+        df = self.createDocFile()
+        key = bytes(range(32))
+        data = b''.join(df.toBuffers())
+        keyContext = KeyContext.of(key)
+        encryptKey = keyContext.encryptKey
+        envelope = DocEnvelope()
+        envelope.version = DocEnvelope.Version.V1
+        ciphertexts = list()
+        for piece in DocEnvelope.splitBuffers(df.toBuffers()):
+            nonce, tag, ciphertext = DocEnvelope.encryptChunk(encryptKey, piece)
+            envelope.chunks.append((0, len(ciphertext), nonce, tag))
+            ciphertexts.append(ciphertext)
+        fields = envelope.tableFieldsToBytes()
+        encrypted = fields + hmac.new(keyContext.macKey, fields, 'sha256').digest() + b''.join(ciphertexts)
+        self.assertEqual(DocEnvelope.decrypt(key, encrypted), data)
+        with tempfile.TemporaryDirectory() as folder:
+            path = Path(folder) / 'test.writer'
+            path.write_bytes(encrypted)
+            content, envelope = DocEnvelope.decryptFile(key, path)
+            self.assertEqual(content, data)
+            self.assertFalse(envelope.canUpdate(path, key))
+            path.write_bytes(encrypted + b'x')
+            with self.assertRaises(CorruptFileException):
+                DocEnvelope.decryptFile(key, path)
+
+    def test_keycontext(self):
+        key = bytes(range(32))
+        context = KeyContext.of(key)
+        self.assertIs(KeyContext.of(bytearray(key)), context)
+        self.assertTrue(context.isSameKey(KeyContext.fingerprintOf(key)))
+        self.assertFalse(context.isSameKey(KeyContext.fingerprintOf(bytes(32))))
+        self.assertEqual(context.mac(b'data'), hmac.new(context.macKey, b'data', 'sha256').digest())
+        self.assertEqual(context.mac(b'data'), context.mac(b'data'))
+        for index in range(KeyContext.cacheSize):
+            KeyContext.of(bytes([index + 1]) * 32)
+        self.assertIsNot(KeyContext.of(key), context)
+        self.assertEqual(KeyContext.of(key).fingerprint, context.fingerprint)
+        context = KeyContext.of(key)
+        KeyContext.evict(key)
+        self.assertNotIn(key, KeyContext.cache)
+        self.assertIsNot(KeyContext.of(key), context)
+        KeyContext.clear()
+        self.assertEqual(len(KeyContext.cache), 0)
+
+    def test_docinfotable(self):
+        df = self.createDocFile()
+        for i in range(100):
+            block = DocInfoBlock()
+            block.name = ('tag%d' % i).encode('utf-8')
+            block.value = bytes(1000)
+            df.docInfoBlock.append(block)
+        data = df.toByteIO().getvalue()
+        newDf = DocFile.fromBuffer(data)
+        table = newDf.docInfoBlock
+        self.assertIsInstance(table, DocInfoTable)
+        self.assertEqual(table.get(b'title'), '标题'.encode('utf-8'))
+        self.assertIsNone(table.get(b'none'))
+        self.assertEqual(table.properties()['测试'], 'aaaa')
+        # 读取属性不会解码信息块
+        self.assertEqual(table.blocks, [None] * len(table))
+        # 没有修改的信息块引用原数据
+        self.assertIs(table.raw[50].obj, data)
+
+        table.set(b'title', b'new')
+        table.set(b'added', b'value')
+        self.assertEqual(len(table), 104)
+        self.assertEqual(sum(block is not None for block in table.blocks), 2)
+        newDf.docBody.content = bytes(newDf.docBody.content)
+        newData = newDf.toByteIO().getvalue()
+        metadata = DocFile.fromBytes(newData).docInfoBlock.properties()
+        self.assertEqual(metadata['title'], 'new')
+        self.assertEqual(metadata['added'], 'value')
+        self.assertEqual(metadata['author'], '名字')
+        self.assertEqual(len(metadata), 104)
+
+        # 复制后不再引用原数据
+        copied = DocFile.fromBuffer(data).docInfoBlock.copy()
+        for raw in copied.raw:
+            self.assertIsNot(raw.obj, data)
+        self.assertEqual(copied.get(b'tag99'), bytes(1000))
+
+        # 直接修改解码后的信息块
+        table[0].value = b'changed'
+        newDf.docInfoBlock = table
+        self.assertEqual(DocFile.fromBytes(newDf.toByteIO().getvalue()).docInfoBlock.get(b'author'), b'changed')
+
+    def test_docinfotable_v1(self):
+        df = self.createDocFile()
+        df.docHead.version = DocHead.Version.V1
+        newDf = DocFile.fromBytes(df.toByteIO().getvalue())
+        self.assertEqual(newDf.docInfoBlock.get(b'author'), '名字'.encode('utf-8'))
+        newDf.docHead.version = DocHead.Version.Latest
+        newDf.docInfoBlock.set(b'author', b'a')
+        table = DocFile.fromBytes(newDf.toByteIO().getvalue()).docInfoBlock
+        self.assertEqual(dict(table.properties()), {'author': 'a', 'title': '标题', '测试': 'aaaa'})
+
+    def test_docfile_truncated(self):
+        data = self.createDocFile().toByteIO().getvalue()
+        for loader in (DocFile.fromBytes, DocFile.fromBuffer):
+            with self.assertRaises(CorruptFileException):
+                loader(data[:-1])
 
     def test_docfile_emptyinfolists(self):
         df = DocFile()
@@ -129,6 +933,135 @@ class MyTestCase(unittest.TestCase):
             self.assertDocInfoBlock(a, b)
         self.assertDocBody(newDf.docBody, df.docBody)
 
+@unittest.skipIf(QImage is None, '需要PySide6')
+class ImageScalePolicyTestCase(unittest.TestCase):
+
+    @staticmethod
+    def createImage(width: int, height: int, imageFormat=None) -> QImage:
+        imageFormat = QImage.Format.Format_RGB32 if imageFormat is None else imageFormat
+        pixels = os.urandom(width * height * 4)
+        return QImage(pixels, width, height, width * 4, imageFormat).copy()
+
+    def test_apply_small(self):
+        image = self.createImage(100, 50)
+        data = imageToBytes(image, 'PNG')
+        result, scaled, original = ImageScalePolicy(2560).apply(image, data)
+        self.assertIs(result, data)
+        self.assertIs(scaled, image)
+        self.assertIsNone(original)
+
+    def test_apply_oversized(self):
+        image = self.createImage(400, 100)
+        data = imageToBytes(image, 'PNG')
+        result, scaled, original = ImageScalePolicy(200).apply(image, data)
+        self.assertEqual((scaled.width(), scaled.height()), (200, 50))
+        # 没有透明通道时用JPEG编码，默认保留原图
+        self.assertEqual(result[:2], b'\xff\xd8')
+        self.assertEqual(original, data)
+
+        result, scaled, original = ImageScalePolicy(200, keepOriginal=False).apply(image, data)
+        self.assertEqual(scaled.width(), 200)
+        self.assertIsNone(original)
+
+        # 没有原始数据时按imageFormat编码原图
+        result, scaled, original = ImageScalePolicy(200).apply(image)
+        self.assertTrue(QImage.fromData(original).size() == image.size())
+
+    def test_apply_alpha(self):
+        image = self.createImage(400, 100, QImage.Format.Format_ARGB32)
+        result, scaled, original = ImageScalePolicy(200).apply(image, imageToBytes(image, 'PNG'))
+        self.assertEqual(scaled.width(), 200)
+        self.assertEqual(result[:8], b'\x89PNG\r\n\x1a\n')
+
+    def test_apply_maxbytes(self):
+        image = self.createImage(256, 256)
+        data = imageToBytes(image, 'PNG')
+        policy = ImageScalePolicy(maxBytes=len(data) // 10)
+        result, scaled, original = policy.apply(image, data)
+        self.assertTrue(len(result) <= policy.maxBytes or max(scaled.width(), scaled.height()) <= policy.minSize)
+        self.assertLess(scaled.width(), image.width())
+        self.assertEqual(original, data)
+
+    def test_prepareimage(self):
+        image = self.createImage(100, 50)
+        data = imageToBytes(image, 'PNG')
+        result, decoded, original = prepareImage(data, ImageScalePolicy(2560))
+        self.assertIs(result, data)
+        self.assertEqual((decoded.width(), decoded.height()), (100, 50))
+        self.assertIsNone(original)
+
+        result, decoded, original = prepareImage(data, ImageScalePolicy(50))
+        self.assertEqual(decoded.width(), 50)
+        self.assertEqual(original, data)
+
+        self.assertIsNone(prepareImage(b'not an image', ImageScalePolicy(2560)))
+
+
+class DocInfoBlockBenchmark(unittest.TestCase):
+
+    def createDocFile(self, version):
+        df = DocFile()
+        df.docBody = DocBody()
+        df.docBody.content = b''
+        df.docInfoBlock = list()
+        for name in ('author', 'createDatetime', 'editDatetime', 'title', 'remarks'):
+            block = DocInfoBlock()
+            block.name = name.encode('utf-8')
+            block.value = '2022-10-01 12:00:00.000000 +0000 UTC'.encode('utf-8')
+            df.docInfoBlock.append(block)
+        df.docHead = DocHead()
+        df.docHead.version = version
+        df.docHead.docType = DocHead.DocType.Writer
+        df.docHead.docInfoBlockLen = [i.getByteLen(version) for i in df.docInfoBlock]
+        return df
+
+    def test_benchmark_infoblock(self):
+        number = 2000
+        result = dict()
+        for version in (DocHead.Version.V1, DocHead.Version.V2):
+            data = self.createDocFile(version).toByteIO().getvalue()
+            parseTime = timeit.timeit(lambda: DocFile.fromBytes(data), number=number) / number
+            saveTime = timeit.timeit(lambda: self.createDocFile(version).toByteIO(), number=number) / number
+            result[version] = len(data)
+            print('V%d: %d字节, 解析%.2fus, 保存%.2fus' % (version, len(data), parseTime * 1e6, saveTime * 1e6))
+        self.assertLess(result[DocHead.Version.V2], result[DocHead.Version.V1])
+
+
+class DocBodyCodecBenchmark(unittest.TestCase):
+
+    def createHtml(self, size):
+        lines = list()
+        length = 0
+        while length < size:
+            for line in conent.splitlines():
+                line = '<p style=" margin-top:0px; margin-bottom:0px; margin-left:0px; margin-right:0px; ' \
+                       '-qt-block-indent:0; text-indent:0px;"><span style=" font-family:\'Microsoft YaHei UI\'; ' \
+                       'font-size:14pt;">%s</span></p>' % line
+                lines.append(line)
+                length += len(line.encode('utf-8'))
+        return '\n'.join(lines).encode('utf-8')
+
+    def test_benchmark_codec(self):
+        content = self.createHtml(8 << 20)
+        for name, codec in DocHead.Codec.Names.items():
+            df = DocFile()
+            df.docInfoBlock = list()
+            df.docBody = DocBody()
+            df.docBody.content = content
+            df.docHead = DocHead()
+            df.docHead.docType = DocHead.DocType.Writer
+            df.docHead.codec = codec
+            start = time.perf_counter()
+            data = df.toByteIO().getvalue()
+            saveTime = time.perf_counter() - start
+            start = time.perf_counter()
+            newDf = DocFile.fromBytes(data)
+            loadTime = time.perf_counter() - start
+            self.assertEqual(newDf.docBody.content, content)
+            mb = len(content) / (1 << 20)
+            print('%s: 压缩率%.2f, 保存%.1fMB/s, 读取%.1fMB/s' % (name, len(content) / len(data), mb / saveTime, mb / loadTime))
+
+
 conent = '''
 近日，历史老师将“羊了个羊”游戏创新改编成“历了个史”的消息引发广泛关注。🅿️🆑🆓🀄🃏🏺🐎
 
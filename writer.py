@@ -2,15 +2,19 @@
 import os
 import time
 from functools import partial, lru_cache
+from typing import Dict
 
 import qtawesome as qta
 
-import keymanager.encryptor
-from keymanager.key import decrypt_data, encrypt_data, Key, add_key_invalidate_callback, set_key_timeout, \
+from keymanager.key import Key, add_key_invalidate_callback, set_key_timeout, \
     add_current_keystatus_callback, KEY_CACHE as key_cache, start_check_key_thread, KEY_CHECKER as key_checker
 from keymanager.menus import add_key, add_keymanager_menu, reload_key
 
 from writerlib import textedit
+from writerlib.assets import ImageInfo, ImageScalePolicy, ImageExtensions
+from writerlib.cipher import DocEnvelope, KeyContext
+from writerlib.doc import DocHead, DocJournal, DocInfoTable
+from writerlib.docio import DocLoader, LoadResult, DocSaver, SaveSnapshot, SaveResult, DocLocker
 from writerlib.settings import Settings, getIcon, getSymbolEmojiType, SymbolEmojis, getIconOpt, getIconName, \
     addDefaultColorToFontOptions
 from writerlib.textedit import Selection
@@ -21,12 +25,12 @@ import sys
 from pathlib import Path
 
 from PySide6 import QtPrintSupport, QtGui
-from PySide6.QtCore import QPoint, Signal
+from PySide6.QtCore import QPoint, Signal, QTimer
 from PySide6.QtGui import QAction, QIcon, QContextMenuEvent, Qt, QImage, QTextCharFormat, QFont, QTextCursor, \
-    QTextListFormat, QColor, QTextFragment
+    QTextListFormat, QColor, QTextFragment, QTextDocument
 from PySide6.QtWidgets import QMainWindow, QFontComboBox, QSpinBox, QMessageBox, QMenu, QFileDialog, QDialog, \
     QColorDialog, QApplication, QPushButton, QToolButton, QStackedLayout, QWidget, \
-    QLabel, QSizePolicy, QLCDNumber
+    QLabel, QSizePolicy, QLCDNumber, QProgressBar
 
 
 def checkLock(callback):
@@ -47,6 +51,17 @@ class LockData:
 
     def unlock(self):
         self.encrypt_text = ''
+        # 从编辑器中移除的文档，加密锁定完成后为None
+        self.document: QTextDocument = None
+        # 加密锁定时原文档的默认字体、页边距和文本选项，解锁时用于新文档
+        self.documentFormat = None
+        # 从编辑器中移除的资源和图片信息，加密锁定完成后为空，资源已经加密到encrypt_text中
+        self.assets: Dict[str, bytes] = dict()
+        self.imageInfos: Dict[str, ImageInfo] = dict()
+        # 正在后台解密
+        self.unlocking = False
+        # 锁定时使用的密钥的指纹，只有同一个密钥可以解锁
+        self.keyFingerprint = bytes()
         self.selection = Selection()
         self.cursorPosition = -1
         self.scrollBarPos = -1
@@ -68,12 +83,29 @@ class Main(QMainWindow):
 
         self.filename = ""
         self.changesSaved = True
-        self.defaultKeyMark = bytes()
-        self.encryptedMark = bytes()
+        # 未加密文档追加保存时使用的日志
+        self.docJournal: DocJournal = None
+        # 加密文档只加密变化的分块时使用
+        self.docEnvelope: DocEnvelope = None
+        # 正在打开的文档和使用的密钥
+        self.docLoader: DocLoader = None
+        # 只保存密钥的指纹，不持有密钥对象
+        self.loadKeyFingerprint = bytes()
+        # 每次打开和取消打开时增加，用来忽略已经取消的打开
+        self.loadId = 0
+        # 打开或者关闭文档时改变，文档修改时增加，用来判断后台保存完成时文档是否发生了变化
+        self.documentId = 0
+        self.editRevision = 0
+        # 打开或保存文档时使用的密钥的指纹，保存时用来判断密钥是否改变
+        self.keyFingerprint = bytes()
 
         self.encrypt_text = ""  # 锁定时记录的加密文件内容
 
         self.lockData = LockData()
+        # 锁定时替换编辑器中的文档
+        self.lockDocument: QTextDocument = None
+        # 每次锁定和解锁时增加，用来忽略已经取消的后台加密和解密
+        self.lockId = 0
 
         self.emoji_browser = None
         self.find = None
@@ -81,6 +113,14 @@ class Main(QMainWindow):
 
         self.systemSetting = Settings()
         self.initUI()
+        self.docSaver = DocSaver(self.text, self)
+        self.docSaver.progress.connect(self.showProgress)
+        self.docSaver.saved.connect(self.docsSaved)
+        self.docLocker = DocLocker(self.text, self)
+        self.docLocker.progress.connect(self.showProgress)
+        self.docLocker.locked.connect(self.docLocked)
+        self.docLocker.unlocked.connect(self.docUnlocked)
+        self.docLocker.failed.connect(self.docLockFailed)
         self.autoLockEditor.connect(self.lock)
         self.updateStatusbarIcon.connect(self.updateStatusbarKeyIndicator)
         add_key_invalidate_callback(self.currentKeyAboutToTimeout)
@@ -468,6 +508,7 @@ class Main(QMainWindow):
 
         self.text = textedit.TextEdit(self)
         self.text.document().setDocumentMargin(20)
+        self.text.imageScalePolicy = ImageScalePolicy.fromSettings(self.systemSetting)
 
         self.text.document().contentsChanged.connect(self.resetTimeout)
         self.text.verticalScrollBar().valueChanged.connect(
@@ -530,6 +571,11 @@ class Main(QMainWindow):
         unlock = getIcon('unlock')
         lock = getIcon('lock')
         add_current_keystatus_callback(lambda key: self.updateStatusbarIcon.emit(key))
+        self.statusbarProgress = QProgressBar()
+        self.statusbarProgress.setRange(0, 100)
+        self.statusbarProgress.setMaximumSize(160, 16)
+        self.statusbarProgress.setVisible(False)
+        self.statusbar.addPermanentWidget(self.statusbarProgress)
         self.statusbar.addPermanentWidget(self.statusbarKeyIndicator)
         self.statusbar.addPermanentWidget(self.statusbarTimtoutProgressbarIndicator)
 
@@ -552,6 +598,8 @@ class Main(QMainWindow):
             self.statusbarTimtoutProgressbarIndicator.display(9999)
 
     def currentKeyAboutToTimeout(self, key:Key):
+        # 超时的密钥不能再从缓存的派生密钥中恢复
+        KeyContext.evict(key)
         current_key = key_cache.get_cur_key()
         if current_key.id != key.id:
             return
@@ -562,6 +610,8 @@ class Main(QMainWindow):
 
     def changed(self, changesSaved=False):
         self.changesSaved = changesSaved
+        if not changesSaved:
+            self.editRevision += 1
         self.updateWindowsTitle()
 
     def updateWindowsTitle(self):
@@ -584,6 +634,8 @@ class Main(QMainWindow):
             event.ignore()
             return
 
+        self.waitForSave()
+
         if self.changesSaved:
 
             event.accept()
@@ -607,7 +659,7 @@ class Main(QMainWindow):
             answer = popup.exec()
 
             if answer == QMessageBox.Save:
-                if not self.save():
+                if not self.save(wait=True):
                     event.ignore()
 
             elif answer == QMessageBox.Discard:
@@ -701,12 +753,20 @@ class Main(QMainWindow):
                 imageSetting.destroy()
 
             def imageSaveAs():
-                selectedImage = image.Image.retriveRawImage(image_format)
-                filename:str = QFileDialog.getSaveFileName(self, '图片另存为', './', '图像(*.png)')[0]
+                # 图片缩小时保存原图，常见格式直接保存原始数据，不解码图片
+                name = self.text.getOriginalImageName(image_format)
+                info = self.text.getImageInfo(name)
+                extension = ImageExtensions.get(info.format, 'png') if info is not None else 'png'
+                filename:str = QFileDialog.getSaveFileName(self, '图片另存为', './', '图像(*.%s)' % extension)[0]
                 if filename:
-                    if not filename.lower().endswith('.png'):
-                        filename += '.png'
-                    if not selectedImage.save(filename, 'png'):
+                    if not filename.lower().endswith('.' + extension):
+                        filename += '.' + extension
+                    if info is not None and info.format in ImageExtensions:
+                        try:
+                            Path(filename).write_bytes(self.text.getImageBytes(name))
+                        except OSError:
+                            QMessageBox.warning(self, '保存图片失败', '保存图片失败')
+                    elif not self.text.getImage(name).save(filename, 'png'):
                         QMessageBox.warning(self, '保存图片失败', '保存图片失败')
 
             imageSettingAction = QAction(getIcon('imageSetting'), "调整图片大小", self)
@@ -942,77 +1002,128 @@ class Main(QMainWindow):
     @checkLock
     def open(self):
 
-        oldFileName = self.filename
-        isEncryptDocument = self.text.isEncryptDocument
-        changSaved = self.changesSaved
+        if self.docLoader is not None:
+            return
 
-        opened = False
+        if not self.changesSaved:
+            result = QMessageBox.question(self, '文件未保存', '文件未保存，是否继续打开文件？', QMessageBox.StandardButton.Yes | QMessageBox.StandardButton.No)
+            if result == QMessageBox.StandardButton.No:
+                return
 
-        def restore():
-            self.filename = oldFileName
-            self.text.isEncryptDocument = isEncryptDocument
-            self.changesSaved = changSaved
-            self.updateWindowsTitle()
+        filename = QFileDialog.getOpenFileName(self, 'Open File', ".", "(*.writer)")[0]
+        if not filename or not Path(filename).exists() or not Path(filename).is_file():
+            return
 
-        try:
-            if not self.changesSaved:
-                result = QMessageBox.question(self, '文件未保存', '文件未保存，是否继续打开文件？', QMessageBox.StandardButton.Yes | QMessageBox.StandardButton.No)
-                if result == QMessageBox.StandardButton.No:
-                    return restore()
+        # 在线程池中读取和解析文档，界面不会卡住
+        mmapOpenSize = self.systemSetting.mmapOpenSize
+        self.loadId += 1
+        loadId = self.loadId
+        self.docLoader = DocLoader(filename, self.text, mmapOpenSize << 20 if mmapOpenSize > 0 else -1, self)
+        self.docLoader.progress.connect(
+            lambda value, message: self.showProgress(value, message) if loadId == self.loadId else None)
+        self.docLoader.detected.connect(lambda isEncryptDocument: self.docDetected(loadId, isEncryptDocument))
+        self.docLoader.loaded.connect(lambda result: self.docLoaded(loadId, result))
+        self.docLoader.failed.connect(lambda title, message: self.docLoadFailed(loadId, title, message))
+        self.text.setReadOnly(True)
+        self.showProgress(0, '正在读取文件')
+        self.docLoader.start()
 
-            self.filename = QFileDialog.getOpenFileName(self, 'Open File', ".", "(*.writer)")[0]
-            if self.filename is None or not Path(self.filename).exists() or not Path(self.filename).is_file():
-                return restore()
+    def docDetected(self, loadId: int, isEncryptDocument: bool):
+        if loadId != self.loadId:
+            return
+        current_key = key_cache.get_cur_key()
 
-            content = Path(self.filename).read_bytes()
-            self.text.isEncryptDocument = keymanager.encryptor.is_encrypt_data(content)
+        if isEncryptDocument:
 
-            current_key = key_cache.get_cur_key()
+            if current_key is None:
+                loaded = self.showLoadKeyDialog()
+                current_key = key_cache.get_cur_key()
+                if not loaded or current_key is None:
+                    return self.finishLoad()
 
-            if self.text.isEncryptDocument:
+            if current_key.timeout:
+                activated = self.showActivateKeyDialog()
+                if not activated:
+                    return self.finishLoad()
+                current_key = key_cache.get_cur_key()
 
-                if current_key is None:
-                    loaded = self.showLoadKeyDialog()
-                    current_key = key_cache.get_cur_key()
-                    if not loaded:
-                        return restore()
-
-                if current_key.timeout:
-                    activated = self.showActivateKeyDialog()
-                    if not activated:
-                        return restore()
-                    current_key = key_cache.get_cur_key()
-
-            if self.filename:
-                if self.text.isEncryptDocument:
-                    encrypt_content = Path(self.filename).read_bytes()
-                    content = decrypt_data(current_key.key, encrypt_content)
-                else:
-                    content = Path(self.filename).read_bytes()
-                try:
-                    html, prop = self.text.docfromBytes(content)
-                except Exception as e:
-                    QMessageBox.critical(self, '错误', '文件损坏或密钥不匹配\n' + str(e))
-                    return restore()
-
-                if self.text.isEncryptDocument:
-                    self.defaultKeyMark = os.urandom(1024)
-                    self.encryptedMark = encrypt_data(current_key.key, self.defaultKeyMark)
-
-                self.text.documentProperty = self.text.dictToDocumentProperty(prop, self.text.documentProperty)
-                self.changed(changesSaved=True)
-                opened = True
-        except Exception as e:
-            QMessageBox.critical(self,'未知错误', str(e))
-            return restore()
-
-        if opened:
-            self.text.textChanged.disconnect(self.changed)
-            self.text.setText(html)
-            self.text.textChanged.connect(self.changed)
+            # 输入密钥时可能已经锁定或关闭文档
+            if loadId != self.loadId:
+                return
+
+            self.loadKeyFingerprint = KeyContext.fingerprintOf(current_key)
+
+        self.docLoader.decode(current_key.key if isEncryptDocument else None)
+
+    def docLoaded(self, loadId: int, result: LoadResult):
+        # 打开的过程中锁定、新建或关闭了文档
+        if loadId != self.loadId:
+            return
+        self.finishLoad()
+
+        self.waitForSave()
+        self.documentId += 1
+        self.filename = result.filename
+        self.text.isEncryptDocument = result.isEncryptDocument
+        self.docJournal = result.docJournal
+        self.docEnvelope = result.docEnvelope
+
+        self.keyFingerprint = self.loadKeyFingerprint if self.text.isEncryptDocument else bytes()
+        self.loadKeyFingerprint = bytes()
+
+        self.text.documentProperty = self.text.dictToDocumentProperty(result.properties, self.text.documentProperty)
+
+        # 只有设置文档内容在GUI线程中进行
+        self.text.textChanged.disconnect(self.changed)
+        self.text.setAssets(result.assets, result.imageInfos)
+        self.text.setDocInfoTable(result.properties.infoTable)
+        self.text.setText(result.html)
+        self.text.textChanged.connect(self.changed)
+        self.changed(changesSaved=True)
+
+    def docLoadFailed(self, loadId: int, title: str, message: str):
+        if loadId != self.loadId:
+            return
+        self.finishLoad()
+        self.loadKeyFingerprint = bytes()
+        QMessageBox.critical(self, title, message)
+
+    def finishLoad(self):
+        if self.docLoader is not None:
+            self.docLoader.cancel()
+            self.docLoader.deleteLater()
+            self.docLoader = None
+        self.text.setReadOnly(False)
+        self.hideProgress()
+
+    def cancelLoad(self):
+        '''
+        锁定、新建或关闭文档时取消正在进行的打开，之后到达的结果被忽略，后台任务结束后删除DocLoader
+        '''
+        if self.docLoader is None:
+            return
+        self.loadId += 1
+        loader = self.docLoader
+        loader.detected.connect(loader.deleteLater)
+        loader.loaded.connect(loader.deleteLater)
+        loader.failed.connect(loader.deleteLater)
+        loader.cancel()
+        self.docLoader = None
+        self.loadKeyFingerprint = bytes()
+        self.text.setReadOnly(False)
+        self.hideProgress()
+
+    def showProgress(self, value: int, message: str):
+        self.statusbarProgress.setValue(value)
+        self.statusbarProgress.setVisible(True)
+        self.statusbar.showMessage(message)
+
+    def hideProgress(self):
+        self.statusbarProgress.setVisible(False)
+        self.statusbar.clearMessage()
 
     @checkLock
-    def save(self, saveas=False):
+    def save(self, saveas=False, wait=False):
 
         current_key = key_cache.get_cur_key()
         oldfilename = self.filename
@@ -1031,9 +1142,7 @@ class Main(QMainWindow):
                     return False
                 current_key = key_cache.get_cur_key()
 
-            decryptedMark = decrypt_data(current_key.key, self.encryptedMark)
-
-            if decryptedMark != self.defaultKeyMark:
+            if self.keyFingerprint and not KeyContext.of(current_key).isSameKey(self.keyFingerprint):
                 result = QMessageBox.question(self, '警告', '检测到打开文档使用的密钥与保存文档使用的密钥不同\n是否继续保存？',
                                               QMessageBox.StandardButton.Yes | QMessageBox.StandardButton.No)
                 if result == QMessageBox.StandardButton.No:
@@ -1049,18 +1158,37 @@ class Main(QMainWindow):
               self.filename += ".writer"
 
             self.text.updateEditTime()
-            prop = self.text.documentPropertyToDict(self.text.documentProperty)
-            content = self.text.docToBytes(self.text.toHtml(), prop)
+            # 正在插入的图片完成后再保存，文档中不留下占位图片
+            self.text.waitForImages()
+            snapshot = SaveSnapshot()
+            snapshot.filename = self.filename
+            snapshot.html = self.text.toHtml()
+            snapshot.properties = self.text.documentPropertyToDict(self.text.documentProperty)
+            snapshot.codec = DocHead.Codec.Names.get(self.systemSetting.bodyCodec, DocHead.Codec.Raw)
+            snapshot.assets = dict(self.text.assets)
+            snapshot.docInfoTable = self.text.docInfoTable
+            snapshot.isEncryptDocument = self.text.isEncryptDocument
             if self.text.isEncryptDocument:
-                encrypt_content = encrypt_data(current_key.key, content)
-                Path(self.filename).write_bytes(encrypt_content)
-                # 重新加密，避免更换key之后每次保存都提示
-                self.encryptedMark = encrypt_data(current_key.key, self.defaultKeyMark)
+                snapshot.key = current_key.key
+                snapshot.keyFingerprint = KeyContext.fingerprintOf(current_key)
+                if self.filename == oldfilename and not self.docSaver.isSaving():
+                    snapshot.docEnvelope = self.docEnvelope
             else:
-                Path(self.filename).write_bytes(content)
-
-            self.changesSaved = True
-            self.updateWindowsTitle()
+                snapshot.journalSave = self.systemSetting.journalSave
+                # 还有没有完成的保存时日志可能已经过期，重写整个文件
+                if self.filename == oldfilename and not self.docSaver.isSaving():
+                    snapshot.docJournal = self.docJournal
+            snapshot.documentId = self.documentId
+            snapshot.revision = self.editRevision
+
+            if wait or not self.systemSetting.backgroundSave:
+                self.waitForSave()
+                result = self.docSaver.write(snapshot)
+                self.docSaved(result)
+                return result.error is None
+
+            # 在后台生成和写入文件，写入完成之前可以继续编辑
+            self.docSaver.save(snapshot)
             return True
 
         if saveas:
@@ -1068,6 +1196,39 @@ class Main(QMainWindow):
 
         return False
 
+    def docsSaved(self):
+        # 排在之前的保存进度之后，结果可能已经被waitForSave处理
+        self.hideProgress()
+        for result in self.docSaver.takeResults():
+            self.docSaved(result)
+
+    def docSaved(self, result: SaveResult):
+        self.hideProgress()
+        snapshot = result.snapshot
+        if result.error is not None:
+            QMessageBox.critical(self, '错误', '保存失败\n' + result.error)
+            return
+        # 保存期间打开了其他文档
+        if snapshot.documentId != self.documentId:
+            return
+        if snapshot.filename == self.filename:
+            self.docJournal = result.docJournal
+            self.docEnvelope = result.docEnvelope
+        if snapshot.isEncryptDocument:
+            # 记录保存使用的密钥，避免更换key之后每次保存都提示
+            self.keyFingerprint = snapshot.keyFingerprint
+        # 保存之后文档没有再修改
+        if snapshot.revision == self.editRevision and snapshot.filename == self.filename:
+            self.changesSaved = True
+            self.updateWindowsTitle()
+
+    def waitForSave(self):
+        '''
+        等待后台保存完成，并直接处理保存的结果，不处理事件队列中的其他事件
+        '''
+        for result in self.docSaver.waitForDone():
+            self.docSaved(result)
+
     @checkLock
     def closeDoc(self):
         if not self.changesSaved:
@@ -1076,11 +1237,19 @@ class Main(QMainWindow):
                                           '文档发生变化，是否需要保存？',
                                           QMessageBox.StandardButton.Yes | QMessageBox.StandardButton.No)
             if result == QMessageBox.StandardButton.Yes:
-                result = self.save()
+                result = self.save(wait=True)
                 if not result:
                     return
+        self.cancelLoad()
+        self.waitForSave()
 
         self.text.clear()
+        self.text.setAssets(dict())
+        self.text.setDocInfoTable(DocInfoTable())
+        self.docJournal = None
+        self.docEnvelope = None
+        self.keyFingerprint = bytes()
+        self.documentId += 1
         self.filename = ''
         self.text.isEncryptDocument = False
         self.changesSaved = True
@@ -1124,13 +1293,14 @@ class Main(QMainWindow):
                     return
 
         if locked and not forceLock:
+            # 解锁完成后取消锁定状态
             self.doUnLock(currentKey)
-            self.setDocumentLock(False)
         elif forceLock and locked:
             pass
         else:
-            self.doLock(currentKey)
+            # 先显示锁定页面
             self.setDocumentLock(True)
+            self.doLock(currentKey)
 
     def isDocumentLocked(self):
         return self.lockAction.property('locked')
@@ -1144,6 +1314,10 @@ class Main(QMainWindow):
 
     def doLock(self, key: Key):
 
+        # 正在打开的文档不会在锁定后显示
+        self.cancelLoad()
+        # 锁定后不再替换移除的文档中的占位图片
+        self.text.cancelImages()
         self.text.setEnabled(False)
         self.text.setReadOnly(True)
 
@@ -1161,24 +1335,103 @@ class Main(QMainWindow):
             if action.property('alwaysEnabled'):
                 continue
             action.setEnabled(False)
-        text = self.text.toHtml()
-        encrypt_text = encrypt_data(key.key, text.encode('utf-8'))
-        self.lockData.lock(encrypt_text, self.text.getSelection(), self.text.textCursor().position(), self.text.verticalScrollBar().value())
-        self.text.document().clearUndoRedoStacks()
-        self.text.textCursor().beginEditBlock()
+
+        self.lockId += 1
+        self.lockData.lock('', self.text.getSelection(), self.text.textCursor().position(), self.text.verticalScrollBar().value())
+        self.lockData.keyFingerprint = KeyContext.fingerprintOf(key)
+        # 锁定后内存中不保留派生的密钥，加密锁定使用的密钥由DocLocker重新派生
+        KeyContext.clear()
+        self.detachDocument()
+        if self.systemSetting.lockMode == 'encrypt':
+            # 先回到事件循环显示锁定页面，再序列化移除的文档
+            QTimer.singleShot(0, partial(self.encryptDetachedDocument, self.lockId, key.key))
+
+    def encryptDetachedDocument(self, lockId: int, key: bytes):
+        '''
+        在GUI线程中序列化移除的文档，在线程池中加密，完成之前解锁时直接放回原文档
+        '''
+        # 显示锁定页面之前已经解锁
+        if lockId != self.lockId or self.lockData.document is None:
+            return
+        self.showProgress(5, '正在锁定文档')
+        html = self.lockData.document.toHtml()
+        self.docLocker.lock(lockId, html, dict(self.lockData.assets), key)
+
+    def docLocked(self, lockId: int, encrypt_text: bytes):
+        self.hideProgress()
+        # 加密完成之前已经解锁
+        if lockId != self.lockId:
+            return
+        document = self.lockData.document
+        self.lockData.encrypt_text = encrypt_text
+        self.lockData.documentFormat = (document.defaultFont(), document.documentMargin(), document.defaultTextOption())
+        self.lockData.document = None
+        self.lockData.assets = dict()
+        self.lockData.imageInfos = dict()
+        document.deleteLater()
+
+    def docLockFailed(self, lockId: int, title: str, message: str):
+        self.hideProgress()
+        if lockId != self.lockId:
+            return
+        # 加密失败时保留移除的文档，解锁时直接放回；解密失败时保持锁定
+        self.lockData.unlocking = False
+        QMessageBox.critical(self, title, message)
+
+    def detachDocument(self):
+        '''
+        用空文档替换编辑器中的文档，原文档的内容、排版和撤销记录都保留，锁定和解锁的时间与文档大小无关。
+        资源也从编辑器中移除，编辑器的图片缓存在锁定期间清空
+        '''
+        document = self.text.document()
+        # 编辑器会删除作为子对象的旧文档，先转移到主窗口
+        document.setParent(self)
+        self.lockData.document = document
+        self.lockData.assets = self.text.assets
+        self.lockData.imageInfos = self.text.imageInfos
+        self.text.setAssets(dict())
+        if self.lockDocument is None:
+            self.lockDocument = QTextDocument(self)
         self.text.textChanged.disconnect(self.changed)
-        self.text.clear()
+        self.text.setDocument(self.lockDocument)
         self.text.textChanged.connect(self.changed)
-        self.text.textCursor().endEditBlock()
 
-    def doUnLock(self, key: Key):
-        text = decrypt_data(key.key, self.lockData.encrypt_text).decode('utf-8')
-        self.text.textCursor().joinPreviousEditBlock()
+    def attachDocument(self, document: QTextDocument):
         self.text.textChanged.disconnect(self.changed)
-        self.text.setHtml(text)
+        self.text.setDocument(document)
         self.text.textChanged.connect(self.changed)
-        self.text.textCursor().endEditBlock()
+        # 文档中的图片资源通过父对象TextEdit的loadResource读取
+        document.setParent(self.text)
 
+    def doUnLock(self, key: Key):
+        if self.lockData.unlocking:
+            return
+        # 放回移除的文档和解密都只能使用锁定时的密钥
+        if not KeyContext.of(key).isSameKey(self.lockData.keyFingerprint):
+            QMessageBox.warning(self, '警告', '当前密钥与锁定文档时使用的密钥不同，无法解锁')
+            return
+        # 正在进行的加密只使用快照，结果会因为lockId改变被忽略
+        self.lockId += 1
+        if self.lockData.document is not None:
+            self.attachDocument(self.lockData.document)
+            self.text.setAssets(self.lockData.assets, self.lockData.imageInfos)
+            self.finishUnlock()
+            return
+        # 在线程池中排在加密之后解密和解析，完成之前保持锁定页面
+        self.lockData.unlocking = True
+        font, margin, option = self.lockData.documentFormat
+        self.docLocker.unlock(self.lockId, self.lockData.encrypt_text, key.key, font, margin, option)
+
+    def docUnlocked(self, lockId: int, document: QTextDocument, assets: Dict[str, bytes]):
+        self.hideProgress()
+        if lockId != self.lockId:
+            return
+        self.attachDocument(document)
+        self.text.setAssets(assets)
+        document.contentsChanged.connect(self.resetTimeout)
+        self.finishUnlock()
+
+    def finishUnlock(self):
         self.text.setEnabled(True)
         self.text.setReadOnly(False)
 
@@ -1198,6 +1451,7 @@ class Main(QMainWindow):
         self.text.verticalScrollBar().setValue(self.lockData.scrollBarPos)
 
         self.lockData.unlock()
+        self.setDocumentLock(False)
 
     @checkLock
     def preview(self):
@@ -1347,17 +1601,12 @@ class Main(QMainWindow):
 
         # Get image file name
         #PYQT5 Returns a tuple in PyQt5
-        filename = QFileDialog.getOpenFileName(self, 'Insert image',".","Images (*.png *.xpm *.jpg *.bmp *.gif *.svg)")[0]
+        filename = QFileDialog.getOpenFileName(self, 'Insert image',".","Images (*.png *.xpm *.jpg *.jpeg *.webp *.bmp *.gif *.svg)")[0]
 
         if filename:
             
-            # Create image object
-            image_bytes = Path(filename).read_bytes()
-            image = QImage()
-            image.loadFromData(image_bytes)
-
-            # Error if unloadable
-            if image.isNull():
+            # Insert the original file data, error if unloadable
+            if not self.text.insertImageFile(filename):
 
                 popup = QMessageBox(QMessageBox.Critical,
                                           "Image load error",
@@ -1366,9 +1615,6 @@ class Main(QMainWindow):
                                           self)
                 popup.show()
 
-            else:
-                self.text.dropImage(image)
-
     def insertCameraImage(self):
         from writerlib import image
         d = image.CameraListDialog(self.text)
@@ -0,0 +1,212 @@
+import imghdr
+import math
+import threading
+from io import BytesIO
+from collections import OrderedDict
+from typing import Dict, Mapping, Optional, Tuple
+
+from PySide6.QtCore import QByteArray, QBuffer, QIODevice, Qt
+from PySide6.QtGui import QImage, QImageReader
+
+from .settings import Settings
+
+# 这些格式的图片保存原始数据，其他格式转换为PNG
+KeepImageTypes = ('png', 'jpeg', 'gif', 'webp')
+# 另存原始数据时图片格式对应的扩展名
+ImageExtensions = {'png': 'png', 'jpeg': 'jpg', 'gif': 'gif', 'webp': 'webp'}
+
+
+def imageToBytes(image: QImage, imageFormat: str = 'PNG', quality: int = -1) -> bytes:
+    '''
+    quality为0到100，-1使用默认值，只对JPEG和WEBP有效。Qt没有对应的编码插件时使用PNG
+    '''
+    ba = QByteArray()
+    buffer = QBuffer(ba)
+    buffer.open(QIODevice.OpenModeFlag.WriteOnly)
+    if not image.save(buffer, imageFormat, quality) and imageFormat != 'PNG':
+        buffer.seek(0)
+        ba.clear()
+        image.save(buffer, 'PNG')
+    buffer.close()
+    return ba.data()
+
+
+class ImageCache:
+    '''
+    按资源的sha256缓存解码后的图片，最近使用的图片保留在缓存中，缓存的图片总大小不超过maxBytes。
+    图片的原始数据保存在TextEdit.assets中，不在缓存中重复保存。
+    maxBytes只限制缓存本身，QTextDocument排版时通过loadResource读取的图片由文档另外保留，直到文档被替换
+    '''
+
+    def __init__(self, maxBytes: int = 256 << 20):
+        self.maxBytes = maxBytes
+        self.images: OrderedDict[str, QImage] = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def get(self, assetHash: str) -> Optional[QImage]:
+        with self.lock:
+            image = self.images.get(assetHash)
+            if image is not None:
+                self.images.move_to_end(assetHash)
+            return image
+
+    def put(self, assetHash: str, image: QImage):
+        if image.isNull() or image.sizeInBytes() > self.maxBytes:
+            return
+        with self.lock:
+            old = self.images.pop(assetHash, None)
+            if old is not None:
+                self.size -= old.sizeInBytes()
+            self.images[assetHash] = image
+            self.size += image.sizeInBytes()
+            while self.size > self.maxBytes:
+                assetHash, old = self.images.popitem(last=False)
+                self.size -= old.sizeInBytes()
+
+    def clear(self):
+        with self.lock:
+            self.images.clear()
+            self.size = 0
+
+    def __contains__(self, assetHash: str) -> bool:
+        with self.lock:
+            return assetHash in self.images
+
+    def __len__(self) -> int:
+        with self.lock:
+            return len(self.images)
+
+
+class ImageScalePolicy:
+    '''
+    插入图片时缩小长边超过maxSize像素或编码后超过maxBytes字节的图片，0表示不限制。
+    缩小后的图片没有透明通道时用JPEG编码。keepOriginal为True时原图也保存为资源，只在需要时解码
+    '''
+
+    # 按大小缩小时图片长边的最小值
+    minSize = 64
+
+    def __init__(self, maxSize: int = 0, maxBytes: int = 0, keepOriginal: bool = True, quality: int = 90):
+        self.maxSize = maxSize
+        self.maxBytes = maxBytes
+        self.keepOriginal = keepOriginal
+        self.quality = quality
+
+    @classmethod
+    def fromSettings(cls, settings: Settings) -> 'ImageScalePolicy':
+        return cls(settings.imageMaxSize, settings.imageMaxBytes << 10, settings.keepOriginalImage)
+
+    def isOversized(self, image: QImage) -> bool:
+        return self.maxSize > 0 and max(image.width(), image.height()) > self.maxSize
+
+    def isOverBudget(self, data: bytes) -> bool:
+        return self.maxBytes > 0 and len(data) > self.maxBytes
+
+    def apply(self, image: QImage, data: Optional[bytes] = None, imageFormat: str = 'PNG',
+              quality: int = -1) -> Tuple[bytes, QImage, Optional[bytes]]:
+        '''
+        data为图片的原始数据，没有原始数据时用imageFormat和quality编码。
+        返回插入文档的图片数据、图片和需要保留的原图数据
+        '''
+        if not self.isOversized(image):
+            if data is None:
+                data = imageToBytes(image, imageFormat, quality)
+            if not self.isOverBudget(data):
+                return data, image, None
+
+        if data is None and self.keepOriginal:
+            data = imageToBytes(image, imageFormat, quality)
+
+        if image.hasAlphaChannel():
+            scaledFormat, scaledQuality = 'PNG', -1
+        else:
+            scaledFormat, scaledQuality = 'JPEG', self.quality
+
+        scaled = image
+        if self.isOversized(image):
+            scaled = image.scaled(self.maxSize, self.maxSize, Qt.AspectRatioMode.KeepAspectRatio,
+                                  Qt.TransformationMode.SmoothTransformation)
+        scaledData = imageToBytes(scaled, scaledFormat, scaledQuality)
+
+        # 编码后仍然超过大小时按比例继续缩小，每次最多缩小一半
+        while self.isOverBudget(scaledData) and max(scaled.width(), scaled.height()) > self.minSize:
+            factor = min(0.9, max(0.5, math.sqrt(self.maxBytes / len(scaledData))))
+            scaled = scaled.scaled(max(1, int(scaled.width() * factor)), max(1, int(scaled.height() * factor)),
+                                   Qt.AspectRatioMode.KeepAspectRatio, Qt.TransformationMode.SmoothTransformation)
+            scaledData = imageToBytes(scaled, scaledFormat, scaledQuality)
+
+        # 没有缩小尺寸，重新编码也没有变小时保留原图
+        if data is not None and scaled.size() == image.size() and len(scaledData) >= len(data):
+            return data, image, None
+
+        return scaledData, scaled, data if self.keepOriginal else None
+
+
+def getImageType(data: bytes) -> Optional[str]:
+    with BytesIO(data) as f:
+        return imghdr.what(f)
+
+
+def prepareImage(data: bytes, policy: ImageScalePolicy) -> Optional[Tuple[bytes, QImage, Optional[bytes]]]:
+    '''
+    解码图片并按policy缩小，不能解码时返回None。只使用QImage，可以在线程池中调用
+    '''
+    image = QImage()
+    if not image.loadFromData(data):
+        return None
+    return policy.apply(image, data if getImageType(data) in KeepImageTypes else None)
+
+
+class ImageInfo:
+    '''
+    图片的原始宽高、格式和数据大小，读取时只解析图片头，不解码图片
+    '''
+
+    __slots__ = ('width', 'height', 'format', 'size')
+
+    # 先只用数据的开头读取图片头，读取失败时再使用全部数据
+    headBytesLen = 256 << 10
+
+    def __init__(self, width: int, height: int, format: str, size: int):
+        self.width = width
+        self.height = height
+        self.format = format
+        self.size = size
+
+    @classmethod
+    def ofImage(cls, image: QImage, data: bytes) -> 'ImageInfo':
+        return cls(image.width(), image.height(), getImageType(data) or '', len(data))
+
+    @classmethod
+    def of(cls, data: bytes) -> Optional['ImageInfo']:
+        info = cls.readHead(data[:cls.headBytesLen], len(data))
+        if info is None and len(data) > cls.headBytesLen:
+            info = cls.readHead(data, len(data))
+        return info
+
+    @classmethod
+    def readHead(cls, head: bytes, size: int) -> Optional['ImageInfo']:
+        ba = QByteArray(head)
+        buffer = QBuffer(ba)
+        buffer.open(QIODevice.OpenModeFlag.ReadOnly)
+        reader = QImageReader(buffer)
+        imageSize = reader.size()
+        if not imageSize.isValid() or imageSize.isEmpty():
+            return None
+        return cls(imageSize.width(), imageSize.height(), reader.format().data().decode('ascii').lower(), size)
+
+    def ratio(self) -> float:
+        return self.width / self.height
+
+
+def readImageInfos(assets: Mapping[str, bytes]) -> Dict[str, ImageInfo]:
+    '''
+    打开文档时读取所有图片的信息，可以在线程池中调用
+    '''
+    infos = dict()
+    for assetHash, data in assets.items():
+        info = ImageInfo.of(data)
+        if info is not None:
+            infos[assetHash] = info
+    return infos
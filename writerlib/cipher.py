@@ -0,0 +1,488 @@
+import hashlib
+import hmac
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, List, Optional, Tuple, TypeVar
+
+from Crypto.Cipher import AES
+
+from .doc import CorruptFileException, MemoryViewReader, readBytes, readInt
+
+
+DocEnvelopeType = TypeVar("DocEnvelopeType", bound="DocEnvelope")
+KeyContextType = TypeVar("KeyContextType", bound="KeyContext")
+
+
+class KeyContext:
+    '''
+    从密钥派生的指纹、加密密钥和MAC密钥。每个密钥只派生一次并缓存，比较指纹就可以判断两次使用的是否是同一个密钥，
+    不需要解密数据。of可以传入keymanager的Key或者密钥的bytes。
+    缓存中保存了密钥，密钥超时、失效或者锁定文档时需要调用evict或clear
+    '''
+
+    FingerprintLabel = b'EncryptWriter key fingerprint'
+    EncryptKeyLabel = b'EncryptWriter chunk key'
+    MacKeyLabel = b'EncryptWriter chunk mac'
+
+    # 缓存的密钥数量
+    cacheSize = 8
+    cache: Dict[bytes, KeyContextType] = OrderedDict()
+    cacheLock = threading.Lock()
+
+    def __init__(self, key: bytes):
+        self.fingerprint = hmac.new(key, self.FingerprintLabel, hashlib.sha256).digest()
+        self.encryptKey = hmac.new(key, self.EncryptKeyLabel, hashlib.sha256).digest()
+        self.macKey = hmac.new(key, self.MacKeyLabel, hashlib.sha256).digest()
+        # 已经处理过密钥的HMAC，每次计算时复制
+        self.macTemplate = hmac.new(self.macKey, digestmod=hashlib.sha256)
+
+    @classmethod
+    def of(cls, key) -> KeyContextType:
+        key = bytes(getattr(key, 'key', key))
+        with cls.cacheLock:
+            context = cls.cache.get(key)
+            if context is not None:
+                cls.cache.move_to_end(key)
+                return context
+        context = cls(key)
+        with cls.cacheLock:
+            cls.cache[key] = context
+            while len(cls.cache) > cls.cacheSize:
+                cls.cache.popitem(last=False)
+        return context
+
+    @classmethod
+    def clear(cls):
+        with cls.cacheLock:
+            cls.cache.clear()
+
+    @classmethod
+    def evict(cls, key):
+        '''
+        密钥超时或失效时移除缓存的派生密钥，之后使用这个密钥时重新派生
+        '''
+        key = bytes(getattr(key, 'key', key))
+        with cls.cacheLock:
+            cls.cache.pop(key, None)
+
+    @classmethod
+    def fingerprintOf(cls, key) -> bytes:
+        return cls.of(key).fingerprint
+
+    def isSameKey(self, fingerprint: bytes) -> bool:
+        return hmac.compare_digest(self.fingerprint, fingerprint)
+
+    def mac(self, data) -> bytes:
+        mac = self.macTemplate.copy()
+        mac.update(data)
+        return mac.digest()
+
+
+class DocEnvelope:
+    '''
+    分块加密的文档。每个分块使用独立的随机nonce以AES-GCM加密，分块表记录每个分块的位置、长度、nonce和tag，
+    分块表的MAC覆盖整个分块列表，分块不能被替换、删除或调整顺序。加密和解密在线程池中并行进行
+    格式：Magic | 版本 | 分块表位置 | 文件头MAC | 密文 ... | 分块表
+    分块表：分块数量 | (位置 | 长度 | nonce | tag) * 分块数量 | MAC
+    保存时只加密变化的分块并追加到文件末尾，写入新的分块表后再修改文件头中分块表的位置，没有变化的分块保留原来的密文和tag，
+    追加的数据超过一定比例后重写整个文件。
+    文件头MAC覆盖分块表的位置和分块表的MAC，文件中保留的旧分块表不能通过修改分块表的位置重新使用
+    版本1的分块表在文件头之后，不包含位置，密文按顺序排列；版本2的文件头没有MAC
+    '''
+
+    class Version:
+        V1 = 1
+        V2 = 2
+        V3 = 3
+        Latest = V3
+
+    Magic = b'EWCE'
+    VersionBytesLen = 1
+    TableOffsetBytesLen = 7
+    ChunkCountBytesLen = 4
+    OffsetBytesLen = 7
+    ChunkBytesLen = 5
+    NonceBytesLen = 12
+    TagBytesLen = 16
+    MacBytesLen = 32
+    ChunkHashBytesLen = 16
+    HeadFieldsBytesLen = len(Magic) + VersionBytesLen + TableOffsetBytesLen
+    HeadBytesLen = HeadFieldsBytesLen + MacBytesLen
+
+    # 每个分块的最大长度，文档的每个数据段单独分块，大的数据段按chunkSize切分
+    chunkSize = 1 << 20
+    # 流式加密时每个线程同时处理的分块数量，限制内存中的密文
+    pendingChunks = 2
+    # 追加的数据超过有效数据的比例后重写整个文件
+    compactRatio = 1.0
+
+    def __init__(self):
+        self.version = self.Version.Latest
+        # (位置, 长度, nonce, tag)
+        self.chunks: List[Tuple[int, int, bytes, bytes]] = list()
+        # 文件中已有的分块，明文hash -> (位置, 长度, nonce, tag)，只保存在内存中
+        self.chunkIndex: Dict[bytes, Tuple[int, int, bytes, bytes]] = dict()
+        # 只保存密钥的指纹，派生的密钥在加密和解密时从KeyContext取得
+        self.keyFingerprint = bytes()
+        self.fileLen = 0
+
+    @classmethod
+    def isEnvelope(cls, data) -> bool:
+        return bytes(data[:len(cls.Magic)]) == cls.Magic
+
+    @classmethod
+    def chunkHash(cls, chunk) -> bytes:
+        return hashlib.blake2b(chunk, digest_size=cls.ChunkHashBytesLen).digest()
+
+    def getHeadBytesLen(self) -> int:
+        return self.HeadBytesLen if self.version >= self.Version.V3 else self.HeadFieldsBytesLen
+
+    def headToBytes(self, tableOffset: int, keyContext: KeyContext = None, tableMac: bytes = b'') -> bytes:
+        fields = self.Magic + self.version.to_bytes(self.VersionBytesLen, byteorder='big') + \
+                 tableOffset.to_bytes(self.TableOffsetBytesLen, byteorder='big')
+        if self.version < self.Version.V3:
+            return fields
+        return fields + self.headMac(keyContext, tableOffset, tableMac)
+
+    def headMac(self, keyContext: KeyContext, tableOffset: int, tableMac: bytes) -> bytes:
+        return keyContext.mac(self.Magic + self.version.to_bytes(self.VersionBytesLen, byteorder='big') +
+                              tableOffset.to_bytes(self.TableOffsetBytesLen, byteorder='big') + tableMac)
+
+    def tableFieldsToBytes(self) -> bytes:
+        fields = [self.Magic, self.version.to_bytes(self.VersionBytesLen, byteorder='big'),
+                  len(self.chunks).to_bytes(self.ChunkCountBytesLen, byteorder='big')]
+        for offset, length, nonce, tag in self.chunks:
+            if self.version >= self.Version.V2:
+                fields.append(offset.to_bytes(self.OffsetBytesLen, byteorder='big'))
+            fields.append(length.to_bytes(self.ChunkBytesLen, byteorder='big'))
+            fields.append(nonce)
+            fields.append(tag)
+        return b''.join(fields)
+
+    def tableToBytes(self, keyContext: KeyContext) -> bytes:
+        '''
+        MAC同时覆盖Magic和版本，写入文件的分块表不包含这两项
+        '''
+        fields = self.tableFieldsToBytes()
+        return fields[len(self.Magic) + self.VersionBytesLen:] + keyContext.mac(fields)
+
+    def getTableEntryBytesLen(self) -> int:
+        entryLen = self.ChunkBytesLen + self.NonceBytesLen + self.TagBytesLen
+        if self.version >= self.Version.V2:
+            entryLen += self.OffsetBytesLen
+        return entryLen
+
+    def getTableBytesLen(self) -> int:
+        return self.ChunkCountBytesLen + len(self.chunks) * self.getTableEntryBytesLen() + self.MacBytesLen
+
+    def getBodyLen(self) -> int:
+        return sum(chunk[1] for chunk in self.chunks)
+
+    @classmethod
+    def readTable(cls, bis) -> Tuple[DocEnvelopeType, int, bytes, bytes]:
+        '''
+        读取文件头和分块表，不验证MAC，返回DocEnvelope、分块表的位置、分块表的MAC和文件头的MAC，
+        版本2之前的文件头MAC为空。分块数量不能超过剩余数据能容纳的数量，损坏的文件不会按错误的数量循环读取
+        '''
+        envelope = cls()
+        if bytes(readBytes(len(cls.Magic), bis)) != cls.Magic:
+            raise CorruptFileException('不是分块加密的文档')
+        envelope.version = readInt(cls.VersionBytesLen, bis)
+        if envelope.version > cls.Version.Latest or envelope.version < cls.Version.V1:
+            raise CorruptFileException('不支持的分块加密版本%d' % envelope.version)
+        headMac = bytes()
+        if envelope.version >= cls.Version.V2:
+            tableOffset = readInt(cls.TableOffsetBytesLen, bis)
+            if envelope.version >= cls.Version.V3:
+                headMac = bytes(readBytes(cls.MacBytesLen, bis))
+            if tableOffset < envelope.getHeadBytesLen():
+                raise CorruptFileException('分块表位置%d无效' % tableOffset)
+            bis.seek(tableOffset)
+        tableOffset = bis.tell()
+        remaining = bis.seek(0, 2) - tableOffset
+        bis.seek(tableOffset)
+        count = readInt(cls.ChunkCountBytesLen, bis)
+        if count * envelope.getTableEntryBytesLen() > remaining:
+            raise CorruptFileException('分块数量%d超出文件长度' % count)
+        offset = 0
+        for index in range(count):
+            if envelope.version >= cls.Version.V2:
+                offset = readInt(cls.OffsetBytesLen, bis)
+            length = readInt(cls.ChunkBytesLen, bis)
+            nonce = bytes(readBytes(cls.NonceBytesLen, bis))
+            tag = bytes(readBytes(cls.TagBytesLen, bis))
+            envelope.chunks.append((offset, length, nonce, tag))
+            offset += length
+        mac = bytes(readBytes(cls.MacBytesLen, bis))
+        if envelope.version < cls.Version.V2:
+            # 版本1的密文在分块表之后
+            bodyOffset = bis.tell()
+            envelope.chunks = [(offset + bodyOffset, length, nonce, tag)
+                               for offset, length, nonce, tag in envelope.chunks]
+        return envelope, tableOffset, mac, headMac
+
+    @classmethod
+    def readHead(cls, bis, keyContext: KeyContext) -> DocEnvelopeType:
+        '''
+        读取文件头并验证分块表，密钥不匹配、分块列表或分块表的位置被修改时抛出CorruptFileException
+        '''
+        envelope, tableOffset, mac, headMac = cls.readTable(bis)
+        envelope.keyFingerprint = keyContext.fingerprint
+        envelope.checkMac(keyContext, tableOffset, mac, headMac)
+        return envelope
+
+    def checkMac(self, keyContext: KeyContext, tableOffset: int, mac: bytes, headMac: bytes):
+        if not hmac.compare_digest(mac, keyContext.mac(self.tableFieldsToBytes())):
+            raise CorruptFileException('分块表校验失败，文件损坏或密钥不匹配')
+        if self.version >= self.Version.V3 and \
+                not hmac.compare_digest(headMac, self.headMac(keyContext, tableOffset, mac)):
+            raise CorruptFileException('文件头校验失败，分块表的位置被修改')
+
+    @classmethod
+    def verify(cls, path, key: bytes = None):
+        '''
+        检查文件结构，分块都在文件头和分块表之间。没有密钥时不能检查MAC和分块的tag，
+        传入密钥时同时检查文件头和分块表的MAC，有错误时抛出CorruptFileException
+        '''
+        with open(path, 'rb') as f:
+            envelope, tableOffset, mac, headMac = cls.readTable(f)
+            fileLen = os.fstat(f.fileno()).st_size
+        envelope.checkFileLen(fileLen)
+        if envelope.version >= cls.Version.V2:
+            for offset, length, nonce, tag in envelope.chunks:
+                if offset < envelope.getHeadBytesLen() or offset + length > tableOffset:
+                    raise CorruptFileException('分块位置%d长度%d超出密文区域' % (offset, length))
+        if key is not None:
+            envelope.checkMac(KeyContext.of(key), tableOffset, mac, headMac)
+
+    def checkFileLen(self, fileLen: int):
+        chunkEnd = max((offset + length for offset, length, nonce, tag in self.chunks), default=0)
+        if chunkEnd > fileLen:
+            raise CorruptFileException('文件长度%d小于分块结束的位置%d' % (fileLen, chunkEnd))
+        if self.version < self.Version.V2 and self.chunks and chunkEnd != fileLen:
+            raise CorruptFileException('文件长度%d与分块长度之和%d不一致' % (fileLen, chunkEnd))
+
+    @classmethod
+    def splitBuffers(cls, buffers: Iterable) -> List[memoryview]:
+        pieces = list()
+        for buffer in buffers:
+            view = memoryview(buffer).cast('B')
+            for offset in range(0, len(view), cls.chunkSize):
+                pieces.append(view[offset:offset + cls.chunkSize])
+        return pieces
+
+    @classmethod
+    def encryptChunk(cls, encryptKey: bytes, data) -> Tuple[bytes, bytes, bytes]:
+        nonce = os.urandom(cls.NonceBytesLen)
+        cipher = AES.new(encryptKey, AES.MODE_GCM, nonce=nonce)
+        cipher.update(cls.Magic)
+        ciphertext, tag = cipher.encrypt_and_digest(data)
+        return nonce, tag, ciphertext
+
+    @classmethod
+    def decryptChunk(cls, encryptKey: bytes, nonce: bytes, tag: bytes, data, output=None):
+        cipher = AES.new(encryptKey, AES.MODE_GCM, nonce=nonce)
+        cipher.update(cls.Magic)
+        plaintext = cipher.decrypt(data, output=output)
+        try:
+            cipher.verify(tag)
+        except ValueError:
+            raise CorruptFileException('分块校验失败，文件损坏或密钥不匹配')
+        return plaintext
+
+    def writeChunks(self, f, encryptKey: bytes, pieces: List[memoryview], threads: Optional[int],
+                    progress: Callable[[int, int], None] = None) \
+            -> Tuple[List[Tuple[int, int, bytes, bytes]], Dict[bytes, Tuple[int, int, bytes, bytes]]]:
+        '''
+        从文件当前位置写入分块，chunkIndex中已有的分块不再加密和写入。返回新的分块列表和新写入的分块，
+        不修改DocEnvelope，文件头写入并同步到磁盘后再由调用者更新，写入失败时DocEnvelope仍然对应文件中的内容
+        '''
+        def encryptPiece(piece):
+            chunkHash = self.chunkHash(piece)
+            if chunkHash in self.chunkIndex:
+                return chunkHash, None
+            return chunkHash, self.encryptChunk(encryptKey, piece)
+
+        threads = threads or os.cpu_count()
+        window = threads * self.pendingChunks
+        total = sum(len(piece) for piece in pieces)
+        position = 0
+        offset = f.tell()
+        chunks = list()
+        chunkIndex = dict()
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            for start in range(0, len(pieces), window):
+                for chunkHash, result in executor.map(encryptPiece, pieces[start:start + window]):
+                    chunk = self.chunkIndex.get(chunkHash, chunkIndex.get(chunkHash))
+                    if chunk is None:
+                        nonce, tag, ciphertext = result
+                        chunk = (offset, len(ciphertext), nonce, tag)
+                        f.write(ciphertext)
+                        chunkIndex[chunkHash] = chunk
+                        offset += len(ciphertext)
+                    chunks.append(chunk)
+                    position += chunk[1]
+                if progress is not None:
+                    progress(position, total)
+        return chunks, chunkIndex
+
+    def writeTable(self, f, keyContext: KeyContext) -> Tuple[int, bytes]:
+        '''
+        从文件当前位置写入分块表，返回分块表的位置和MAC，用于生成文件头
+        '''
+        tableOffset = f.tell()
+        table = self.tableToBytes(keyContext)
+        f.write(table)
+        f.truncate()
+        f.flush()
+        os.fsync(f.fileno())
+        return tableOffset, table[-self.MacBytesLen:]
+
+    @classmethod
+    def encrypt(cls, key: bytes, buffers: Iterable, threads: Optional[int] = None) -> List[memoryview]:
+        '''
+        加密文档的各个数据段，返回组成文件的数据段，可以直接用saveBuffers写入文件
+        '''
+        envelope = cls()
+        keyContext = KeyContext.of(key)
+        envelope.keyFingerprint = keyContext.fingerprint
+        encryptKey = keyContext.encryptKey
+        pieces = cls.splitBuffers(buffers)
+        with ThreadPoolExecutor(max_workers=threads or os.cpu_count()) as executor:
+            results = list(executor.map(lambda piece: cls.encryptChunk(encryptKey, piece), pieces))
+        offset = cls.HeadBytesLen
+        for nonce, tag, ciphertext in results:
+            envelope.chunks.append((offset, len(ciphertext), nonce, tag))
+            offset += len(ciphertext)
+        table = envelope.tableToBytes(keyContext)
+        return [memoryview(envelope.headToBytes(offset, keyContext, table[-cls.MacBytesLen:]))] + \
+               [memoryview(ciphertext) for nonce, tag, ciphertext in results] + [memoryview(table)]
+
+    @classmethod
+    def decrypt(cls, key: bytes, data, threads: Optional[int] = None) -> bytearray:
+        '''
+        解密整个文档，每个分块直接解密到结果中对应的位置
+        '''
+        keyContext = KeyContext.of(key)
+        encryptKey = keyContext.encryptKey
+        bis = MemoryViewReader(data)
+        envelope = cls.readHead(bis, keyContext)
+        envelope.checkFileLen(len(bis.view))
+        content = bytearray(envelope.getBodyLen())
+        view = memoryview(content)
+        tasks = list()
+        position = 0
+        for offset, length, nonce, tag in envelope.chunks:
+            tasks.append((nonce, tag, bis.view[offset:offset + length], view[position:position + length]))
+            position += length
+
+        def decryptTask(task):
+            nonce, tag, ciphertext, output = task
+            cls.decryptChunk(encryptKey, nonce, tag, ciphertext, output)
+
+        with ThreadPoolExecutor(max_workers=threads or os.cpu_count()) as executor:
+            list(executor.map(decryptTask, tasks))
+        return content
+
+    @classmethod
+    def encryptToFile(cls, key: bytes, path, buffers: Iterable, threads: Optional[int] = None,
+                      progress: Callable[[int, int], None] = None) -> DocEnvelopeType:
+        '''
+        加密文档的各个数据段并写入文件，内存中只保留正在加密的分块的密文。先写入所有分块和分块表，最后写入文件头，
+        同样先写入临时文件并同步到磁盘再替换原文件。返回的DocEnvelope用于之后只加密变化的分块
+        '''
+        envelope = cls()
+        keyContext = KeyContext.of(key)
+        envelope.keyFingerprint = keyContext.fingerprint
+        encryptKey = keyContext.encryptKey
+        tempPath = str(path) + '.tmp'
+        with open(tempPath, 'wb') as f:
+            f.seek(cls.HeadBytesLen)
+            envelope.chunks, envelope.chunkIndex = envelope.writeChunks(f, encryptKey, cls.splitBuffers(buffers),
+                                                                        threads, progress)
+            tableOffset, tableMac = envelope.writeTable(f, keyContext)
+            f.seek(0)
+            f.write(envelope.headToBytes(tableOffset, keyContext, tableMac))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tempPath, path)
+        envelope.fileLen = tableOffset + envelope.getTableBytesLen()
+        return envelope
+
+    @classmethod
+    def decryptFile(cls, key: bytes, path, threads: Optional[int] = None,
+                    progress: Callable[[int, int], None] = None) -> Tuple[bytearray, DocEnvelopeType]:
+        '''
+        从文件中读取并解密文档，每个分块读取到结果中对应的位置后在线程池中原地解密，不保留密文的副本。
+        同时返回文件的DocEnvelope
+        '''
+        keyContext = KeyContext.of(key)
+        encryptKey = keyContext.encryptKey
+        with open(path, 'rb', buffering=0) as f:
+            envelope = cls.readHead(f, keyContext)
+            envelope.fileLen = os.fstat(f.fileno()).st_size
+            envelope.checkFileLen(envelope.fileLen)
+            bodyLen = envelope.getBodyLen()
+            content = bytearray(bodyLen)
+            view = memoryview(content)
+
+            def decryptTask(nonce, tag, chunk):
+                cls.decryptChunk(encryptKey, nonce, tag, chunk, chunk)
+                return cls.chunkHash(chunk)
+
+            with ThreadPoolExecutor(max_workers=threads or os.cpu_count()) as executor:
+                tasks = list()
+                position = 0
+                for offset, length, nonce, tag in envelope.chunks:
+                    chunk = view[position:position + length]
+                    f.seek(offset)
+                    read = 0
+                    while read < length:
+                        size = f.readinto(chunk[read:])
+                        if not size:
+                            raise CorruptFileException('预期读取个%d字节，实际读取%d个字节' % (length, read))
+                        read += size
+                    tasks.append(executor.submit(decryptTask, nonce, tag, chunk))
+                    position += length
+                    if progress is not None:
+                        progress(position, bodyLen)
+                for task, chunk in zip(tasks, envelope.chunks):
+                    envelope.chunkIndex[task.result()] = chunk
+        return content, envelope
+
+    def canUpdate(self, path, key: bytes) -> bool:
+        if self.version != self.Version.Latest:
+            return False
+        if not KeyContext.of(key).isSameKey(self.keyFingerprint):
+            return False
+        liveLen = self.HeadBytesLen + self.getBodyLen() + self.getTableBytesLen()
+        if self.fileLen - liveLen > liveLen * self.compactRatio:
+            return False
+        # 文件被其他程序修改过
+        return os.path.exists(path) and os.path.getsize(path) == self.fileLen
+
+    def update(self, key: bytes, path, buffers: Iterable, threads: Optional[int] = None,
+               progress: Callable[[int, int], None] = None):
+        '''
+        只加密变化的分块并追加到文件末尾，写入新的分块表并同步到磁盘后，再修改文件头中分块表的位置，
+        修改文件头之前中断时文件仍然是上次保存的内容，DocEnvelope也保留上次保存的分块，再次保存时不会引用没有写入的密文
+        '''
+        keyContext = KeyContext.of(key)
+        lastChunks = self.chunks
+        try:
+            with open(path, 'r+b') as f:
+                f.seek(self.fileLen)
+                self.chunks, chunkIndex = self.writeChunks(f, keyContext.encryptKey, self.splitBuffers(buffers),
+                                                           threads, progress)
+                tableOffset, tableMac = self.writeTable(f, keyContext)
+                f.seek(0)
+                f.write(self.headToBytes(tableOffset, keyContext, tableMac))
+                f.flush()
+                os.fsync(f.fileno())
+        except BaseException:
+            self.chunks = lastChunks
+            raise
+        self.chunkIndex.update(chunkIndex)
+        self.fileLen = tableOffset + self.getTableBytesLen()
@@ -1,11 +1,21 @@
+import hashlib
+import lzma
+import mmap
+import os
+import re
+import zlib
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
-from typing import List, TypeVar
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple, TypeVar
 
 
 DocHeadType = TypeVar("DocHeadType", bound="DocHead")
 DocInfoBlockType = TypeVar("DocInfoBlockType", bound="DocInfoBlock")
 DocBodyType = TypeVar("DocBodyType", bound="DocBody")
 DocFileType = TypeVar("DocFileType", bound="DocFile")
+DocJournalType = TypeVar("DocJournalType", bound="DocJournal")
+DocInfoTableType = TypeVar("DocInfoTableType", bound="DocInfoTable")
 
 
 class CorruptFileException(Exception):
@@ -21,13 +31,8 @@ def pad(data: bytes, length: int, pad: bytes) -> bytes:
 
 
 def unpad(data: bytes, pad: bytes) -> bytes:
-    result = bytearray(b'')
-    dataArray = [b'%c' % i for i in data]
-    for b in dataArray:
-        if b == pad:
-            continue
-        result += b
-    return bytes(result)
+    # pad在数据前填充
+    return bytes(data).lstrip(pad)
 
 
 def readInt(length: int, bis: BytesIO) -> int:
@@ -44,41 +49,271 @@ def readBytes(length: int, bis:BytesIO) -> bytes:
         raise CorruptFileException('预期读取个%d字节，实际读取%d个字节' % (length, len(b)))
     return b
 
+
+# 一次writev最多写入的数据段数量
+IovMax = 1024
+
+
+def writeBuffers(fd: int, buffers: List[memoryview]) -> int:
+    '''
+    把多个数据段依次写入文件描述符，支持writev时一次系统调用写入多个数据段
+    '''
+    buffers = [buffer.cast('B') for buffer in buffers if buffer.nbytes > 0]
+    total = 0
+    index = 0
+    while index < len(buffers):
+        if hasattr(os, 'writev'):
+            written = os.writev(fd, buffers[index:index + IovMax])
+        else:
+            written = os.write(fd, buffers[index])
+        total += written
+        # 跳过已经写完的数据段，部分写入的数据段从剩余的位置继续写
+        while index < len(buffers) and written >= buffers[index].nbytes:
+            written -= buffers[index].nbytes
+            index += 1
+        if written > 0:
+            buffers[index] = buffers[index][written:]
+    return total
+
+
+def mapFile(path) -> mmap.mmap:
+    '''
+    以只读方式把文件映射到内存，映射在没有引用后释放
+    '''
+    with open(path, 'rb') as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def saveBuffers(path, buffers: List[memoryview]):
+    '''
+    先写入临时文件并同步到磁盘，再替换原文件，写入失败时原文件不变
+    '''
+    tempPath = str(path) + '.tmp'
+    with open(tempPath, 'wb') as f:
+        writeBuffers(f.fileno(), buffers)
+        os.fsync(f.fileno())
+    os.replace(tempPath, path)
+
+
+def isEnvelopeFile(path) -> bool:
+    '''
+    是否是分块加密的文档，见cipher.DocEnvelope
+    '''
+    from .cipher import DocEnvelope
+    with open(path, 'rb') as f:
+        return DocEnvelope.isEnvelope(f.read(len(DocEnvelope.Magic)))
+
+
+def isEncryptedFile(path) -> bool:
+    '''
+    是否是分块加密的文档或keymanager整体加密的旧版本文档，没有安装keymanager时只检查分块加密的文档
+    '''
+    if isEnvelopeFile(path):
+        return True
+    try:
+        from keymanager.encryptor import is_encrypt_data
+    except ImportError:
+        return False
+    if os.path.getsize(path) == 0:
+        return False
+    with mapFile(path) as content:
+        return is_encrypt_data(content)
+
+
+class MemoryViewReader:
+    '''
+    以文件对象的方式读取内存中的数据，read返回的是memoryview切片，不会复制数据
+    '''
+
+    def __init__(self, data):
+        self.view = memoryview(data)
+        self.position = 0
+
+    def read(self, length: int = -1) -> memoryview:
+        end = len(self.view) if length < 0 else min(self.position + length, len(self.view))
+        b = self.view[self.position:end]
+        self.position = end
+        return b
+
+    def tell(self) -> int:
+        return self.position
+
+    def seek(self, position: int, whence: int = 0) -> int:
+        if whence == 1:
+            position += self.position
+        elif whence == 2:
+            position += len(self.view)
+        self.position = max(0, min(position, len(self.view)))
+        return self.position
+
+
 class DocHead:
 
     DocTypeBytesLen = 2
     DocInfoBlockCountBytesLen = 4
     DocInfoBlockBytesLen = 5
     DocBodyBytesLen = 7
+    DocChunkCountBytesLen = 4
+    DocChunkBytesLen = 5
+    DocCodecBytesLen = 1
+    DocAssetCountBytesLen = 4
+    DocAssetHashBytesLen = 32
+    DocAssetBytesLen = 5
+    DocChecksumTypeBytesLen = 1
+    DocChecksumBytesLen = 4
 
     class DocType:
         Writer = 1
 
+    class Version:
+        # 信息块名称填充到1024字节
+        V1 = 1
+        # 信息块名称使用长度前缀
+        V2 = 2
+        # 正文分块，文件头记录每个分块的长度
+        V3 = 3
+        # 文件头记录正文的压缩格式，每个分块单独压缩
+        V4 = 4
+        # 正文后增加资源区，保存图片等二进制数据，以sha256去重
+        V5 = 5
+        # 文件末尾可以追加保存记录，见DocJournal
+        V6 = 6
+        # 文件头记录文件头、信息块、每个正文分块和资源的校验和
+        V7 = 7
+        Latest = V7
+
+    class Codec:
+        Raw = 0
+        Zlib = 1
+        Lzma = 2
+        Names = {'none': Raw, 'zlib': Zlib, 'lzma': Lzma}
+
+    class Checksum:
+        NoChecksum = 0
+        Crc32 = 1
+
     def __init__(self):
         self.docType:int = None
+        self.version: int = DocHead.Version.Latest
         self.docInfoBlockLen: List[int] = list()
         self.docBodyLen: int = 0
+        self.docChunkLen: List[int] = list()
+        self.codec: int = DocHead.Codec.Raw
+        self.docAssetHash: List[str] = list()
+        self.docAssetLen: List[int] = list()
+        self.checksum: int = DocHead.Checksum.Crc32
+        # 所有信息块、每个正文分块（压缩后）和每个资源的校验和
+        self.docInfoBlockChecksum: int = 0
+        self.docChunkChecksum: List[int] = list()
+        self.docAssetChecksum: List[int] = list()
+
+    def hasChecksum(self) -> bool:
+        return self.version >= self.Version.V7 and self.checksum != self.Checksum.NoChecksum
 
     def toBytesIO(self, bos:BytesIO=None) -> BytesIO:
         bos = BytesIO() if bos is None else bos
+        fields = self.fieldsToBytesIO().getbuffer()
+        bos.write(fields)
+        # 最后是文件头其他部分的校验和
+        if self.hasChecksum():
+            bos.write(Checksums[self.checksum](fields).to_bytes(self.DocChecksumBytesLen, byteorder='big'))
+        return bos
+
+    def fieldsToBytesIO(self) -> BytesIO:
+        bos = BytesIO()
         blockCount = len(self.docInfoBlockLen)
         bos.write(blockCount.to_bytes(self.DocInfoBlockCountBytesLen, byteorder='big'))
-        bos.write(self.docType.to_bytes(self.DocTypeBytesLen, byteorder='big'))
+        # 文档类型的高字节记录文件版本，V1版本的文件高字节为0
+        version = 0 if self.version == self.Version.V1 else self.version
+        docType = (version << 8) | self.docType
+        bos.write(docType.to_bytes(self.DocTypeBytesLen, byteorder='big'))
         for blockLen in self.docInfoBlockLen:
             bos.write(blockLen.to_bytes(self.DocInfoBlockBytesLen, byteorder='big'))
         bos.write(self.docBodyLen.to_bytes(self.DocBodyBytesLen, byteorder='big'))
+        if self.version >= self.Version.V4:
+            bos.write(self.codec.to_bytes(self.DocCodecBytesLen, byteorder='big'))
+        if self.version >= self.Version.V3:
+            bos.write(len(self.docChunkLen).to_bytes(self.DocChunkCountBytesLen, byteorder='big'))
+            for chunkLen in self.docChunkLen:
+                bos.write(chunkLen.to_bytes(self.DocChunkBytesLen, byteorder='big'))
+        if self.version >= self.Version.V5:
+            bos.write(len(self.docAssetLen).to_bytes(self.DocAssetCountBytesLen, byteorder='big'))
+            for assetHash, assetLen in zip(self.docAssetHash, self.docAssetLen):
+                bos.write(bytes.fromhex(assetHash))
+                bos.write(assetLen.to_bytes(self.DocAssetBytesLen, byteorder='big'))
+        if self.version >= self.Version.V7:
+            bos.write(self.checksum.to_bytes(self.DocChecksumTypeBytesLen, byteorder='big'))
+        if self.hasChecksum():
+            if len(self.docChunkChecksum) != len(self.docChunkLen) or len(self.docAssetChecksum) != len(self.docAssetLen):
+                raise ValueError('校验和数量与正文分块、资源数量不一致')
+            bos.write(self.docInfoBlockChecksum.to_bytes(self.DocChecksumBytesLen, byteorder='big'))
+            for checksum in self.docChunkChecksum + self.docAssetChecksum:
+                bos.write(checksum.to_bytes(self.DocChecksumBytesLen, byteorder='big'))
         return bos
 
     @classmethod
     def fromBytes(cls, data: bytes) -> DocHeadType:
+        return cls.fromStream(BytesIO(data))
+
+    @classmethod
+    def fromStream(cls, bis, checkInfoBlockLen: bool = False) -> DocHeadType:
+        '''
+        信息块、分块和资源的数量不能超过剩余数据能容纳的数量，损坏或加密的文件不会按错误的数量循环读取。
+        checkInfoBlockLen为True时信息块也在bis中，信息块的长度之和不能超过剩余数据的长度
+        '''
         head = DocHead()
-        bis = BytesIO(data)
-        blockCount = readInt(cls.DocInfoBlockCountBytesLen, bis)
-        head.docType = readInt(cls.DocTypeBytesLen, bis)
+        position = bis.tell()
+        remaining = bis.seek(0, 2) - position
+        bis.seek(position)
+        infoBlockLen = 0
+
+        def readCount(countBytesLen: int, itemBytesLen: int, name: str) -> int:
+            count = readInt(countBytesLen, bis)
+            if count * itemBytesLen > remaining:
+                raise CorruptFileException('%s数量%d超出文件长度' % (name, count))
+            return count
+
+        blockCount = readCount(cls.DocInfoBlockCountBytesLen, cls.DocInfoBlockBytesLen, '信息块')
+        docType = readInt(cls.DocTypeBytesLen, bis)
+        head.docType = docType & 0xff
+        head.version = (docType >> 8) or cls.Version.V1
+        if head.version > cls.Version.Latest:
+            raise CorruptFileException('不支持的文件版本%d' % head.version)
         for index in range(blockCount):
             blockLen = readInt(cls.DocInfoBlockBytesLen, bis)
+            infoBlockLen += blockLen
+            if checkInfoBlockLen and infoBlockLen > remaining:
+                raise CorruptFileException('信息块长度超出文件长度')
             head.docInfoBlockLen.append(blockLen)
         head.docBodyLen = readInt(cls.DocBodyBytesLen, bis)
+        if head.version >= cls.Version.V4:
+            head.codec = readInt(cls.DocCodecBytesLen, bis)
+            if head.codec not in BodyCodecs:
+                raise CorruptFileException('不支持的压缩格式%d' % head.codec)
+        if head.version >= cls.Version.V3:
+            chunkCount = readCount(cls.DocChunkCountBytesLen, cls.DocChunkBytesLen, '正文分块')
+            for index in range(chunkCount):
+                chunkLen = readInt(cls.DocChunkBytesLen, bis)
+                head.docChunkLen.append(chunkLen)
+        elif head.docBodyLen > 0:
+            # 旧版本的正文作为一个分块
+            head.docChunkLen.append(head.docBodyLen)
+        if head.version >= cls.Version.V5:
+            assetCount = readCount(cls.DocAssetCountBytesLen, cls.DocAssetHashBytesLen + cls.DocAssetBytesLen, '资源')
+            for index in range(assetCount):
+                head.docAssetHash.append(bytes(readBytes(cls.DocAssetHashBytesLen, bis)).hex())
+                head.docAssetLen.append(readInt(cls.DocAssetBytesLen, bis))
+        head.checksum = cls.Checksum.NoChecksum
+        if head.version >= cls.Version.V7:
+            head.checksum = readInt(cls.DocChecksumTypeBytesLen, bis)
+            if head.checksum not in Checksums:
+                raise CorruptFileException('不支持的校验和格式%d' % head.checksum)
+        if head.hasChecksum():
+            head.docInfoBlockChecksum = readInt(cls.DocChecksumBytesLen, bis)
+            head.docChunkChecksum = [readInt(cls.DocChecksumBytesLen, bis) for index in head.docChunkLen]
+            head.docAssetChecksum = [readInt(cls.DocChecksumBytesLen, bis) for index in head.docAssetLen]
+            if readInt(cls.DocChecksumBytesLen, bis) != Checksums[head.checksum](head.fieldsToBytesIO().getbuffer()):
+                raise CorruptFileException('文件头校验和不一致')
         return head
 
     @staticmethod
@@ -89,11 +324,61 @@ class DocHead:
         return blockCount
 
     @staticmethod
-    def getHeadBlockBytesLen(blockCount:int):
-        return DocHead.DocInfoBlockCountBytesLen \
+    def getHeadBlockBytesLen(blockCount:int, chunkCount:int=0, assetCount:int=0, version:int=Version.Latest,
+                             checksum:int=Checksum.Crc32):
+        headLen = DocHead.DocInfoBlockCountBytesLen \
         + DocHead.DocTypeBytesLen \
         + blockCount * DocHead.DocInfoBlockBytesLen  \
-        + DocHead.DocBodyBytesLen  \
+        + DocHead.DocBodyBytesLen
+        if version >= DocHead.Version.V4:
+            headLen += DocHead.DocCodecBytesLen
+        if version >= DocHead.Version.V3:
+            headLen += DocHead.DocChunkCountBytesLen + chunkCount * DocHead.DocChunkBytesLen
+        if version >= DocHead.Version.V5:
+            headLen += DocHead.DocAssetCountBytesLen \
+                       + assetCount * (DocHead.DocAssetHashBytesLen + DocHead.DocAssetBytesLen)
+        if version >= DocHead.Version.V7:
+            headLen += DocHead.DocChecksumTypeBytesLen
+            if checksum != DocHead.Checksum.NoChecksum:
+                # 信息块、正文分块、资源和文件头的校验和
+                headLen += (2 + chunkCount + assetCount) * DocHead.DocChecksumBytesLen
+        return headLen
+
+    def getHeadBytesLen(self) -> int:
+        return self.getHeadBlockBytesLen(len(self.docInfoBlockLen), len(self.docChunkLen), len(self.docAssetLen),
+                                         self.version, self.checksum)
+
+    def getBodyOffset(self) -> int:
+        return self.getHeadBytesLen() + sum(self.docInfoBlockLen)
+
+    def getChunkOffset(self, index: int) -> int:
+        return self.getBodyOffset() + sum(self.docChunkLen[:index])
+
+    def getAssetOffset(self, index: int) -> int:
+        return self.getBodyOffset() + self.docBodyLen + sum(self.docAssetLen[:index])
+
+
+# 压缩格式 -> (压缩函数, 解压函数)，压缩和解压都以正文分块为单位
+BodyCodecs: Dict[int, Tuple[Callable, Callable]] = {
+    DocHead.Codec.Raw: (bytes, bytes),
+    DocHead.Codec.Zlib: (zlib.compress, zlib.decompress),
+    DocHead.Codec.Lzma: (lzma.compress, lzma.decompress),
+}
+
+
+def registerBodyCodec(codec: int, compress: Callable, decompress: Callable):
+    BodyCodecs[codec] = (compress, decompress)
+
+
+# 校验和格式 -> 计算函数，函数和zlib.crc32一样接受数据和上一段数据的校验和，可以分段计算
+Checksums: Dict[int, Callable] = {
+    DocHead.Checksum.NoChecksum: lambda data, value=0: 0,
+    DocHead.Checksum.Crc32: zlib.crc32,
+}
+
+
+def registerChecksum(checksum: int, update: Callable):
+    Checksums[checksum] = update
 
 
 class DocInfoBlock:
@@ -102,35 +387,266 @@ class DocInfoBlock:
 
     padData = b'\0'
 
+    # V2版本名称长度前缀的字节数
+    NameLenBytesLen = 2
+
     def __init__(self):
         self.name: bytes = None
         self.value: bytes = None
 
-    def toByteIO(self, bos:BytesIO=None) -> BytesIO:
+    def toByteIO(self, bos:BytesIO=None, version:int=DocHead.Version.Latest) -> BytesIO:
         bos = BytesIO() if bos is None else bos
-        bos.write(pad(self.name, self.nameLen, self.padData))
+        if version == DocHead.Version.V1:
+            bos.write(pad(self.name, self.nameLen, self.padData))
+        else:
+            if len(self.name) >= 1 << (8 * self.NameLenBytesLen):
+                raise ValueError('信息块名称过长：%d字节' % len(self.name))
+            bos.write(len(self.name).to_bytes(self.NameLenBytesLen, byteorder='big'))
+            bos.write(self.name)
         bos.write(self.value)
         return bos
 
-    def getByteLen(self):
-        return self.nameLen + len(self.value)
+    def getByteLen(self, version:int=DocHead.Version.Latest):
+        if version == DocHead.Version.V1:
+            return self.nameLen + len(self.value)
+        return self.NameLenBytesLen + len(self.name) + len(self.value)
 
     @classmethod
-    def fromBytes(cls, data: bytes) -> DocInfoBlockType:
+    def fromBytes(cls, data: bytes, version:int=DocHead.Version.Latest) -> DocInfoBlockType:
         bis = BytesIO(data)
         block = DocInfoBlock()
-        bName = readBytes(cls.nameLen, bis)
-        block.name = unpad(bName, cls.padData)
+        if version == DocHead.Version.V1:
+            bName = readBytes(cls.nameLen, bis)
+            block.name = unpad(bName, cls.padData)
+        else:
+            nameLen = readInt(cls.NameLenBytesLen, bis)
+            block.name = readBytes(nameLen, bis)
         block.value = bis.read()
         return block
 
 
+class DocInfoTable:
+    '''
+    按名称索引的信息块。读取时只解析名称，值在使用时才解码，没有修改的信息块保存时直接写入原数据
+    '''
+
+    def __init__(self):
+        # 每个信息块的原数据和原数据的版本，修改过的信息块原数据为None
+        self.raw: List[Optional[memoryview]] = list()
+        self.version: int = DocHead.Version.Latest
+        # 已经解码的信息块
+        self.blocks: List[Optional[DocInfoBlock]] = list()
+        # 名称 -> 位置，名称重复时为最后一个
+        self.index: Dict[bytes, int] = dict()
+
+    @classmethod
+    def fromBytes(cls, data, blockLens: List[int], version:int=DocHead.Version.Latest) -> DocInfoTableType:
+        '''
+        从连续保存的信息块中读取，data可以是memoryview，不复制数据
+        '''
+        table = DocInfoTable()
+        table.version = version
+        view = memoryview(data)
+        offset = 0
+        for blockLen in blockLens:
+            table.appendBytes(view[offset:offset + blockLen])
+            offset += blockLen
+        return table
+
+    @classmethod
+    def of(cls, blocks: Iterable[DocInfoBlock]) -> DocInfoTableType:
+        if isinstance(blocks, DocInfoTable):
+            return blocks
+        table = DocInfoTable()
+        for block in blocks:
+            table.append(block)
+        return table
+
+    def appendBytes(self, data):
+        data = memoryview(data)
+        if self.version == DocHead.Version.V1:
+            if len(data) < DocInfoBlock.nameLen:
+                raise CorruptFileException('信息块长度%d小于名称长度' % len(data))
+            name = unpad(data[:DocInfoBlock.nameLen], DocInfoBlock.padData)
+        else:
+            nameLen = int.from_bytes(data[:DocInfoBlock.NameLenBytesLen], byteorder='big')
+            if len(data) < DocInfoBlock.NameLenBytesLen + nameLen:
+                raise CorruptFileException('信息块长度%d小于名称长度' % len(data))
+            name = bytes(data[DocInfoBlock.NameLenBytesLen:DocInfoBlock.NameLenBytesLen + nameLen])
+        self.index[name] = len(self.raw)
+        self.raw.append(data)
+        self.blocks.append(None)
+
+    def append(self, block: DocInfoBlock):
+        self.index[block.name] = len(self.raw)
+        self.raw.append(None)
+        self.blocks.append(block)
+
+    def __len__(self) -> int:
+        return len(self.raw)
+
+    def __getitem__(self, index: int) -> DocInfoBlock:
+        block = self.blocks[index]
+        if block is None:
+            block = DocInfoBlock.fromBytes(self.raw[index], self.version)
+            self.blocks[index] = block
+            # 解码后的信息块可能被修改，保存时重新生成数据
+            self.raw[index] = None
+        return block
+
+    def __iter__(self) -> Iterator[DocInfoBlock]:
+        for index in range(len(self.raw)):
+            yield self[index]
+
+    def names(self) -> List[bytes]:
+        return list(self.index.keys())
+
+    def get(self, name: bytes) -> Optional[bytes]:
+        index = self.index.get(name)
+        if index is None:
+            return None
+        if self.blocks[index] is not None:
+            return self.blocks[index].value
+        # 不解码整个信息块，只复制值
+        raw = self.raw[index]
+        if self.version == DocHead.Version.V1:
+            return bytes(raw[DocInfoBlock.nameLen:])
+        return bytes(raw[DocInfoBlock.NameLenBytesLen + len(name):])
+
+    def set(self, name: bytes, value: bytes):
+        '''
+        修改或者增加一个信息块，其他信息块不变
+        '''
+        block = DocInfoBlock()
+        block.name = name
+        block.value = value
+        index = self.index.get(name)
+        if index is None:
+            self.append(block)
+        else:
+            self.raw[index] = None
+            self.blocks[index] = block
+
+    def blockBytes(self, version:int=DocHead.Version.Latest) -> Iterator:
+        '''
+        依次返回每个信息块保存的数据，版本相同时没有修改的信息块返回原数据
+        '''
+        for index, raw in enumerate(self.raw):
+            if raw is not None and version == self.version:
+                yield raw
+            else:
+                yield self[index].toByteIO(version=version).getbuffer()
+
+    def toByteIO(self, bos:BytesIO=None, version:int=DocHead.Version.Latest) -> List[int]:
+        '''
+        写入所有信息块，返回每个信息块的长度
+        '''
+        bos = BytesIO() if bos is None else bos
+        blockLens = list()
+        for data in self.blockBytes(version):
+            bos.write(data)
+            blockLens.append(len(data))
+        return blockLens
+
+    def copy(self) -> DocInfoTableType:
+        '''
+        复制信息块，原数据复制为bytes，不再引用读取的文件数据
+        '''
+        table = DocInfoTable()
+        table.version = self.version
+        table.raw = [None if raw is None else raw if isinstance(raw.obj, bytes) and raw.nbytes == len(raw.obj)
+                     else memoryview(bytes(raw)) for raw in self.raw]
+        table.blocks = list(self.blocks)
+        table.index = dict(self.index)
+        return table
+
+    def properties(self) -> 'DocProperties':
+        return DocProperties(self)
+
+
+class DocProperties(Mapping):
+    '''
+    以字符串读取信息块，只解码读取的属性
+    '''
+
+    def __init__(self, infoTable: DocInfoTable):
+        self.infoTable = infoTable
+
+    def __getitem__(self, name: str) -> str:
+        value = self.infoTable.get(name.encode('utf-8'))
+        if value is None:
+            raise KeyError(name)
+        return value.decode('utf-8')
+
+    def __iter__(self) -> Iterator[str]:
+        return (name.decode('utf-8') for name in self.infoTable.names())
+
+    def __len__(self) -> int:
+        return len(self.infoTable.index)
+
 
 class DocBody:
 
+    # 正文分块的目标大小，分块长度在chunkSize的1/2到2倍之间
+    chunkSize = 1 << 20
+
+    # 分块在换行处结束，保证每个分块都可以单独解码。是否在某一行结束由行尾内容决定，
+    # 修改文档时只有被修改的分块会变化，后面的分块保持不变
+    boundaryMask = 0xF
+    boundaryWindow = 32
+
+    lineEnd = re.compile(b'\n')
+
     def __init__(self):
         self.content: bytes = None
 
+    def getChunkLens(self) -> List[int]:
+        content = self.content
+        length = len(content)
+        chunkLens = list()
+        start = 0
+        while start < length:
+            end = self.findChunkEnd(content, start, length)
+            chunkLens.append(end - start)
+            start = end
+        return chunkLens
+
+    def findChunkEnd(self, content, start: int, length: int) -> int:
+        position = start + self.chunkSize // 2
+        maxEnd = start + self.chunkSize * 2
+        if position >= length:
+            return length
+        lastLineEnd = -1
+        view = memoryview(content)
+        while True:
+            match = self.lineEnd.search(content, position, min(maxEnd, length))
+            if match is None:
+                break
+            end = match.end()
+            if zlib.crc32(view[max(start, end - self.boundaryWindow):end]) & self.boundaryMask == 0:
+                return end
+            lastLineEnd = end
+            position = end
+        if maxEnd >= length:
+            return length
+        if lastLineEnd > 0:
+            return lastLineEnd
+        # 没有换行时在utf-8字符的边界结束
+        end = maxEnd
+        while end > start + 1 and content[end] & 0xC0 == 0x80:
+            end -= 1
+        return end
+
+    def getChunks(self, chunkLens: List[int] = None) -> List[memoryview]:
+        chunkLens = self.getChunkLens() if chunkLens is None else chunkLens
+        view = memoryview(self.content)
+        chunks = list()
+        offset = 0
+        for chunkLen in chunkLens:
+            chunks.append(view[offset:offset + chunkLen])
+            offset += chunkLen
+        return chunks
+
     def toByteIO(self, bos:BytesIO=None) -> BytesIO:
         bos = BytesIO() if bos is None else bos
         bos.write(self.content)
@@ -138,9 +654,8 @@ class DocBody:
 
     @classmethod
     def fromBytes(cls, data: bytes) -> DocBodyType:
-        bis = BytesIO(data)
         docBody = DocBody()
-        docBody.content = bis.read()
+        docBody.content = bytes(data)
         return docBody
 
 
@@ -148,27 +663,480 @@ class DocFile:
 
     def __init__(self):
         self.docHead:DocHead = None
-        self.docInfoBlock:List[DocInfoBlock] = None
+        # DocInfoTable，也可以是DocInfoBlock的列表
+        self.docInfoBlock: DocInfoTable = None
         self.docBody: DocBody = None
+        # sha256 -> 资源数据
+        self.docAssets: Dict[str, bytes] = dict()
+        # 从带有追加记录的文件中读取时的日志
+        self.docJournal: Optional[DocJournal] = None
 
     def toByteIO(self, bos:BytesIO=None) -> BytesIO:
         bos = BytesIO() if bos is None else bos
-        bos = self.docHead.toBytesIO(bos)
-        for info in self.docInfoBlock:
-            bos = info.toByteIO(bos)
-        bos = self.docBody.toByteIO(bos)
+        for buffer in self.toBuffers():
+            bos.write(buffer)
         return bos
 
+    def toBuffers(self) -> List[memoryview]:
+        '''
+        返回按顺序组成文件的数据段，不压缩时正文分块和资源都是原数据的memoryview，不复制数据
+        '''
+        if self.docHead.version < DocHead.Version.V3:
+            infos = BytesIO()
+            self.docHead.docInfoBlockLen = DocInfoTable.of(self.docInfoBlock).toByteIO(infos, self.docHead.version)
+            return [self.docHead.toBytesIO().getbuffer(), infos.getbuffer(), memoryview(self.docBody.content)]
+
+        return self.getBuffers(self.compressChunks(self.docBody.getChunks()))
+
+    def compressChunks(self, chunks: List[memoryview]) -> List[bytes]:
+        if self.docHead.codec != DocHead.Codec.Raw:
+            compress = BodyCodecs[self.docHead.codec][0]
+            chunks = [compress(chunk) for chunk in chunks]
+        return chunks
+
+    def getBuffers(self, chunks: List[bytes]) -> List[memoryview]:
+        '''
+        按已经压缩的正文分块更新文件头，返回文件头和信息块、正文分块、资源的数据段
+        '''
+        # 文件头记录的是保存在文件中（压缩后）的长度
+        self.docHead.docChunkLen = [len(chunk) for chunk in chunks]
+        self.docHead.docBodyLen = sum(self.docHead.docChunkLen)
+        if self.docHead.version >= DocHead.Version.V5:
+            self.docHead.docAssetHash = list(self.docAssets.keys())
+            self.docHead.docAssetLen = [len(asset) for asset in self.docAssets.values()]
+        infos = BytesIO()
+        self.docHead.docInfoBlockLen = DocInfoTable.of(self.docInfoBlock).toByteIO(infos, self.docHead.version)
+        if self.docHead.hasChecksum():
+            checksum = Checksums[self.docHead.checksum]
+            self.docHead.docInfoBlockChecksum = checksum(infos.getbuffer())
+            self.docHead.docChunkChecksum = [checksum(chunk) for chunk in chunks]
+            self.docHead.docAssetChecksum = [checksum(asset) for asset in self.docAssets.values()]
+        buffers = [self.docHead.toBytesIO().getbuffer(), infos.getbuffer()]
+        buffers.extend(memoryview(chunk) for chunk in chunks)
+        if self.docHead.version >= DocHead.Version.V5:
+            buffers.extend(memoryview(asset) for asset in self.docAssets.values())
+        return buffers
+
+    def writeTo(self, fd: int) -> int:
+        return writeBuffers(fd, self.toBuffers())
+
+    def save(self, path):
+        saveBuffers(path, self.toBuffers())
+
     @classmethod
     def fromBytes(cls, data: bytes) -> DocFileType:
-        bis = BytesIO(data)
+        return cls.fromStream(BytesIO(data))
+
+    @classmethod
+    def fromBuffer(cls, data) -> DocFileType:
+        '''
+        从bytes、bytearray等支持buffer协议的对象中读取文档，正文为原数据的memoryview，不复制数据
+        '''
+        return cls.fromStream(MemoryViewReader(data))
+
+    @classmethod
+    def fromStream(cls, bis) -> DocFileType:
+        '''
+        从文件对象中依次读取文件头、信息块和正文，正文只读取一次
+        '''
         df = DocFile()
-        infoBlockCount = DocHead.getDocInfoBlockCount(bis)
-        headLen = DocHead.getHeadBlockBytesLen(infoBlockCount)
-        df.docHead = DocHead.fromBytes(readBytes(headLen, bis))
-        df.docInfoBlock = list()
-        for infoLen in df.docHead.docInfoBlockLen:
-            infoBlock = DocInfoBlock.fromBytes(readBytes(infoLen, bis))
-            df.docInfoBlock.append(infoBlock)
-        df.docBody = DocBody.fromBytes(readBytes(df.docHead.docBodyLen, bis))
-        return df
\ No newline at end of file
+        df.docHead = DocHead.fromStream(bis)
+        df.docInfoBlock = cls.readInfoBlocks(df.docHead, bis)
+        if df.docHead.version >= DocHead.Version.V6:
+            journal = DocJournal.readRecords(bis, df.docHead)
+            if journal is not None:
+                journal.readDocFile(bis, df)
+                return df
+            bis.seek(df.docHead.getBodyOffset())
+        if sum(df.docHead.docChunkLen) != df.docHead.docBodyLen:
+            raise CorruptFileException('正文分块长度之和%d与正文长度%d不一致' % (sum(df.docHead.docChunkLen), df.docHead.docBodyLen))
+        df.docBody = DocBody()
+        if df.docHead.codec == DocHead.Codec.Raw:
+            df.docBody.content = readBytes(df.docHead.docBodyLen, bis)
+        else:
+            # 逐个分块读取并解压，不保留完整的压缩数据
+            decompress = BodyCodecs[df.docHead.codec][1]
+            df.docBody.content = b''.join([decompress(readBytes(chunkLen, bis)) for chunkLen in df.docHead.docChunkLen])
+        for assetHash, assetLen in zip(df.docHead.docAssetHash, df.docHead.docAssetLen):
+            df.docAssets[assetHash] = readBytes(assetLen, bis)
+        return df
+
+    @staticmethod
+    def readInfoBlocks(head: DocHead, bis) -> DocInfoTable:
+        return DocInfoTable.fromBytes(readBytes(sum(head.docInfoBlockLen), bis), head.docInfoBlockLen, head.version)
+
+    @staticmethod
+    def readChunk(bis, head: DocHead, index: int) -> bytes:
+        '''
+        根据文件头的分块表定位并读取一个正文分块，bis需要支持seek
+        '''
+        bis.seek(head.getChunkOffset(index))
+        chunk = readBytes(head.docChunkLen[index], bis)
+        if head.codec != DocHead.Codec.Raw:
+            chunk = BodyCodecs[head.codec][1](chunk)
+        return chunk
+
+    @staticmethod
+    def readAsset(bis, head: DocHead, index: int) -> bytes:
+        bis.seek(head.getAssetOffset(index))
+        return readBytes(head.docAssetLen[index], bis)
+
+    @classmethod
+    def open(cls, path, mmapThreshold:int=-1) -> DocFileType:
+        '''
+        读取文档，mmapThreshold不小于0且文件大小达到mmapThreshold时映射文件，正文为映射内存的memoryview
+        '''
+        if 0 <= mmapThreshold <= os.path.getsize(path) and os.path.getsize(path) > 0:
+            return cls.fromBuffer(mapFile(path))
+        with open(path, 'rb') as f:
+            return cls.fromStream(f)
+
+    # verify每次读取的数据大小
+    verifyBlockSize = 1 << 20
+
+    @classmethod
+    def verify(cls, path, threads:int=4):
+        '''
+        检查未加密文档的结构和校验和，不读取到内存中解码。信息块、正文分块和资源由多个线程并行读取，
+        有错误时抛出CorruptFileException，包含所有出错的部分。分块加密的文档只检查文件结构，见DocEnvelope.verify
+        '''
+        if isEnvelopeFile(path):
+            from .cipher import DocEnvelope
+            return DocEnvelope.verify(path)
+        if isEncryptedFile(path):
+            raise CorruptFileException('旧版本整体加密的文档不能检查结构')
+        with open(path, 'rb') as f:
+            head = DocHead.fromStream(f, checkInfoBlockLen=True)
+            fileLen = f.seek(0, 2)
+            journal = DocJournal.readRecords(f, head, DocJournal.Check.All) \
+                if head.version >= DocHead.Version.V6 else None
+        baseLen = head.getAssetOffset(len(head.docAssetLen))
+        if sum(head.docChunkLen) != head.docBodyLen:
+            raise CorruptFileException('正文分块长度之和%d与正文长度%d不一致' % (sum(head.docChunkLen), head.docBodyLen))
+        if baseLen > fileLen:
+            raise CorruptFileException('文件长度%d小于文件头记录的长度%d' % (fileLen, baseLen))
+        errors = list()
+        fileEnd = baseLen if journal is None else journal.fileLen
+        if fileEnd != fileLen:
+            errors.append('文件末尾%d字节的数据无效' % (fileLen - fileEnd))
+
+        if head.hasChecksum():
+            sections = [('信息块', head.getHeadBytesLen(), sum(head.docInfoBlockLen), head.docInfoBlockChecksum)]
+            offset = head.getBodyOffset()
+            for index, checksum in enumerate(head.docChunkChecksum):
+                sections.append(('正文分块%d' % index, offset, head.docChunkLen[index], checksum))
+                offset += head.docChunkLen[index]
+            for index, checksum in enumerate(head.docAssetChecksum):
+                sections.append(('资源%s' % head.docAssetHash[index], offset, head.docAssetLen[index], checksum))
+                offset += head.docAssetLen[index]
+            update = Checksums[head.checksum]
+
+            def verifySection(section):
+                name, offset, length, checksum = section
+                value = 0
+                with open(path, 'rb') as f:
+                    f.seek(offset)
+                    while length > 0:
+                        block = f.read(min(length, cls.verifyBlockSize))
+                        if not block:
+                            break
+                        value = update(block, value)
+                        length -= len(block)
+                return None if value == checksum else name + '校验和不一致'
+
+            with ThreadPoolExecutor(max_workers=threads) as executor:
+                errors.extend(error for error in executor.map(verifySection, sections) if error is not None)
+
+        if errors:
+            raise CorruptFileException('\n'.join(errors))
+
+    @classmethod
+    def readMetadata(cls, path) -> Dict[str, str]:
+        '''
+        只读取未加密文档的文件头和信息块，不读取正文，返回文档属性。加密的文档抛出CorruptFileException
+        '''
+        if isEncryptedFile(path):
+            raise CorruptFileException('加密的文档需要解密后才能读取属性')
+        with open(path, 'rb') as f:
+            head = DocHead.fromStream(f, checkInfoBlockLen=True)
+            infoBlocks = cls.readInfoBlocks(head, f)
+            if head.version >= DocHead.Version.V6:
+                # 只读取记录头和清单，不读取追加的数据
+                journal = DocJournal.readRecords(f, head, DocJournal.Check.Manifest)
+                if journal is not None:
+                    infoBlocks = journal.infoBlocks
+        return dict(infoBlocks.properties())
+
+
+
+class DocJournal:
+    '''
+    追加保存。文件开头是一个完整的文档，之后是追加的记录，每条记录包含新增的正文分块、新增的资源和当前文档的清单，
+    清单记录属性以及每个正文分块、资源在文件中的位置。保存时只追加变化的分块，日志超过一定大小后重写整个文件
+    记录格式：RecordMagic | 数据长度 | 清单长度 | 数据的crc32 | 清单的crc32 | 数据 | 清单
+    数据和清单分别校验，只读取属性时跳过数据，只读取记录头和清单
+    旧的记录格式：LegacyRecordMagic | 数据长度 | 清单长度 | 数据 | 清单 | 数据和清单的crc32，只读取不再写入
+    '''
+
+    class Check:
+        # 只检查清单，不读取数据
+        Manifest = 0
+        # 检查最后一条记录的数据，之前的记录在追加下一条记录之前已经同步到磁盘
+        LastRecord = 1
+        # 检查所有记录的数据
+        All = 2
+
+    RecordMagic = b'EWJS'
+    LegacyRecordMagic = b'EWJR'
+    DataBytesLen = 7
+    ManifestBytesLen = 5
+    CrcBytesLen = 4
+    CountBytesLen = 4
+    OffsetBytesLen = 7
+    ChunkHashBytesLen = 16
+    RecordHeadBytesLen = len(RecordMagic) + DataBytesLen + ManifestBytesLen + CrcBytesLen * 2
+    LegacyRecordHeadBytesLen = len(LegacyRecordMagic) + DataBytesLen + ManifestBytesLen
+
+    # 追加的记录超过完整文档大小的比例后重写整个文件
+    compactRatio = 1.0
+
+    def __init__(self):
+        self.codec: int = DocHead.Codec.Raw
+        self.baseLen = 0
+        self.fileLen = 0
+        # 文件中已有的正文分块，分块hash -> (位置, 长度)
+        self.chunkExtents: Dict[bytes, Tuple[int, int]] = dict()
+        # 文件中已有的资源，sha256 -> (位置, 长度)
+        self.assetExtents: Dict[str, Tuple[int, int]] = dict()
+        # 最后一条记录的清单
+        self.infoBlocks: DocInfoTable = DocInfoTable()
+        self.chunks: List[Tuple[bytes, int, int]] = list()
+        self.assets: List[Tuple[str, int, int]] = list()
+
+    @classmethod
+    def chunkHash(cls, chunk) -> bytes:
+        return hashlib.blake2b(chunk, digest_size=cls.ChunkHashBytesLen).digest()
+
+    def getJournalLen(self) -> int:
+        return self.fileLen - self.baseLen
+
+    def canAppend(self, path, docFile: DocFile) -> bool:
+        if docFile.docHead.codec != self.codec:
+            return False
+        if self.getJournalLen() > self.baseLen * self.compactRatio:
+            return False
+        # 文件被其他程序修改过
+        return os.path.getsize(path) == self.fileLen
+
+    @classmethod
+    def write(cls, path, docFile: DocFile) -> DocJournalType:
+        '''
+        重写整个文件，写入完整的文档和一条只有清单的记录
+        '''
+        docFile.docHead.version = max(docFile.docHead.version, DocHead.Version.V6)
+        rawChunks = docFile.docBody.getChunks()
+        chunks = docFile.compressChunks(rawChunks)
+        buffers = docFile.getBuffers(chunks)
+        journal = DocJournal()
+        journal.codec = docFile.docHead.codec
+        journal.baseLen = sum(buffer.nbytes for buffer in buffers)
+        offset = docFile.docHead.getBodyOffset()
+        for rawChunk, chunk in zip(rawChunks, chunks):
+            journal.chunkExtents[cls.chunkHash(rawChunk)] = (offset, len(chunk))
+            offset += len(chunk)
+        for assetHash, asset in docFile.docAssets.items():
+            journal.assetExtents[assetHash] = (offset, len(asset))
+            offset += len(asset)
+        tempPath = str(path) + '.tmp'
+        with open(tempPath, 'wb') as f:
+            writeBuffers(f.fileno(), buffers)
+            journal.fileLen = journal.baseLen
+            journal.appendRecord(f, docFile, rawChunks)
+        os.replace(tempPath, path)
+        return journal
+
+    def append(self, path, docFile: DocFile):
+        with open(path, 'r+b') as f:
+            self.appendRecord(f, docFile, docFile.docBody.getChunks())
+
+    def appendRecord(self, f, docFile: DocFile, rawChunks: List[memoryview]):
+        compress = BodyCodecs[self.codec][0]
+        position = self.fileLen + self.RecordHeadBytesLen
+        data = list()
+        chunkExtents = dict()
+        chunks = list()
+        for rawChunk in rawChunks:
+            chunkHash = self.chunkHash(rawChunk)
+            extent = self.chunkExtents.get(chunkHash, chunkExtents.get(chunkHash))
+            if extent is None:
+                chunk = compress(rawChunk)
+                extent = (position, len(chunk))
+                chunkExtents[chunkHash] = extent
+                data.append(chunk)
+                position += len(chunk)
+            chunks.append((chunkHash,) + extent)
+        assetExtents = dict()
+        assets = list()
+        for assetHash, asset in docFile.docAssets.items():
+            extent = self.assetExtents.get(assetHash)
+            if extent is None:
+                extent = (position, len(asset))
+                assetExtents[assetHash] = extent
+                data.append(asset)
+                position += len(asset)
+            assets.append((assetHash,) + extent)
+        manifest = self.manifestToBytes(docFile.docInfoBlock, chunks, assets)
+        dataLen = position - self.fileLen - self.RecordHeadBytesLen
+        crc = 0
+        for d in data:
+            crc = zlib.crc32(d, crc)
+        f.seek(self.fileLen)
+        f.write(self.RecordMagic)
+        f.write(dataLen.to_bytes(self.DataBytesLen, byteorder='big'))
+        f.write(len(manifest).to_bytes(self.ManifestBytesLen, byteorder='big'))
+        f.write(crc.to_bytes(self.CrcBytesLen, byteorder='big'))
+        f.write(zlib.crc32(manifest).to_bytes(self.CrcBytesLen, byteorder='big'))
+        for d in data:
+            f.write(d)
+        f.write(manifest)
+        f.truncate()
+        f.flush()
+        os.fsync(f.fileno())
+        self.fileLen = f.tell()
+        self.chunkExtents.update(chunkExtents)
+        self.assetExtents.update(assetExtents)
+        self.infoBlocks = DocInfoTable.of(docFile.docInfoBlock)
+        self.chunks = chunks
+        self.assets = assets
+
+    @classmethod
+    def manifestToBytes(cls, infoBlocks: DocInfoTable, chunks: List[Tuple[bytes, int, int]],
+                        assets: List[Tuple[str, int, int]]) -> bytes:
+        bos = BytesIO()
+        infoBlocks = DocInfoTable.of(infoBlocks)
+        bos.write(len(infoBlocks).to_bytes(cls.CountBytesLen, byteorder='big'))
+        for data in infoBlocks.blockBytes():
+            bos.write(len(data).to_bytes(DocHead.DocInfoBlockBytesLen, byteorder='big'))
+            bos.write(data)
+        bos.write(len(chunks).to_bytes(cls.CountBytesLen, byteorder='big'))
+        for chunkHash, offset, chunkLen in chunks:
+            bos.write(chunkHash)
+            bos.write(offset.to_bytes(cls.OffsetBytesLen, byteorder='big'))
+            bos.write(chunkLen.to_bytes(DocHead.DocChunkBytesLen, byteorder='big'))
+        bos.write(len(assets).to_bytes(cls.CountBytesLen, byteorder='big'))
+        for assetHash, offset, assetLen in assets:
+            bos.write(bytes.fromhex(assetHash))
+            bos.write(offset.to_bytes(cls.OffsetBytesLen, byteorder='big'))
+            bos.write(assetLen.to_bytes(DocHead.DocAssetBytesLen, byteorder='big'))
+        return bos.getvalue()
+
+    def readManifest(self, data: bytes):
+        bis = BytesIO(data)
+        self.infoBlocks = DocInfoTable()
+        for index in range(readInt(self.CountBytesLen, bis)):
+            infoLen = readInt(DocHead.DocInfoBlockBytesLen, bis)
+            self.infoBlocks.appendBytes(readBytes(infoLen, bis))
+        self.chunks = list()
+        for index in range(readInt(self.CountBytesLen, bis)):
+            chunkHash = readBytes(self.ChunkHashBytesLen, bis)
+            extent = (readInt(self.OffsetBytesLen, bis), readInt(DocHead.DocChunkBytesLen, bis))
+            self.chunkExtents[chunkHash] = extent
+            self.chunks.append((chunkHash,) + extent)
+        self.assets = list()
+        for index in range(readInt(self.CountBytesLen, bis)):
+            assetHash = readBytes(DocHead.DocAssetHashBytesLen, bis).hex()
+            extent = (readInt(self.OffsetBytesLen, bis), readInt(DocHead.DocAssetBytesLen, bis))
+            self.assetExtents[assetHash] = extent
+            self.assets.append((assetHash,) + extent)
+
+    @classmethod
+    def readRecords(cls, bis, head: DocHead, check: int = Check.LastRecord) -> Optional[DocJournalType]:
+        '''
+        读取完整文档之后的所有记录，没有完整的记录时返回None。最后一条记录写入不完整时忽略这条记录。
+        check为Check.Manifest时只读取记录头和清单，不读取数据
+        '''
+        journal = DocJournal()
+        journal.codec = head.codec
+        journal.baseLen = head.getAssetOffset(len(head.docAssetLen))
+        journal.fileLen = journal.baseLen
+        fileLen = bis.seek(0, 2)
+        # (数据位置, 数据长度, 数据的crc32, 清单, 记录结束的位置)，数据已经检查过的crc32为None
+        records = list()
+        recordStart = journal.baseLen
+        while recordStart + cls.LegacyRecordHeadBytesLen <= fileLen:
+            bis.seek(recordStart)
+            magic = bytes(bis.read(len(cls.RecordMagic)))
+            if magic not in (cls.RecordMagic, cls.LegacyRecordMagic):
+                break
+            dataLen = readInt(cls.DataBytesLen, bis)
+            manifestLen = readInt(cls.ManifestBytesLen, bis)
+            if magic == cls.LegacyRecordMagic:
+                recordEnd = recordStart + cls.LegacyRecordHeadBytesLen + dataLen + manifestLen + cls.CrcBytesLen
+                if recordEnd > fileLen:
+                    break
+                # 旧格式的数据和清单共用crc32，需要读取数据
+                crc = cls.dataCrc(bis, dataLen)
+                manifest = readBytes(manifestLen, bis)
+                if zlib.crc32(manifest, crc) != readInt(cls.CrcBytesLen, bis):
+                    break
+                records.append((recordStart + cls.LegacyRecordHeadBytesLen, dataLen, None, manifest, recordEnd))
+            else:
+                recordEnd = recordStart + cls.RecordHeadBytesLen + dataLen + manifestLen
+                if recordEnd > fileLen:
+                    break
+                dataCrc = readInt(cls.CrcBytesLen, bis)
+                manifestCrc = readInt(cls.CrcBytesLen, bis)
+                dataOffset = recordStart + cls.RecordHeadBytesLen
+                bis.seek(dataOffset + dataLen)
+                manifest = readBytes(manifestLen, bis)
+                if zlib.crc32(manifest) != manifestCrc:
+                    break
+                if check == cls.Check.All:
+                    bis.seek(dataOffset)
+                    if cls.dataCrc(bis, dataLen) != dataCrc:
+                        break
+                    dataCrc = None
+                records.append((dataOffset, dataLen, dataCrc, manifest, recordEnd))
+            recordStart = recordEnd
+        if check == cls.Check.LastRecord:
+            # 最后一条记录的数据可能没有写入磁盘
+            while records and records[-1][2] is not None:
+                dataOffset, dataLen, dataCrc, manifest, recordEnd = records[-1]
+                bis.seek(dataOffset)
+                if cls.dataCrc(bis, dataLen) == dataCrc:
+                    break
+                records.pop()
+        if not records:
+            return None
+        for dataOffset, dataLen, dataCrc, manifest, recordEnd in records:
+            journal.readManifest(manifest)
+        journal.fileLen = records[-1][4]
+        return journal
+
+    @staticmethod
+    def dataCrc(bis, dataLen: int) -> int:
+        crc = 0
+        remain = dataLen
+        while remain > 0:
+            block = readBytes(min(remain, DocBody.chunkSize), bis)
+            crc = zlib.crc32(block, crc)
+            remain -= len(block)
+        return crc
+
+    def readDocFile(self, bis, df: DocFile):
+        '''
+        按照最后一条记录的清单读取属性、正文和资源
+        '''
+        decompress = BodyCodecs[self.codec][1]
+        content = list()
+        for chunkHash, offset, chunkLen in self.chunks:
+            bis.seek(offset)
+            content.append(decompress(readBytes(chunkLen, bis)))
+        df.docInfoBlock = self.infoBlocks
+        df.docBody = DocBody()
+        df.docBody.content = b''.join(content)
+        df.docAssets = dict()
+        for assetHash, offset, assetLen in self.assets:
+            bis.seek(offset)
+            df.docAssets[assetHash] = readBytes(assetLen, bis)
+        df.docJournal = self
@@ -0,0 +1,378 @@
+import mmap
+import threading
+import traceback
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+import keymanager.encryptor
+from keymanager.key import decrypt_data
+from PySide6.QtCore import QObject, QRunnable, QThreadPool, Signal
+from PySide6.QtGui import QFont, QTextDocument, QTextOption
+
+from .assets import ImageInfo, ImageScalePolicy, prepareImage, readImageInfos
+from .cipher import DocEnvelope, KeyContext
+from .doc import DocFile, DocJournal, DocProperties, DocInfoTable, mapFile
+
+
+class Task(QRunnable):
+
+    def __init__(self, func: Callable):
+        super().__init__()
+        self.func = func
+
+    def run(self):
+        self.func()
+
+
+class LoadResult:
+
+    def __init__(self):
+        self.filename = ''
+        self.isEncryptDocument = False
+        self.html: str = ''
+        self.properties: DocProperties = None
+        self.assets: Dict[str, bytes] = dict()
+        self.imageInfos: Dict[str, ImageInfo] = dict()
+        self.docJournal: Optional[DocJournal] = None
+        self.docEnvelope: Optional[DocEnvelope] = None
+
+
+class DocLoader(QObject):
+    '''
+    在线程池中打开文档，文件只读取一次。读取后通过detected通知是否加密，
+    准备好密钥后调用decode解密、解析文档和解码正文，完成后通过loaded返回LoadResult，GUI线程只需要设置文档内容
+    '''
+
+    progress = Signal(int, str)
+    detected = Signal(bool)
+    loaded = Signal(object)
+    failed = Signal(str, str)
+
+    # 读取文件时每次读取的大小
+    readBlockSize = 4 << 20
+
+    def __init__(self, filename: str, textEdit, mmapThreshold: int = -1, parent=None):
+        super().__init__(parent)
+        self.filename = filename
+        self.textEdit = textEdit
+        self.mmapThreshold = mmapThreshold
+        self.content = None
+        self.isEncryptDocument = False
+        # 分块加密的文档在解密时才读取文件
+        self.isEnvelope = False
+
+    def start(self):
+        QThreadPool.globalInstance().start(Task(self.read))
+
+    def decode(self, key: Optional[bytes]):
+        QThreadPool.globalInstance().start(Task(lambda: self.parse(key)))
+
+    def read(self):
+        try:
+            with open(self.filename, 'rb') as f:
+                self.isEnvelope = DocEnvelope.isEnvelope(f.read(len(DocEnvelope.Magic)))
+            if self.isEnvelope:
+                self.isEncryptDocument = True
+                return self.detected.emit(True)
+            size = Path(self.filename).stat().st_size
+            if 0 <= self.mmapThreshold <= size and size > 0:
+                # 大文件映射到内存，只有解码正文时读取的页面会载入
+                self.content = mapFile(self.filename)
+            else:
+                self.content = self.readFile(size)
+            self.isEncryptDocument = keymanager.encryptor.is_encrypt_data(self.content)
+        except Exception as e:
+            self.content = None
+            traceback.print_exc()
+            return self.failed.emit('错误', '无法读取文件\n' + str(e))
+        self.detected.emit(self.isEncryptDocument)
+
+    def readFile(self, size: int) -> bytearray:
+        content = bytearray(size)
+        view = memoryview(content)
+        position = 0
+        with open(self.filename, 'rb', buffering=0) as f:
+            while position < size:
+                length = f.readinto(view[position:position + self.readBlockSize])
+                if not length:
+                    break
+                position += length
+                self.progress.emit(position * 40 // size, '正在读取文件')
+        del view
+        if position < size:
+            del content[position:]
+        return content
+
+    def parse(self, key: Optional[bytes]):
+        result = LoadResult()
+        result.filename = self.filename
+        result.isEncryptDocument = self.isEncryptDocument
+        content, self.content = self.content, None
+        try:
+            if self.isEncryptDocument:
+                self.progress.emit(40, '正在解密')
+                if self.isEnvelope:
+                    # 逐个分块读取到结果中解密，内存中不同时保存密文和明文
+                    content, result.docEnvelope = DocEnvelope.decryptFile(
+                        key, self.filename,
+                        progress=lambda position, total: self.progress.emit(40 + position * 20 // total, '正在解密'))
+                else:
+                    # 旧版本整体加密的文档，映射的文件需要先读取为bytes再解密
+                    content = decrypt_data(key, content[:] if isinstance(content, mmap.mmap) else content)
+            self.progress.emit(60, '正在解析文档')
+            docFile = DocFile.fromBuffer(content)
+            self.progress.emit(80, '正在解码正文')
+            result.html, result.properties, result.assets = self.textEdit.docfromDocFile(docFile)
+            result.imageInfos = readImageInfos(result.assets)
+            result.docJournal = None if self.isEncryptDocument else docFile.docJournal
+            # 释放正文的memoryview，映射的文件随之关闭，之后保存时才能修改文件
+            docFile = None
+            content = None
+        except Exception as e:
+            traceback.print_exc()
+            return self.failed.emit('错误', '文件损坏或密钥不匹配\n' + str(e))
+        self.progress.emit(100, '正在显示文档')
+        self.loaded.emit(result)
+
+    def cancel(self):
+        self.content = None
+
+
+class SaveSnapshot:
+    '''
+    保存时在GUI线程中记录的文档内容，之后在线程池中生成和写入文件
+    '''
+
+    def __init__(self):
+        self.filename = ''
+        self.html: str = ''
+        self.properties: Dict[str, str] = dict()
+        self.codec = 0
+        self.assets: Dict[str, bytes] = dict()
+        self.docInfoTable: DocInfoTable = None
+        self.isEncryptDocument = False
+        # 保存时才使用的密钥，写入完成后清除
+        self.key: Optional[bytes] = None
+        self.keyFingerprint = bytes()
+        # 未加密文档追加保存时使用的日志，None表示重写整个文件
+        self.docJournal: Optional[DocJournal] = None
+        self.journalSave = False
+        # 加密文档只加密变化的分块时使用，None表示重写整个文件
+        self.docEnvelope: Optional[DocEnvelope] = None
+        # 用来判断保存之后文档是否又发生了变化
+        self.documentId = 0
+        self.revision = 0
+
+
+class SaveResult:
+
+    def __init__(self, snapshot: SaveSnapshot):
+        self.snapshot = snapshot
+        self.docJournal: Optional[DocJournal] = None
+        self.docEnvelope: Optional[DocEnvelope] = None
+        self.error: Optional[str] = None
+
+
+class DocSaver(QObject):
+    '''
+    在单线程的线程池中保存文档。保存还没有开始时再次保存只写入最新的快照，文件写入并同步到磁盘后保存SaveResult，
+    再通过saved通知GUI线程用takeResults取走。waitForDone直接返回结果，不需要处理事件队列
+    '''
+
+    progress = Signal(int, str)
+    saved = Signal()
+
+    def __init__(self, textEdit, parent=None):
+        super().__init__(parent)
+        self.textEdit = textEdit
+        self.pool = QThreadPool(self)
+        self.pool.setMaxThreadCount(1)
+        self.lock = threading.Lock()
+        self.pending: Optional[SaveSnapshot] = None
+        self.results: List[SaveResult] = list()
+        self.taskCount = 0
+
+    def save(self, snapshot: SaveSnapshot):
+        with self.lock:
+            self.pending = snapshot
+            self.taskCount += 1
+        self.pool.start(Task(self.run))
+
+    def isSaving(self) -> bool:
+        with self.lock:
+            return self.taskCount > 0
+
+    def takeResults(self) -> List[SaveResult]:
+        '''
+        返回还没有取走的保存结果，每个结果只返回一次
+        '''
+        with self.lock:
+            results, self.results = self.results, list()
+        return results
+
+    def waitForDone(self) -> List[SaveResult]:
+        '''
+        等待保存完成并返回结果，之后收到的saved通知不会再返回这些结果
+        '''
+        self.pool.waitForDone()
+        return self.takeResults()
+
+    def run(self):
+        with self.lock:
+            snapshot, self.pending = self.pending, None
+        try:
+            # 已经被之前的任务保存
+            if snapshot is not None:
+                result = self.write(snapshot)
+                with self.lock:
+                    self.results.append(result)
+                self.saved.emit()
+        finally:
+            with self.lock:
+                self.taskCount -= 1
+
+    def write(self, snapshot: SaveSnapshot) -> SaveResult:
+        result = SaveResult(snapshot)
+        try:
+            self.progress.emit(10, '正在生成文档')
+            docFile = self.textEdit.docToDocFile(snapshot.html, snapshot.properties, snapshot.codec,
+                                                 snapshot.assets, snapshot.docInfoTable)
+            # 正文已经编码为docFile中的bytes，不再保留html
+            snapshot.html = ''
+            if snapshot.isEncryptDocument:
+                self.progress.emit(40, '正在加密')
+                progress = lambda position, total: self.progress.emit(40 + position * 60 // total, '正在加密')
+                if snapshot.docEnvelope is not None and snapshot.docEnvelope.canUpdate(snapshot.filename, snapshot.key):
+                    # 只加密和写入变化的分块
+                    snapshot.docEnvelope.update(snapshot.key, snapshot.filename, docFile.toBuffers(), progress=progress)
+                    result.docEnvelope = snapshot.docEnvelope
+                else:
+                    # 分块加密后直接写入文件，内存中只有正在加密的分块的密文
+                    result.docEnvelope = DocEnvelope.encryptToFile(snapshot.key, snapshot.filename,
+                                                                   docFile.toBuffers(), progress=progress)
+            elif not snapshot.journalSave:
+                self.progress.emit(70, '正在写入文件')
+                docFile.save(snapshot.filename)
+            elif snapshot.docJournal is not None and snapshot.docJournal.canAppend(snapshot.filename, docFile):
+                # 只追加变化的正文分块和资源
+                self.progress.emit(70, '正在写入文件')
+                snapshot.docJournal.append(snapshot.filename, docFile)
+                result.docJournal = snapshot.docJournal
+            else:
+                self.progress.emit(70, '正在写入文件')
+                result.docJournal = DocJournal.write(snapshot.filename, docFile)
+            self.progress.emit(100, '保存完毕')
+        except Exception as e:
+            traceback.print_exc()
+            result.error = str(e)
+        finally:
+            snapshot.key = None
+        return result
+
+
+class DocLocker(QObject):
+    '''
+    加密锁定时在线程池中把GUI线程序列化的正文和资源打包并加密，解锁时在线程池中解密并生成新的文档，
+    GUI线程只需要替换编辑器中的文档，新文档由编辑器分步排版。锁定和解锁按顺序在同一个线程中进行，
+    解锁总是排在之前的锁定之后，完成后通过locked、unlocked返回，lockId用来忽略已经取消的锁定和解锁
+    '''
+
+    progress = Signal(int, str)
+    locked = Signal(int, object)
+    unlocked = Signal(int, object, object)
+    failed = Signal(int, str, str)
+
+    def __init__(self, textEdit, parent=None):
+        super().__init__(parent)
+        self.textEdit = textEdit
+        self.pool = QThreadPool(self)
+        self.pool.setMaxThreadCount(1)
+
+    def lock(self, lockId: int, html: str, assets: Dict[str, bytes], key: bytes):
+        '''
+        html和assets是GUI线程中的快照，线程池中不访问编辑器中的文档
+        '''
+        self.pool.start(Task(lambda: self.encrypt(lockId, html, assets, key)))
+
+    def unlock(self, lockId: int, data: bytes, key: bytes, font: QFont, margin: float, option: QTextOption):
+        self.pool.start(Task(lambda: self.decrypt(lockId, data, key, font, margin, option)))
+
+    def encrypt(self, lockId: int, html: str, assets: Dict[str, bytes], key: bytes):
+        try:
+            self.progress.emit(10, '正在锁定文档')
+            docFile = self.textEdit.docToDocFile(html, dict(), assets=assets, docInfoTable=DocInfoTable())
+            html = None
+            assets = None
+            self.progress.emit(50, '正在加密')
+            data = b''.join(DocEnvelope.encrypt(key, docFile.toBuffers()))
+            docFile = None
+        except Exception as e:
+            traceback.print_exc()
+            return self.failed.emit(lockId, '错误', '锁定文档失败\n' + str(e))
+        finally:
+            # 锁定期间内存中不保留派生的密钥
+            KeyContext.evict(key)
+        self.progress.emit(100, '已锁定')
+        self.locked.emit(lockId, data)
+
+    def decrypt(self, lockId: int, data: bytes, key: bytes, font: QFont, margin: float, option: QTextOption):
+        try:
+            self.progress.emit(10, '正在解密')
+            # 正文直接从解密的数据中解码，不再复制一次
+            html, properties, assets = self.textEdit.docfromDocFile(DocFile.fromBuffer(DocEnvelope.decrypt(key, data)))
+            self.progress.emit(50, '正在解析文档')
+            # 在线程池中解析，排版在设置到编辑器之后由GUI线程分步进行
+            document = QTextDocument()
+            document.setDefaultFont(font)
+            document.setDocumentMargin(margin)
+            document.setDefaultTextOption(option)
+            document.setHtml(html)
+            document.setModified(False)
+            html = None
+            document.moveToThread(self.thread())
+        except Exception as e:
+            traceback.print_exc()
+            return self.failed.emit(lockId, '错误', '解锁文档失败\n' + str(e))
+        self.progress.emit(100, '正在显示文档')
+        self.unlocked.emit(lockId, document, assets)
+
+
+class ImageIngestor(QObject):
+    '''
+    插入多个图片文件时在线程池中并行读取、解码、缩小和编码，每个图片完成后保存(ingestId, index, result)，
+    再通过ingested通知GUI线程用takeResults取走，不能读取或解码时result为None，ingestId区分不同批次的插入
+    '''
+
+    ingested = Signal()
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.pool = QThreadPool(self)
+        self.lock = threading.Lock()
+        self.results: List[Tuple[int, int, object]] = list()
+
+    def ingest(self, ingestId: int, filenames: List[str], policy: ImageScalePolicy):
+        for index, filename in enumerate(filenames):
+            self.pool.start(Task(lambda index=index, filename=filename: self.load(ingestId, index, filename, policy)))
+
+    def takeResults(self) -> List[Tuple[int, int, object]]:
+        with self.lock:
+            results, self.results = self.results, list()
+        return results
+
+    def waitForDone(self) -> List[Tuple[int, int, object]]:
+        '''
+        等待所有图片处理完成并返回结果，之后收到的ingested通知不会再返回这些结果
+        '''
+        self.pool.waitForDone()
+        return self.takeResults()
+
+    def load(self, ingestId: int, index: int, filename: str, policy: ImageScalePolicy):
+        result = None
+        try:
+            result = prepareImage(Path(filename).read_bytes(), policy)
+        except Exception:
+            traceback.print_exc()
+        with self.lock:
+            self.results.append((ingestId, index, result))
+        self.ingested.emit()
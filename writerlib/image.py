@@ -1,4 +1,3 @@
-import base64
 import time
 from typing import List, Union
 
@@ -24,18 +23,19 @@ class Image(QDialog):
 
         self.imageFormat = imageFormat
 
-        self.rawImage = Image.retriveRawImage(self.imageFormat)
-        self.imageRatio = self.rawImage.width() / self.rawImage.height()
+        # 只读取图片头得到原始宽高，不解码图片
+        info = parent.text.getImageInfo(self.imageFormat.name())
+        if info is not None:
+            self.imageRatio = info.ratio()
+        else:
+            rawImage = Image.retriveRawImage(self.imageFormat, parent.text)
+            self.imageRatio = rawImage.width() / rawImage.height()
 
         self.initUI()
 
     @staticmethod
-    def retriveRawImage(imageFormat:QTextImageFormat):
-        base64data = imageFormat.name()[22:]
-        imageData = base64.b64decode(base64data.encode('utf-8'))
-        i = QImage()
-        i.loadFromData(imageData)
-        return i
+    def retriveRawImage(imageFormat:QTextImageFormat, textEdit:TextEdit):
+        return textEdit.getImage(imageFormat.name())
  
     def initUI(self):
 
@@ -212,7 +212,8 @@ class CameraListDialog(QDialog):
 
 
     def insertImageToEditor(self, image: QImage):
-        self._parentWidget.dropImage(image)
+        settings: Settings = self._parentWidget._parentWidget.systemSetting
+        self._parentWidget.dropImage(image, settings.cameraImageFormat, settings.cameraImageQuality)
         self.hide()
 
     def getCameraByIndex(self, index):
@@ -15,6 +15,13 @@ SETTING_FILE_BACKUP = './config/settings.json.backup'
 
 class Settings:
 
+    # 锁定文档的方式。encrypt加密文档内容后释放原文档，锁定时要序列化整个文档，解锁时要解密并重新解析，
+    # 所需时间随文档大小增加，撤销记录不保留；加密完成之前解锁时直接放回原文档。
+    # detach把文档从编辑器中移除，锁定和解锁的时间与文档大小无关并保留撤销记录，但锁定期间内容以明文保留在内存中
+    LockModes = {'encrypt': '加密文档内容（大文档锁定和解锁较慢）', 'detach': '移除文档（立即锁定和解锁，保留撤销记录，不加密）'}
+    # 摄像头拍摄的图片的编码格式，默认PNG无损保存，JPEG和WebP需要用户选择
+    CameraImageFormats = {'PNG': 'PNG（无损）', 'JPEG': 'JPEG', 'WEBP': 'WebP'}
+
     def __init__(self) -> None:
         self.d: [dict[str, str]] = dict()
         self.read()
@@ -38,6 +45,26 @@ class Settings:
             self.d['resetTimeoutOnSelect'] = True
         if 'webcam' not in self.d:
             self.d['webcam'] = {}
+        if 'bodyCodec' not in self.d:
+            self.d['bodyCodec'] = 'zlib'
+        if 'journalSave' not in self.d:
+            self.d['journalSave'] = 'True'
+        if 'mmapOpenSize' not in self.d:
+            self.d['mmapOpenSize'] = 64
+        if 'backgroundSave' not in self.d:
+            self.d['backgroundSave'] = 'True'
+        if 'lockMode' not in self.d:
+            self.d['lockMode'] = 'encrypt'
+        if 'cameraImageFormat' not in self.d:
+            self.d['cameraImageFormat'] = 'PNG'
+        if 'cameraImageQuality' not in self.d:
+            self.d['cameraImageQuality'] = 90
+        if 'imageMaxSize' not in self.d:
+            self.d['imageMaxSize'] = 2560
+        if 'imageMaxBytes' not in self.d:
+            self.d['imageMaxBytes'] = 0
+        if 'keepOriginalImage' not in self.d:
+            self.d['keepOriginalImage'] = 'True'
 
     def _makeDir(self) -> None:
         folder = Path(SETTING_FILE).parent
@@ -78,6 +105,102 @@ class Settings:
     def resetTimeoutOnSelect(self, reset: bool):
         self.d['resetTimeoutOnSelect'] = 'True' if reset else 'False'
 
+    @property
+    def bodyCodec(self) -> str:
+        return self.d['bodyCodec']
+
+    @bodyCodec.setter
+    def bodyCodec(self, codec: str):
+        self.d['bodyCodec'] = codec
+
+    @property
+    def journalSave(self) -> bool:
+        return self.d['journalSave'] == 'True'
+
+    @journalSave.setter
+    def journalSave(self, journal: bool):
+        self.d['journalSave'] = 'True' if journal else 'False'
+
+    @property
+    def mmapOpenSize(self) -> int:
+        '''
+        打开达到这个大小(MB)的文档时映射文件，不一次读入内存，0表示不映射
+        '''
+        return self.d['mmapOpenSize']
+
+    @mmapOpenSize.setter
+    def mmapOpenSize(self, size: int):
+        self.d['mmapOpenSize'] = size
+
+    @property
+    def backgroundSave(self) -> bool:
+        return self.d['backgroundSave'] == 'True'
+
+    @backgroundSave.setter
+    def backgroundSave(self, background: bool):
+        self.d['backgroundSave'] = 'True' if background else 'False'
+
+    @property
+    def lockMode(self) -> str:
+        return self.d['lockMode'] if self.d['lockMode'] in self.LockModes else 'encrypt'
+
+    @lockMode.setter
+    def lockMode(self, mode: str):
+        self.d['lockMode'] = mode
+
+    @property
+    def cameraImageFormat(self) -> str:
+        imageFormat = self.d['cameraImageFormat']
+        return imageFormat if imageFormat in self.CameraImageFormats else 'PNG'
+
+    @cameraImageFormat.setter
+    def cameraImageFormat(self, imageFormat: str):
+        self.d['cameraImageFormat'] = imageFormat
+
+    @property
+    def cameraImageQuality(self) -> int:
+        '''
+        JPEG和WebP的编码质量，1到100
+        '''
+        return self.d['cameraImageQuality']
+
+    @cameraImageQuality.setter
+    def cameraImageQuality(self, quality: int):
+        self.d['cameraImageQuality'] = quality
+
+    @property
+    def imageMaxSize(self) -> int:
+        '''
+        插入图片时缩小长边超过这个像素数的图片，0表示不限制
+        '''
+        return self.d['imageMaxSize']
+
+    @imageMaxSize.setter
+    def imageMaxSize(self, size: int):
+        self.d['imageMaxSize'] = size
+
+    @property
+    def imageMaxBytes(self) -> int:
+        '''
+        插入图片时缩小超过这个大小(KB)的图片，0表示不限制
+        '''
+        return self.d['imageMaxBytes']
+
+    @imageMaxBytes.setter
+    def imageMaxBytes(self, size: int):
+        self.d['imageMaxBytes'] = size
+
+    @property
+    def keepOriginalImage(self) -> bool:
+        '''
+        缩小图片时在文档中保留原图，默认保留，关闭后缩小的图片不能恢复
+        '''
+        return self.d['keepOriginalImage'] == 'True'
+
+    @keepOriginalImage.setter
+    def keepOriginalImage(self, keep: bool):
+        self.d['keepOriginalImage'] = 'True' if keep else 'False'
+
     @property
     def webcams(self):
         return copy.deepcopy(self.d['webcam'])
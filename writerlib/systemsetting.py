@@ -1,7 +1,9 @@
-from PySide6.QtWidgets import QDialog, QLabel, QSpinBox, QCheckBox, QGridLayout, QPushButton, QMessageBox
+from PySide6.QtWidgets import QDialog, QLabel, QSpinBox, QCheckBox, QGridLayout, QPushButton, QMessageBox, QComboBox
 from keymanager.key import set_key_timeout
 
-from .settings import getIcon
+from .assets import ImageScalePolicy
+from .doc import DocHead
+from .settings import getIcon, Settings
 from .widgets import checkLock
 
 
@@ -28,6 +30,51 @@ class SysSettingEditor(QDialog):
         self.resetTimeoutOnSelect = QCheckBox('选择、光标、滚动条变化时重置超时时间', self)
         self.resetTimeoutOnSelect.setChecked(self._parentWidget.systemSetting.resetTimeoutOnSelect)
 
+        bodyCodecLabel = QLabel('文档压缩格式')
+        self.bodyCodec = QComboBox(self)
+        self.bodyCodec.addItems(list(DocHead.Codec.Names.keys()))
+        self.bodyCodec.setCurrentText(self._parentWidget.systemSetting.bodyCodec)
+
+        self.journalSave = QCheckBox('保存时只追加修改的内容', self)
+        self.journalSave.setChecked(self._parentWidget.systemSetting.journalSave)
+        self.backgroundSave = QCheckBox('在后台保存文档', self)
+        self.backgroundSave.setChecked(self._parentWidget.systemSetting.backgroundSave)
+
+        lockModeLabel = QLabel('锁定文档的方式')
+        self.lockMode = QComboBox(self)
+        for mode, name in Settings.LockModes.items():
+            self.lockMode.addItem(name, mode)
+        self.lockMode.setCurrentIndex(self.lockMode.findData(self._parentWidget.systemSetting.lockMode))
+        self.lockMode.setToolTip('加密：锁定期间内存中只有密文，锁定和解锁的时间随文档大小增加，解锁后没有撤销记录\n'
+                                 '移除：锁定和解锁的时间与文档大小无关，保留撤销记录，但锁定期间内存中保留明文')
+
+        cameraImageFormatLabel = QLabel('摄像头图片格式')
+        self.cameraImageFormat = QComboBox(self)
+        for imageFormat, name in Settings.CameraImageFormats.items():
+            self.cameraImageFormat.addItem(name, imageFormat)
+        self.cameraImageFormat.setCurrentIndex(
+            self.cameraImageFormat.findData(self._parentWidget.systemSetting.cameraImageFormat))
+        cameraImageQualityLabel = QLabel('摄像头图片质量(JPEG、WebP)')
+        self.cameraImageQuality = QSpinBox(self)
+        self.cameraImageQuality.setRange(1, 100)
+        self.cameraImageQuality.setValue(self._parentWidget.systemSetting.cameraImageQuality)
+
+        imageMaxSizeLabel = QLabel('插入图片的最大边长(像素，0为不限制)')
+        self.imageMaxSize = QSpinBox(self)
+        self.imageMaxSize.setRange(0, 100000)
+        self.imageMaxSize.setValue(self._parentWidget.systemSetting.imageMaxSize)
+        imageMaxBytesLabel = QLabel('插入图片的最大大小(KB，0为不限制)')
+        self.imageMaxBytes = QSpinBox(self)
+        self.imageMaxBytes.setRange(0, 1000000)
+        self.imageMaxBytes.setValue(self._parentWidget.systemSetting.imageMaxBytes)
+        self.keepOriginalImage = QCheckBox('缩小图片时在文档中保留原图', self)
+        self.keepOriginalImage.setChecked(self._parentWidget.systemSetting.keepOriginalImage)
+
+        mmapOpenSizeLabel = QLabel('映射打开的文档大小(MB，0为不映射)')
+        self.mmapOpenSizeInput = QSpinBox(self)
+        self.mmapOpenSizeInput.setRange(0, 100000)
+        self.mmapOpenSizeInput.setValue(self._parentWidget.systemSetting.mmapOpenSize)
+
         layout = QGridLayout()
         rowIndex = 0
         layout.addWidget(timeoutLabel, rowIndex, 0)
@@ -39,6 +86,43 @@ class SysSettingEditor(QDialog):
         rowIndex += 1
         layout.addWidget(self.resetTimeoutOnSelect, rowIndex, 0, 1, 2)
 
+        rowIndex += 1
+        layout.addWidget(lockModeLabel, rowIndex, 0)
+        layout.addWidget(self.lockMode, rowIndex, 1)
+
+        rowIndex += 1
+        layout.addWidget(bodyCodecLabel, rowIndex, 0)
+        layout.addWidget(self.bodyCodec, rowIndex, 1)
+
+        rowIndex += 1
+        layout.addWidget(self.journalSave, rowIndex, 0, 1, 2)
+
+        rowIndex += 1
+        layout.addWidget(self.backgroundSave, rowIndex, 0, 1, 2)
+
+        rowIndex += 1
+        layout.addWidget(cameraImageFormatLabel, rowIndex, 0)
+        layout.addWidget(self.cameraImageFormat, rowIndex, 1)
+
+        rowIndex += 1
+        layout.addWidget(cameraImageQualityLabel, rowIndex, 0)
+        layout.addWidget(self.cameraImageQuality, rowIndex, 1)
+
+        rowIndex += 1
+        layout.addWidget(imageMaxSizeLabel, rowIndex, 0)
+        layout.addWidget(self.imageMaxSize, rowIndex, 1)
+
+        rowIndex += 1
+        layout.addWidget(imageMaxBytesLabel, rowIndex, 0)
+        layout.addWidget(self.imageMaxBytes, rowIndex, 1)
+
+        rowIndex += 1
+        layout.addWidget(self.keepOriginalImage, rowIndex, 0, 1, 2)
+
+        rowIndex += 1
+        layout.addWidget(mmapOpenSizeLabel, rowIndex, 0)
+        layout.addWidget(self.mmapOpenSizeInput, rowIndex, 1)
+
         self.buttonOk = QPushButton('保存')
         self.buttonOk.clicked.connect(self.ok)
         self.buttonCancel = QPushButton('取消')
@@ -56,7 +140,18 @@ class SysSettingEditor(QDialog):
         self._parentWidget.systemSetting.keyTimeout = self.timeoutInput.value()
         self._parentWidget.systemSetting.autoLockDoc = self.autoLockDoc.isChecked()
         self._parentWidget.systemSetting.resetTimeoutOnSelect = self.resetTimeoutOnSelect.isChecked()
+        self._parentWidget.systemSetting.lockMode = self.lockMode.currentData()
+        self._parentWidget.systemSetting.bodyCodec = self.bodyCodec.currentText()
+        self._parentWidget.systemSetting.journalSave = self.journalSave.isChecked()
+        self._parentWidget.systemSetting.backgroundSave = self.backgroundSave.isChecked()
+        self._parentWidget.systemSetting.mmapOpenSize = self.mmapOpenSizeInput.value()
+        self._parentWidget.systemSetting.cameraImageFormat = self.cameraImageFormat.currentData()
+        self._parentWidget.systemSetting.cameraImageQuality = self.cameraImageQuality.value()
+        self._parentWidget.systemSetting.imageMaxSize = self.imageMaxSize.value()
+        self._parentWidget.systemSetting.imageMaxBytes = self.imageMaxBytes.value()
+        self._parentWidget.systemSetting.keepOriginalImage = self.keepOriginalImage.isChecked()
         self._parentWidget.systemSetting.write()
+        self._parentWidget.text.imageScalePolicy = ImageScalePolicy.fromSettings(self._parentWidget.systemSetting)
         set_key_timeout(self._parentWidget.systemSetting.keyTimeout)
         self.close()
 
@@ -1,18 +1,19 @@
 import base64
 import copy
+import hashlib
+import re
 from datetime import datetime
 from time import strftime, gmtime
-from typing import Optional, List
+from typing import Optional, List, Dict, Mapping
 
 import PySide6.QtCore
 from PySide6 import QtCore, QtGui
-from PySide6.QtGui import QImage, QTextImageFormat, QTextCursor, QTextTable, QTextTableCell
+from PySide6.QtGui import QImage, QTextImageFormat, QTextCursor, QTextTable, QTextTableCell, QTextDocument
 from PySide6.QtWidgets import QTextEdit
-from io import BytesIO
 
-import imghdr
-
-from .doc import DocFile, DocBody, DocInfoBlock, DocHead
+from .assets import ImageCache, ImageInfo, ImageScalePolicy, imageToBytes, getImageType, prepareImage
+from .docio import ImageIngestor
+from .doc import DocFile, DocBody, DocHead, DocInfoTable, DocProperties
 from .settings import DocumentProperties
 
 
@@ -32,6 +33,21 @@ class Selection:
         return False
 
 
+class PendingImages:
+    '''
+    一次插入的多个图片文件，placeholders指向各个占位图片，results保存还没有按顺序替换的结果
+    '''
+
+    def __init__(self, names: List[str], placeholders: List[QTextCursor]):
+        self.names = names
+        self.placeholders = placeholders
+        self.results: Dict[int, object] = dict()
+        self.next = 0
+
+    def isDone(self) -> bool:
+        return self.next == len(self.placeholders)
+
+
 class TextEdit(QTextEdit):
 
     style = '''
@@ -39,12 +55,36 @@ class TextEdit(QTextEdit):
     QTextEdit { selection-background-color: rgb(240,208,140)}
     '''
 
+    # 图片保存在资源区，图片名称为 asset:sha256
+    AssetScheme = 'asset'
+    assetUrlPattern = re.compile(r'(?:src|href)="asset:([0-9a-f]{64})"')
+    dataUriPattern = re.compile(r'src="data:image/[^;"]*;base64,([^"]*)"')
+    # 图片文件处理完成之前插入的占位图片，名称为 placeholder:批次-序号
+    PlaceholderScheme = 'placeholder'
+    placeholderSize = 64
+    EncodedImageMimeTypes = ('image/png', 'image/jpeg', 'image/gif', 'image/webp')
+
     def __init__(self, parent: Optional[PySide6.QtWidgets.QWidget]) -> None:
         super().__init__(parent)
         self._parentWidget = parent
         self.documentProperty = copy.deepcopy(DocumentProperties)
         self.addCreateTime()
         self.isEncryptDocument = False
+        self.assets: Dict[str, bytes] = dict()
+        # 解码后的图片，sha256 -> QImage
+        self.imageCache = ImageCache()
+        # 图片的原始宽高、格式和大小，sha256 -> ImageInfo
+        self.imageInfos: Dict[str, ImageInfo] = dict()
+        # 插入图片时缩小过大的图片，由系统设置更新
+        self.imageScalePolicy = ImageScalePolicy()
+        self.imageIngestor = ImageIngestor(self)
+        self.imageIngestor.ingested.connect(self.imagesIngested)
+        self.ingestId = 0
+        self.pendingImages: Dict[int, PendingImages] = dict()
+        self.placeholderImage = QImage(self.placeholderSize, self.placeholderSize, QImage.Format.Format_RGB32)
+        self.placeholderImage.fill(QtGui.QColor(224, 224, 224))
+        # 打开的文档中的信息块，保存时保留不认识的属性
+        self.docInfoTable = DocInfoTable()
         self.setStyleSheet(self.style)
 
 
@@ -61,6 +101,8 @@ class TextEdit(QTextEdit):
     def dropEvent(self, e: PySide6.QtGui.QDropEvent) -> None:
         source = e.mimeData()
         if source.hasImage() or source.hasUrls():
+            # 插入到拖放的位置
+            self.setTextCursor(self.cursorForPosition(e.position().toPoint()))
             self.insertRichContentFromMimeData(source)
             return
         else:
@@ -75,47 +117,234 @@ class TextEdit(QTextEdit):
 
     def insertRichContentFromMimeData(self, source: PySide6.QtCore.QMimeData) -> None:
         if source.hasImage():
+            # 剪贴板中有编码后的图片时直接使用原始数据
+            for mimeType in self.EncodedImageMimeTypes:
+                if source.hasFormat(mimeType) and self.insertImageBytes(source.data(mimeType).data()):
+                    return True
             img = source.imageData()
             self.dropImage(img)
             return True
         elif source.hasUrls():
-            for u in source.urls():
-                if u.isLocalFile():
-                    i = QImage(u.toLocalFile())
-                    self.dropImage(i)
+            self.insertImageFiles([u.toLocalFile() for u in source.urls() if u.isLocalFile()])
             return True
         return False
 
-    def dropImage(self, image: QImage):
-        image_bytes = self.qImageToBytes(image)
-        self.insertImageInFile(image_bytes)
-
-    def qImageToBytes(self, image: QImage):
-        ba = QtCore.QByteArray()
-        buffer = QtCore.QBuffer(ba)
-        buffer.open(QtCore.QIODevice.OpenModeFlag.WriteOnly)
-        image.save(buffer, "PNG")
-        bio = BytesIO(ba)
-        return bio.getvalue()
+    def insertImageFiles(self, filenames: List[str]):
+        '''
+        在光标处插入占位图片，图片文件在线程池中处理，完成后按顺序替换占位图片，不能解码的文件删除占位图片
+        '''
+        if not filenames:
+            return
+        self.ingestId += 1
+        names = []
+        placeholders = []
+        cursor = self.textCursor()
+        cursor.beginEditBlock()
+        cursor.removeSelectedText()
+        for index in range(len(filenames)):
+            name = '%s:%d-%d' % (self.PlaceholderScheme, self.ingestId, index)
+            self.document().addResource(QTextDocument.ResourceType.ImageResource, QtCore.QUrl(name),
+                                        self.placeholderImage)
+            imageFormat = QTextImageFormat()
+            imageFormat.setName(name)
+            imageFormat.setWidth(self.placeholderSize)
+            imageFormat.setHeight(self.placeholderSize)
+            position = cursor.position()
+            cursor.insertImage(imageFormat)
+            # 在占位图片之前输入文字时光标随之移动
+            placeholder = QTextCursor(self.document())
+            placeholder.setPosition(position)
+            names.append(name)
+            placeholders.append(placeholder)
+        cursor.endEditBlock()
+        self.pendingImages[self.ingestId] = PendingImages(names, placeholders)
+        self.imageIngestor.ingest(self.ingestId, filenames, self.imageScalePolicy)
+
+    def imagesIngested(self):
+        for ingestId, index, result in self.imageIngestor.takeResults():
+            self.imageIngested(ingestId, index, result)
+
+    def imageIngested(self, ingestId: int, index: int, result):
+        pending = self.pendingImages.get(ingestId)
+        if pending is None:
+            return
+        pending.results[index] = result
+        while pending.next in pending.results:
+            self.replacePlaceholder(pending.names[pending.next], pending.placeholders[pending.next],
+                                    pending.results.pop(pending.next))
+            pending.next += 1
+        if pending.isDone():
+            del self.pendingImages[ingestId]
+
+    def replacePlaceholder(self, name: str, cursor: QTextCursor, result):
+        '''
+        占位图片已经被删除，或者所在的文档已经关闭时忽略结果
+        '''
+        if cursor.isNull():
+            return
+        cursor.movePosition(QTextCursor.MoveOperation.NextCharacter, QTextCursor.MoveMode.KeepAnchor)
+        charFormat = cursor.charFormat()
+        if not charFormat.isImageFormat() or charFormat.toImageFormat().name() != name:
+            return
+        if result is None:
+            cursor.removeSelectedText()
+        else:
+            self.insertImageInFile(*result, cursor=cursor)
+
+    def cancelImages(self):
+        '''
+        已经完成的图片替换占位图片，删除其余的占位图片，之后完成的图片被忽略
+        '''
+        for pending in self.pendingImages.values():
+            for index in range(pending.next, len(pending.placeholders)):
+                self.replacePlaceholder(pending.names[index], pending.placeholders[index],
+                                        pending.results.pop(index, None))
+        self.pendingImages.clear()
+
+    def waitForImages(self):
+        '''
+        等待正在插入的图片替换占位图片，直接处理结果，不处理事件队列中的其他事件
+        '''
+        if self.pendingImages:
+            for ingestId, index, result in self.imageIngestor.waitForDone():
+                self.imageIngested(ingestId, index, result)
+
+    def insertImageFile(self, filename: str) -> bool:
+        try:
+            with open(filename, 'rb') as f:
+                image_bytes = f.read()
+        except OSError:
+            return False
+        return self.insertImageBytes(image_bytes)
+
+    def insertImageBytes(self, image_bytes: bytes) -> bool:
+        '''
+        插入编码后的图片，常见的压缩格式保留原始数据，其他格式转换为PNG，不能解码时返回False
+        '''
+        result = prepareImage(image_bytes, self.imageScalePolicy)
+        if result is None:
+            return False
+        self.insertImageInFile(*result)
+        return True
+
+    def dropImage(self, image: QImage, imageFormat: str = 'PNG', quality: int = -1):
+        self.insertImageInFile(*self.imageScalePolicy.apply(image, None, imageFormat, quality))
+
+    def qImageToBytes(self, image: QImage, imageFormat: str = 'PNG', quality: int = -1):
+        return imageToBytes(image, imageFormat, quality)
 
     def getImageType(self, image_bytes):
-        f = BytesIO()
-        f.write(image_bytes)
-        f.seek(0)
-        imgType = imghdr.what(f)
-        f.close()
-        return imgType
-
-    def insertImageInFile(self, image_bytes):
-        imgType = self.getImageType(image_bytes)
-        base64text = "".join(['data:image/', imgType, ';base64,', base64.b64encode(image_bytes).decode('utf-8')])
+        return getImageType(image_bytes)
+
+    def insertImageInFile(self, image_bytes, image: QImage = None, original: bytes = None,
+                          cursor: QTextCursor = None):
+        '''
+        图片名称为 asset:sha256，已经解码的图片放入缓存，文档通过loadResource读取时不需要再次解码。
+        original为缩小前的原图，保存为资源并作为图片的链接，在需要时才解码。
+        cursor为None时插入到编辑器的光标处，否则替换cursor选中的内容
+        '''
+        name = self.addAsset(image_bytes)
+        assetHash = name[len(self.AssetScheme) + 1:]
+        if image is None:
+            image = self.getImage(name)
+        else:
+            self.imageCache.put(assetHash, image)
+        self.imageInfos[assetHash] = ImageInfo.ofImage(image, image_bytes)
         imageFormat = QTextImageFormat()
-        imageFormat.setName(base64text)
-        image = QImage()
-        image.loadFromData(image_bytes)
+        imageFormat.setName(name)
         imageFormat.setWidth(image.width())
         imageFormat.setHeight(image.height())
+        if original is not None:
+            imageFormat.setAnchor(True)
+            imageFormat.setAnchorHref(self.addAsset(original))
+            self.getImageInfo(imageFormat.anchorHref())
+        if cursor is not None:
+            cursor.insertImage(imageFormat)
+            return
+        if original is None:
+            self.textCursor().insertImage(imageFormat)
+            return
+        # 之后输入的文字不带原图的链接
+        charFormat = self.currentCharFormat()
         self.textCursor().insertImage(imageFormat)
+        self.setCurrentCharFormat(charFormat)
+
+    def addAsset(self, data: bytes) -> str:
+        assetHash = hashlib.sha256(data).hexdigest()
+        if assetHash not in self.assets:
+            self.assets[assetHash] = bytes(data)
+        return self.AssetScheme + ':' + assetHash
+
+    def setAssets(self, assets: Dict[str, bytes], imageInfos: Dict[str, ImageInfo] = None):
+        self.assets = assets
+        self.imageInfos = dict() if imageInfos is None else imageInfos
+        self.imageCache.clear()
+
+    def setDocInfoTable(self, docInfoTable: DocInfoTable):
+        self.docInfoTable = docInfoTable
+
+    def getImageBytes(self, name: str) -> bytes:
+        if name.startswith(self.AssetScheme + ':'):
+            return self.assets[name[len(self.AssetScheme) + 1:]]
+        return base64.b64decode(name[name.index(',') + 1:].encode('utf-8'))
+
+    def getOriginalImageName(self, imageFormat: QTextImageFormat) -> str:
+        '''
+        图片缩小时保留了原图的返回原图的名称，否则返回图片的名称
+        '''
+        href = imageFormat.anchorHref()
+        if imageFormat.isAnchor() and href.startswith(self.AssetScheme + ':') \
+                and href[len(self.AssetScheme) + 1:] in self.assets:
+            return href
+        return imageFormat.name()
+
+    def getImageInfo(self, name: str) -> Optional[ImageInfo]:
+        '''
+        返回图片的原始宽高、格式和大小，只解析图片头，资源中的图片只解析一次
+        '''
+        if not name.startswith(self.AssetScheme + ':'):
+            return ImageInfo.of(self.getImageBytes(name))
+        assetHash = name[len(self.AssetScheme) + 1:]
+        info = self.imageInfos.get(assetHash)
+        if info is None and assetHash in self.assets:
+            info = ImageInfo.of(self.assets[assetHash])
+            if info is not None:
+                self.imageInfos[assetHash] = info
+        return info
+
+    def getImage(self, name: str) -> QImage:
+        '''
+        返回解码后的图片，资源中的图片留在缓存中时不再解码
+        '''
+        if not name.startswith(self.AssetScheme + ':'):
+            image = QImage()
+            image.loadFromData(self.getImageBytes(name))
+            return image
+        assetHash = name[len(self.AssetScheme) + 1:]
+        image = self.imageCache.get(assetHash)
+        if image is None:
+            image = QImage()
+            data = self.assets.get(assetHash)
+            if data is not None:
+                image.loadFromData(data)
+                self.imageCache.put(assetHash, image)
+        return image
+
+    def loadResource(self, type: int, name: PySide6.QtCore.QUrl):
+        if name.scheme() == self.AssetScheme and name.path() in self.assets:
+            return self.getImage(self.AssetScheme + ':' + name.path())
+        return super().loadResource(type, name)
+
+    def dataUriToAsset(self, html: str, assets: Dict[str, bytes]) -> str:
+        '''
+        把html中base64编码的图片转换为资源
+        '''
+        def replace(match):
+            data = base64.b64decode(match.group(1))
+            assetHash = hashlib.sha256(data).hexdigest()
+            assets.setdefault(assetHash, data)
+            return 'src="%s:%s"' % (self.AssetScheme, assetHash)
+        return self.dataUriPattern.sub(replace, html)
 
     def getSelection(self) -> Selection:
         cursor = self.textCursor()
@@ -213,42 +442,59 @@ class TextEdit(QTextEdit):
     #     else:
     #         return getChar(blockText, charIndexBeforeCursor, charIndexAfterCursor)
 
-    def docfromBytes(self, fileData:bytes) -> (str, dict):
+    def docfromBytes(self, fileData:bytes) -> (str, DocProperties, dict):
+        return self.docfromDocFile(DocFile.fromBytes(fileData))
+
+    def docfromDocFile(self, docFile: DocFile) -> (str, DocProperties, dict):
 
-        docFile = DocFile.fromBytes(fileData)
+        # 属性在读取时才解码，信息块复制出来以便释放文件内容
+        properties = DocInfoTable.of(docFile.docInfoBlock).copy().properties()
 
-        properties = {}
-        for block in docFile.docInfoBlock:
-            properties[block.name.decode('utf-8')] = block.value.decode('utf-8')
+        # 正文可能是memoryview，直接解码，不复制
+        html = str(docFile.docBody.content, 'utf-8')
 
-        html = docFile.docBody.content.decode('utf-8')
+        # 资源可能引用了整个文件的数据，复制出来以便释放文件内容
+        assets = {assetHash: bytes(asset) for assetHash, asset in docFile.docAssets.items()}
+        html = self.dataUriToAsset(html, assets)
 
-        return html, properties
+        return html, properties, assets
 
-    def docToBytes(self, html: str, properties:dict) -> bytes:
+    def docToBytes(self, html: str, properties:dict, codec:int=DocHead.Codec.Raw) -> bytes:
+        return b''.join(self.docToDocFile(html, properties, codec).toBuffers())
+
+    def docToDocFile(self, html: str, properties:dict, codec:int=DocHead.Codec.Raw,
+                     assets:Dict[str, bytes]=None, docInfoTable:DocInfoTable=None) -> DocFile:
+        '''
+        在其他线程中保存时传入资源和信息块的快照
+        '''
+        assets = self.assets if assets is None else assets
+        docInfoTable = self.docInfoTable if docInfoTable is None else docInfoTable
 
         df = DocFile()
 
+        html = self.dataUriToAsset(html, assets)
+        for assetHash in self.assetUrlPattern.findall(html):
+            if assetHash in assets:
+                df.docAssets[assetHash] = assets[assetHash]
+
         docBody = DocBody()
         docBody.content = html.encode('utf-8')
 
-        infoList:List[DocInfoBlock] = list()
+        # 只修改传入的属性，其他信息块保存原数据
+        infoTable = docInfoTable.copy()
         for name, value in properties.items():
-            block = DocInfoBlock()
-            block.name = name.encode('utf-8')
-            block.value = value.encode('utf-8')
-            infoList.append(block)
+            infoTable.set(name.encode('utf-8'), value.encode('utf-8'))
 
         head = DocHead()
         head.docBodyLen = len(docBody.content)
         head.docType = DocHead.DocType.Writer
-        head.docInfoBlockLen = [i.getByteLen() for i in infoList]
+        head.codec = codec
 
         df.docHead = head
         df.docBody = docBody
-        df.docInfoBlock = infoList
+        df.docInfoBlock = infoTable
 
-        return df.toByteIO().getvalue()
+        return df
 
     def updateEditTime(self):
         dt = datetime.now()
@@ -270,7 +516,10 @@ class TextEdit(QTextEdit):
         return result
 
     @staticmethod
-    def dictToDocumentProperty(d:dict, documentProperty:dict):
-        for k, v in d.items():
-            documentProperty[k]['value'] = v
+    def dictToDocumentProperty(d:Mapping, documentProperty:dict):
+        # 只读取已知的属性，DocProperties中的其他属性不会解码
+        for k, v in documentProperty.items():
+            value = d.get(k)
+            if value is not None:
+                v['value'] = value
         return documentProperty
\ No newline at end of file